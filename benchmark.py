@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 SUSE LINUX GmbH, Nuernberg, Germany.
+#
+# All modifications and additions to the file contributed by third parties
+# remain the property of their copyright owners, unless otherwise agreed
+# upon. The license for this file, and modifications and additions to the
+# file, is the same license as for the pristine package itself (unless the
+# license for the pristine package is not an Open Source License, in which
+# case the license is the MIT License). An "Open Source License" is a
+# license that conforms to the Open Source Definition (Version 1.9)
+# published by the Open Source Initiative.
+
+# Please submit bugfixes or comments via http://bugs.opensuse.org/
+#
+
+# Benchmarks for venvjail.  Generate a synthetic RPM repository (no
+# network or rpmbuild required) and measure the main phases of
+# `create`.  The results are stored as JSON, so can be compared
+# between commits.
+
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import os.path
+import platform
+import random
+import shutil
+import stat
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import venvjail
+
+
+# Header types used when writing a RPM header
+INT16 = 3
+INT32 = 4
+STRING = 6
+BIN = 7
+STRING_ARRAY = 8
+
+RPMSIGTAG_SIZE = 1000
+
+# Value of RPMTAG_FILEDIGESTALGO for SHA256
+PGPHASHALGO_SHA256 = 8
+# Flag for `=` in a dependency
+RPMSENSE_EQUAL = 8
+
+MTIME = 1500000000
+
+
+def _header(tags):
+    """Build a RPM header from a list of (tag, type, value)."""
+    index = []
+    store = b''
+    alignment = {INT16: 2, INT32: 4}
+    for tag, type_, value in sorted(tags):
+        store += b'\0' * (-len(store) % alignment.get(type_, 1))
+        if type_ == STRING:
+            data, count = value.encode('utf-8') + b'\0', 1
+        elif type_ == STRING_ARRAY:
+            data = b''.join(v.encode('utf-8') + b'\0' for v in value)
+            count = len(value)
+        elif type_ == BIN:
+            data, count = value, len(value)
+        else:
+            fmt = '>%d%s' % (len(value), 'H' if type_ == INT16 else 'I')
+            data, count = struct.pack(fmt, *value), len(value)
+        index.append(struct.pack('>IIII', tag, type_, len(store), count))
+        store += data
+    return (venvjail.RPM_HEADER_MAGIC + b'\0' * 4
+            + struct.pack('>II', len(index), len(store))
+            + b''.join(index) + store)
+
+
+def _cpio(files):
+    """Build a newc cpio archive from a list of (path, mode, data)."""
+    archive = []
+    for ino, (path, mode, data) in enumerate(
+            files + [('TRAILER!!!', 0, b'')], 1):
+        name = (path if path == 'TRAILER!!!' else './' + path).encode()
+        name += b'\0'
+        fields = (ino, mode, 0, 0, 1, MTIME, len(data), 0, 0, 0, 0,
+                  len(name), 0)
+        entry = b'070701' + b''.join(b'%08X' % field for field in fields)
+        entry += name
+        entry += b'\0' * (-len(entry) % 4)
+        archive.append(entry + data + b'\0' * (-len(data) % 4))
+    return b''.join(archive)
+
+
+def _compress(data, compressor):
+    if compressor == 'gzip':
+        return gzip.compress(data, 6)
+    elif compressor == 'bzip2':
+        return bz2.compress(data)
+    elif compressor == 'xz':
+        return lzma.compress(data)
+    elif compressor == 'zstd':
+        return venvjail.zstandard.ZstdCompressor().compress(data)
+    raise ValueError('Unknown compressor %s' % compressor)
+
+
+def write_rpm(filename, name, files, requires=(), compressor='gzip'):
+    """Write a minimal binary RPM.
+
+    `files` is a list of (path, mode, data), where the data of a link
+    is the target.
+    """
+    classes = ['', 'directory', 'ASCII text']
+    file_class = []
+    for _, mode, data in files:
+        if stat.S_ISDIR(mode):
+            file_class.append(1)
+        elif data.startswith(b'#!') and stat.S_ISREG(mode):
+            # Like file(1), "a INTERPRETER script"
+            interpreter = data[2:].split(b'\n', 1)[0].strip().decode()
+            class_ = 'a %s script, ASCII text executable' % interpreter
+            if class_ not in classes:
+                classes.append(class_)
+            file_class.append(classes.index(class_))
+        elif stat.S_ISREG(mode):
+            file_class.append(2)
+        else:
+            file_class.append(0)
+    dirnames = sorted(set('/' + os.path.dirname(path) + '/'
+                          for path, _, _ in files))
+    regular = [stat.S_ISREG(mode) for _, mode, _ in files]
+    tags = [
+        (venvjail.RPMTAG_NAME, STRING, name),
+        (venvjail.RPMTAG_VERSION, STRING, '1.0'),
+        (venvjail.RPMTAG_RELEASE, STRING, '1.1'),
+        (venvjail.RPMTAG_ARCH, STRING, 'noarch'),
+        (venvjail.RPMTAG_DISTURL, STRING,
+         'obs://build.example.org/Bench/standard/%s' % name),
+        (venvjail.RPMTAG_PAYLOADFORMAT, STRING, 'cpio'),
+        (venvjail.RPMTAG_PAYLOADCOMPRESSOR, STRING, compressor),
+        (venvjail.RPMTAG_PROVIDENAME, STRING_ARRAY, [name]),
+        (venvjail.RPMTAG_PROVIDEFLAGS, INT32, [RPMSENSE_EQUAL]),
+        (venvjail.RPMTAG_PROVIDEVERSION, STRING_ARRAY, ['1.0-1.1']),
+        (venvjail.RPMTAG_FILEDIGESTALGO, INT32, [PGPHASHALGO_SHA256]),
+        (venvjail.RPMTAG_CLASSDICT, STRING_ARRAY, classes),
+    ]
+    if requires:
+        tags += [
+            (venvjail.RPMTAG_REQUIRENAME, STRING_ARRAY, list(requires)),
+            (venvjail.RPMTAG_REQUIREFLAGS, INT32, [0] * len(requires)),
+            (venvjail.RPMTAG_REQUIREVERSION, STRING_ARRAY,
+             [''] * len(requires)),
+        ]
+    if files:
+        tags += [
+            (venvjail.RPMTAG_BASENAMES, STRING_ARRAY,
+             [os.path.basename(path) for path, _, _ in files]),
+            (venvjail.RPMTAG_DIRNAMES, STRING_ARRAY, dirnames),
+            (venvjail.RPMTAG_DIRINDEXES, INT32,
+             [dirnames.index('/' + os.path.dirname(path) + '/')
+              for path, _, _ in files]),
+            (venvjail.RPMTAG_FILESIZES, INT32,
+             [len(data) if not stat.S_ISDIR(mode) else 4096
+              for _, mode, data in files]),
+            (venvjail.RPMTAG_FILEMODES, INT16,
+             [mode for _, mode, _ in files]),
+            (venvjail.RPMTAG_FILEMTIMES, INT32, [MTIME] * len(files)),
+            (venvjail.RPMTAG_FILEDIGESTS, STRING_ARRAY,
+             [hashlib.sha256(data).hexdigest() if is_regular else ''
+              for (_, _, data), is_regular in zip(files, regular)]),
+            (venvjail.RPMTAG_FILELINKTOS, STRING_ARRAY,
+             [data.decode() if stat.S_ISLNK(mode) else ''
+              for _, mode, data in files]),
+            (venvjail.RPMTAG_FILEFLAGS, INT32, [0] * len(files)),
+            (venvjail.RPMTAG_FILECLASS, INT32, file_class),
+        ]
+    header = _header(tags)
+    payload = _compress(_cpio([(path, mode, data if not
+                                stat.S_ISDIR(mode) else b'')
+                               for path, mode, data in files]), compressor)
+    signature = _header([(RPMSIGTAG_SIZE, INT32,
+                          [len(header) + len(payload)])])
+    signature += b'\0' * (-len(signature) % 8)
+    lead = venvjail.RPM_LEAD_MAGIC + b'\x03\x00' + b'\0' * 90
+    with open(filename, 'wb') as f:
+        f.write(lead + signature + header + payload)
+
+
+def generate_repo(repo, packages=100, files=50, scripts=0.1, symlinks=0.05,
+                  alternatives=0.1, services=0.05, size=4096,
+                  compressor='gzip', seed=0):
+    """Generate a synthetic repository of python-* RPMs.
+
+    `scripts`, `symlinks`, `alternatives` and `services` are the
+    ratios of files (or packages, for alternatives and services) of
+    each kind.  Return the list of generated RPM names.
+    """
+    rand = random.Random(seed)
+    os.makedirs(repo, exist_ok=True)
+    rpms = []
+    D, F, X, L = 0o40755, 0o100644, 0o100755, 0o120777
+    for n in range(packages):
+        name = 'python-bench%04d' % n
+        module = 'usr/lib/python2.7/site-packages/bench%04d' % n
+        content = [(module, D, b'')]
+        for i in range(files):
+            kind = rand.random()
+            if kind < scripts:
+                data = b'#!/usr/bin/python2\nimport bench%04d\n' % n
+                content.append(('usr/bin/bench%04d-%d' % (n, i), X, data))
+            elif kind < scripts + symlinks:
+                content.append(('%s/link%d.py' % (module, i), L,
+                                b'mod%d.py' % (i - 1)))
+            else:
+                data = bytes(rand.getrandbits(8) for _ in range(16))
+                data = (data * (size // 16 + 1))[:rand.randint(1, size)]
+                content.append(('%s/mod%d.py' % (module, i), F, data))
+        if rand.random() < alternatives:
+            tool = 'usr/bin/bench%04d-tool' % n
+            content.append((tool, L, b'/etc/alternatives/bench%04d-tool' % n))
+            content.append((tool + '-2.7', X,
+                            b'#!/usr/bin/python2.7\nimport sys\n'))
+            content.append(('srv/www/bench%04d' % n, L, b'/' + tool.encode()))
+        if rand.random() < services:
+            content.append((
+                'usr/lib/systemd/system/bench%04d.service' % n, F,
+                b'[Service]\nExecStartPre=-/usr/bin/true\n'
+                b'ExecStart=/usr/bin/bench%04d-tool\n' % n))
+        requires = ['python-bench%04d' % rand.randrange(n)] if n else []
+        rpm = '%s-1.0-1.1.noarch.rpm' % name
+        write_rpm(os.path.join(repo, rpm), name, content, requires,
+                  compressor)
+        rpms.append(rpm)
+    return rpms
+
+
+def _measure(func, repeat, setup=None):
+    """Call `func` `repeat` times, returning the wall times."""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _fresh_tree(tree, workdir):
+    """Return a copy of an extracted tree, for fixups that modify it."""
+    dest_dir = os.path.join(workdir, 'venv')
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    shutil.copytree(tree, dest_dir, symlinks=True)
+    return dest_dir
+
+
+def _extract(repo, rpms, dest_dir, jobs):
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.makedirs(os.path.join(dest_dir, 'bin'))
+    os.makedirs(os.path.join(dest_dir, 'lib'))
+    os.mkdir(os.path.join(dest_dir, 'usr'))
+    for link, target in (('bin', '../bin'), ('lib', '../lib'),
+                         ('lib64', '../lib')):
+        os.symlink(target, os.path.join(dest_dir, 'usr', link))
+    packages = [os.path.abspath(os.path.join(repo, rpm)) for rpm in rpms]
+    return venvjail._extract_packages(packages, dest_dir, jobs)
+
+
+def run(args):
+    """Generate the repository and run all the benchmarks."""
+    workdir = tempfile.mkdtemp(prefix='venvjail-bench-', dir=args.workdir)
+    results = {}
+    try:
+        repo = os.path.join(workdir, 'repo')
+        rpms = generate_repo(
+            repo, args.packages, args.files, args.scripts, args.symlinks,
+            args.alternatives, args.services, args.size, args.compressor)
+
+        # Rules as generated by the `include` sub-command
+        include = os.path.join(workdir, 'include-rpm')
+        with open(include, 'w') as f:
+            for rpm in rpms:
+                print('%s.*' % rpm.rsplit('-', 2)[0], file=f)
+        exclude = os.path.join(workdir, 'exclude-rpm')
+        with open(exclude, 'w') as f:
+            print(venvjail.EXCLUDE_RPM, file=f)
+        include, exclude = venvjail.FileList(include), \
+            venvjail.FileList(exclude)
+        results['filelist_contains'] = _measure(
+            lambda: [rpm in include and rpm not in exclude for rpm in rpms],
+            args.repeat)
+
+        tree = os.path.join(workdir, 'tree')
+        for jobs in sorted(set((1, args.jobs))):
+            results['extract_j%d' % jobs] = _measure(
+                lambda: _extract(repo, rpms, tree, jobs), args.repeat)
+        extracted = _extract(repo, rpms, tree, 1)
+
+        relocated = '/opt/stack/venv'
+        virtual_env = os.path.join(relocated, 'venv')
+
+        def setup():
+            return (_fresh_tree(tree, workdir),)
+        results['fix_relocation'] = _measure(
+            lambda dest_dir: venvjail._fix_relocation(
+                dest_dir, virtual_env, []), args.repeat, setup)
+        results['fix_alternatives_broken_links'] = _measure(
+            lambda dest_dir: venvjail._fix_tree(dest_dir, [
+                venvjail.AlternativesFixup(relocated),
+                venvjail.BrokenLinksFixup(dest_dir, ['srv'])]),
+            args.repeat, setup)
+        results['fix_tree'] = _measure(
+            lambda dest_dir: venvjail._fix_tree(dest_dir, [
+                venvjail.AlternativesFixup(relocated),
+                venvjail.BrokenLinksFixup(dest_dir, ['srv']),
+                venvjail.RelocationFixup(virtual_env, [])]),
+            args.repeat, setup)
+        results['fix_systemd_services'] = _measure(
+            lambda dest_dir: venvjail._fix_systemd_services(
+                dest_dir, virtual_env), args.repeat, setup)
+
+        headers = [header for header, _ in extracted.values()]
+        results['track'] = _measure(
+            lambda: [venvjail._track_record(header) for header in headers],
+            args.repeat)
+
+        # The full `create` needs virtualenv and python2.7
+        if shutil.which('virtualenv') and shutil.which('python2.7'):
+            def create():
+                dest_dir = os.path.join(workdir, 'bench-20180101')
+                shutil.rmtree(dest_dir, ignore_errors=True)
+                subprocess.check_call(
+                    [sys.executable, venvjail.__file__, 'create', dest_dir,
+                     '--repo', repo, '--jobs', str(args.jobs),
+                     '--include', os.path.join(workdir, 'include-rpm'),
+                     '--exclude', os.path.join(workdir, 'exclude-rpm'),
+                     '--track', os.path.join(workdir, 'track')],
+                    stdout=subprocess.DEVNULL)
+            results['create'] = _measure(create, args.repeat)
+        else:
+            print('Skipping create: virtualenv or python2.7 not found',
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare', 'workdir')},
+        'results': {name: {'min': min(times),
+                           'median': statistics.median(times),
+                           'runs': times}
+                    for name, times in results.items()},
+    }
+
+
+def _commit():
+    """Return the current git commit, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(venvjail.__file__))
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base, current):
+    """Print the ratio between two benchmark results."""
+    print('%-32s %10s %10s %8s' % ('benchmark', 'base', 'current', 'ratio'))
+    for name, result in sorted(current['results'].items()):
+        if name not in base['results']:
+            continue
+        old = base['results'][name]['min']
+        new = result['min']
+        print('%-32s %10.4f %10.4f %7.2fx' % (name, old, new,
+                                              new / old if old else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for venvjail using a synthetic repository')
+    parser.add_argument('-n', '--packages', type=int, default=100,
+                        help='Number of RPMs in the repository')
+    parser.add_argument('-f', '--files', type=int, default=50,
+                        help='Files per RPM')
+    parser.add_argument('--scripts', type=float, default=0.1,
+                        help='Ratio of python scripts with shebang')
+    parser.add_argument('--symlinks', type=float, default=0.05,
+                        help='Ratio of symbolic links')
+    parser.add_argument('--alternatives', type=float, default=0.1,
+                        help='Ratio of RPMs with alternatives links')
+    parser.add_argument('--services', type=float, default=0.05,
+                        help='Ratio of RPMs with systemd services')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='Maximum size of a file')
+    parser.add_argument('-c', '--compressor', default='gzip',
+                        choices=('gzip', 'bzip2', 'xz', 'zstd'),
+                        help='Payload compressor')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of jobs for the parallel extraction')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Repetitions of every benchmark')
+    parser.add_argument('-w', '--workdir',
+                        help='Directory for the temporary files')
+    parser.add_argument('-o', '--output',
+                        help='Store the results in this JSON file')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='Compare with the results of other run')
+    args = parser.parse_args()
+    if args.compressor == 'zstd' and not venvjail.zstandard:
+        parser.error('zstd requires the zstandard module')
+
+    current = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+    else:
+        json.dump(current, sys.stdout, indent=1, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), current)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Tests for the reproducible archive written by `create`.  The command
+# is run with a stand-in `virtualenv`, that only creates the activators.
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import benchmark  # noqa: E402
+
+VENVJAIL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'venvjail.py')
+
+F, X = 0o100644, 0o100755
+MODULE = 'usr/lib/python2.7/site-packages'
+
+VIRTUALENV = r'''#!/bin/sh
+[ "$1" = "--version" ] && { echo 15.1.0; exit 0; }
+for last; do true; done
+mkdir -p "$last/bin" "$last/lib"
+printf 'VIRTUAL_ENV="%s"\ndeactivate nondestructive\n' "$last" \
+    > "$last/bin/activate"
+printf 'setenv VIRTUAL_ENV "%s"\ndeactivate nondestructive\n' "$last" \
+    > "$last/bin/activate.csh"
+printf 'set -gx VIRTUAL_ENV "%s"\ndeactivate nondestructive\n' "$last" \
+    > "$last/bin/activate.fish"
+ln -s /usr/bin/python3 "$last/bin/python"
+'''
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        os.mkdir(os.path.join(self.tmp, 'repo'))
+        benchmark.write_rpm(
+            os.path.join(self.tmp, 'repo', 'python-tool-1.0-1.1.noarch.rpm'),
+            'python-tool', [
+                (MODULE + '/tool.py', F, b'print(1)\n'),
+                ('usr/bin/tool', X, b'#!/usr/bin/python2\nimport tool\n'),
+                ('usr/lib/systemd/system/tool.service', F,
+                 b'[Service]\nExecStart=/usr/bin/tool\n'),
+            ])
+        os.mkdir(os.path.join(self.tmp, 'bin'))
+        virtualenv = os.path.join(self.tmp, 'bin', 'virtualenv')
+        with open(virtualenv, 'w') as f:
+            f.write(VIRTUALENV)
+        os.chmod(virtualenv, 0o755)
+
+    def _create(self, archive, *options):
+        """Build the venv from scratch, and return the archive."""
+        shutil.rmtree(os.path.join(self.tmp, 'tool-1'), ignore_errors=True)
+        env = dict(os.environ)
+        env['PATH'] = '%s:%s' % (os.path.join(self.tmp, 'bin'), env['PATH'])
+        env.pop('SOURCE_DATE_EPOCH', None)
+        subprocess.check_call(
+            [sys.executable, VENVJAIL, 'create', '-r', 'repo', '-t', 'track',
+             '--archive', archive] + list(options) + ['tool-1'],
+            cwd=self.tmp, env=env, stdout=subprocess.DEVNULL)
+        return os.path.join(self.tmp, archive)
+
+    def test_reproducible(self):
+        first = self._create('first.tar.gz')
+        second = self._create('second.tar.gz')
+        with open(first, 'rb') as f, open(second, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+        with tarfile.open(first) as tar:
+            members = tar.getmembers()
+            self.assertEqual(members[0].name, 'tool-1')
+            names = [member.name for member in members]
+            self.assertEqual(len(names), len(set(names)))
+            self.assertIn('tool-1/packages.log', names)
+            # usr/lib and usr/bin are links to lib and bin
+            self.assertIn('tool-1/lib/systemd/system/venv-tool.service',
+                          names)
+            self.assertNotIn('tool-1/lib/systemd/system/tool.service', names)
+            self.assertNotIn('tool-1/META-INF/build-stats.json', names)
+            for member in members:
+                self.assertEqual((member.uid, member.gid), (0, 0))
+                self.assertLessEqual(member.mtime, benchmark.MTIME)
+            script = tar.extractfile('tool-1/bin/tool').read()
+            self.assertTrue(script.startswith(b'#!/opt/stack/venv/tool-1/'))
+
+    def test_mtime(self):
+        archive = self._create('archive.tar', '--archive-mtime', '1000')
+        with tarfile.open(archive) as tar:
+            self.assertEqual(set(member.mtime for member in tar), {1000})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Tests for the client of the daemon, against a stand-in server that
+# records the requests.
+
+import json
+import os
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import venvjail  # noqa: E402
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.socket_path = os.path.join(self.tmp, 'daemon.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+        self.addCleanup(self.server.close)
+        self.requests = []
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        try:
+            connection, _ = self.server.accept()
+        except OSError:
+            # Closed without a client
+            return
+        with connection:
+            f = connection.makefile('rwb')
+            line = f.readline()
+            if not line:
+                return
+            self.requests.append(json.loads(line.decode('utf-8')))
+            f.write(b'{"out": "created\\n"}\n{"exit": 3}\n')
+            f.flush()
+
+    def test_request(self):
+        environ = {'PATH': '/usr/bin', 'HOME': '/home/user',
+                   'OSC_PASSWORD': 'secret', 'AWS_SECRET_ACCESS_KEY': 'x'}
+        with unittest.mock.patch.dict(os.environ, environ, clear=True), \
+                unittest.mock.patch('sys.stdout') as stdout:
+            code = venvjail._client(self.socket_path, ['create', 'a-1'])
+        self.assertEqual(code, 3)
+        stdout.write.assert_called_with('created\n')
+        request, = self.requests
+        self.assertEqual(request['argv'], ['create', 'a-1'])
+        self.assertEqual(request['cwd'], os.getcwd())
+        self.assertEqual(request['env'], {'PATH': '/usr/bin',
+                                          'HOME': '/home/user'})
+
+    def test_other_user(self):
+        # Both the socket and the daemon belong to other user
+        with unittest.mock.patch('os.getuid',
+                                 return_value=os.getuid() + 1), \
+                unittest.mock.patch('sys.stderr'):
+            code = venvjail._client(self.socket_path, ['create', 'a-1'])
+        self.assertIsNone(code)
+        self.assertEqual(self.requests, [])
+
+    def test_not_running(self):
+        self.assertIsNone(venvjail._client(
+            os.path.join(self.tmp, 'missing.sock'), ['create', 'a-1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
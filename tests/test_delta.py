@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Tests for `delta` and `apply`: the delta of two venvs applied over
+# the old one must reproduce the new one.
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import venvjail  # noqa: E402
+
+MODULE = 'lib/python2.7/site-packages'
+OLD_RPM = 'python-tool-1.0-1.1.noarch.rpm'
+NEW_RPM = 'python-tool-2.0-1.1.noarch.rpm'
+
+
+def _tree(dest_dir):
+    """Return the type, mode and content of every path of a tree."""
+    tree = {}
+    for root, dirs, files in os.walk(dest_dir):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            path = os.path.relpath(full, dest_dir)
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                tree[path] = ('link', os.readlink(full))
+            elif stat.S_ISDIR(st.st_mode):
+                tree[path] = ('dir', stat.S_IMODE(st.st_mode))
+            else:
+                with open(full, 'rb') as f:
+                    tree[path] = ('file', stat.S_IMODE(st.st_mode), f.read())
+    return tree
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.old = self._venv('tool-1', [OLD_RPM], {
+            'bin/tool': (0o755, b'#!/opt/tool-1/bin/python2\nimport a\n'),
+            'bin/python': 'python2',
+            MODULE + '/a.py': (0o644, b'a = 1\n'),
+            MODULE + '/same.py': (0o644, b'same\n'),
+            MODULE + '/resized.py': (0o644, b'short\n'),
+            MODULE + '/mode.py': (0o644, b'mode\n'),
+            MODULE + '/gone/__init__.py': (0o644, b'gone\n'),
+            MODULE + '/gone/sub/x.py': (0o644, b'x\n'),
+        })
+        # Built in other place, so it can be created next to the old one
+        self.new = self._venv('build/tool-2', [NEW_RPM], {
+            'bin/tool': (0o755, b'#!/opt/tool-2/bin/python2\nimport a\n'),
+            'bin/python': 'python3',
+            MODULE + '/a.py': (0o644, b'a = 2\n'),
+            MODULE + '/same.py': (0o644, b'same\n'),
+            MODULE + '/resized.py': (0o644, b'much longer\n'),
+            MODULE + '/mode.py': (0o755, b'mode\n'),
+            MODULE + '/new/__init__.py': (0o644, b'new\n'),
+            MODULE + '/new/linked.py': (0o644, b'linked\n'),
+        })
+        # Hard links in the new venv, like the ones created by %fdupes
+        os.link(os.path.join(self.new, MODULE, 'new', 'linked.py'),
+                os.path.join(self.new, MODULE, 'new', 'linked2.py'))
+
+    def _venv(self, name, rpms, files):
+        dest_dir = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(dest_dir, 'META-INF'))
+        venvjail._write_manifest(dest_dir, [{'rpm': rpm, 'files': [],
+                                             'dirs': []} for rpm in rpms])
+        for path, value in files.items():
+            name = os.path.join(dest_dir, path)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            if isinstance(value, str):
+                os.symlink(value, name)
+                continue
+            mode, data = value
+            with open(name, 'wb') as f:
+                f.write(data)
+            os.chmod(name, mode)
+        return dest_dir
+
+    def _delta(self, output='delta.tar.gz'):
+        output = os.path.join(self.tmp, output)
+        with unittest.mock.patch('sys.stdout'):
+            venvjail.delta(argparse.Namespace(old_dir=self.old,
+                                              new_dir=self.new,
+                                              output=output, jobs=2))
+        return output
+
+    def _apply(self, delta, venv, output=None):
+        with unittest.mock.patch('sys.stdout'):
+            return venvjail.apply(argparse.Namespace(delta=delta, venv=venv,
+                                                     output=output))
+
+    def test_apply(self):
+        expected = _tree(self.new)
+        installed = _tree(self.old)
+        delta = self._delta()
+        self.assertEqual(self._apply(delta, self.old), 0)
+        # The new venv is created next to the installed one, that is
+        # left untouched
+        new = os.path.join(self.tmp, 'tool-2')
+        self.assertEqual(_tree(new), expected)
+        self.assertTrue(os.path.samefile(
+            os.path.join(new, MODULE, 'new', 'linked.py'),
+            os.path.join(new, MODULE, 'new', 'linked2.py')))
+        self.assertEqual(_tree(self.old), installed)
+
+    def test_content(self):
+        with venvjail._decompressed(self._delta('delta.tar')) as tar:
+            meta = json.loads(tar.extractfile(tar.next()).read().decode())
+            names = [member.name for member in tar]
+        self.assertEqual(meta['packages'], {'added': [NEW_RPM],
+                                            'removed': [OLD_RPM]})
+        self.assertEqual(meta['removed'], [
+            MODULE + '/gone', MODULE + '/gone/__init__.py',
+            MODULE + '/gone/sub', MODULE + '/gone/sub/x.py'])
+        # Only the changed and added paths are shipped
+        self.assertNotIn('data/%s/same.py' % MODULE, names)
+        self.assertIn('data/%s/mode.py' % MODULE, names)
+        self.assertIn('data/bin/python', names)
+
+    def test_exchange(self):
+        # Installed in the same place
+        expected = _tree(self.new)
+        installed = os.path.join(self.tmp, 'installed')
+        shutil.copytree(self.old, installed, symlinks=True)
+        self.assertEqual(self._apply(self._delta(), installed, installed), 0)
+        self.assertEqual(_tree(installed), expected)
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['build', 'delta.tar.gz', 'installed', 'tool-1'])
+
+    def test_wrong_base(self):
+        delta = self._delta()
+        with open(os.path.join(self.old, MODULE, 'a.py'), 'wb') as f:
+            f.write(b'a = 3\n')
+        self.assertEqual(self._apply(delta, self.old), 1)
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['build', 'delta.tar.gz', 'tool-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
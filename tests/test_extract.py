@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# Tests for the extraction of the RPMs: the cpio reader, the parallel
+# overlay, the RPM cache and the update of a venv.  The RPMs are built
+# with the writer of the benchmarks, so no rpmbuild is required.
+
+import io
+import os
+import os.path
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import benchmark  # noqa: E402
+import venvjail  # noqa: E402
+
+D, F, X, L = 0o40755, 0o100644, 0o100755, 0o120777
+MODULE = 'usr/lib/python2.7/site-packages'
+
+
+def _cpio(entries):
+    """Build a newc cpio archive from (path, mode, ino, nlink, data)."""
+    archive = []
+    for path, mode, ino, nlink, data in entries + [
+            ('TRAILER!!!', 0, 0, 1, b'')]:
+        name = path.encode('utf-8') + b'\0'
+        fields = (ino, mode, 0, 0, nlink, benchmark.MTIME, len(data), 0, 0,
+                  0, 0, len(name), 0)
+        entry = b'070701' + b''.join(b'%08X' % field for field in fields)
+        entry += name
+        entry += b'\0' * (-len(entry) % 4)
+        archive.append(entry + data + b'\0' * (-len(data) % 4))
+    return io.BytesIO(b''.join(archive))
+
+
+def _tree(dest_dir):
+    """Return the type, mode and content of every path of a tree."""
+    tree = {}
+    for root, dirs, files in os.walk(dest_dir):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            path = os.path.relpath(full, dest_dir)
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                tree[path] = ('link', os.readlink(full))
+            elif stat.S_ISDIR(st.st_mode):
+                tree[path] = ('dir', stat.S_IMODE(st.st_mode))
+            else:
+                with open(full, 'rb') as f:
+                    tree[path] = ('file', stat.S_IMODE(st.st_mode), f.read())
+    return tree
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def path(self, *names):
+        return os.path.join(self.tmp, *names)
+
+
+class TestCpio(TempDirTestCase):
+    def test_target_dot_names(self):
+        dest_dir = self.path('venv')
+        os.mkdir(dest_dir)
+        self.assertEqual(
+            venvjail._cpio_target(dest_dir, './..foo', True, True),
+            ('..foo', os.path.join(dest_dir, '..foo')))
+        self.assertEqual(
+            venvjail._cpio_target(dest_dir, '../foo', True, True),
+            ('../foo', None))
+        self.assertEqual(
+            venvjail._cpio_target(dest_dir, '..', True, True),
+            ('..', None))
+
+    def test_hard_links(self):
+        dest_dir = self.path('venv')
+        os.mkdir(dest_dir)
+        extracted = venvjail._cpio_extract(_cpio([
+            ('./dir', D, 1, 2, b''),
+            ('./dir/a.py', F, 2, 2, b''),
+            ('./dir/b.py', F, 2, 2, b'shared\n'),
+            ('./dir/c.py', F, 3, 1, b'single\n'),
+        ]), dest_dir)
+        self.assertEqual(extracted, {'dir', 'dir/a.py', 'dir/b.py',
+                                     'dir/c.py'})
+        a = os.stat(os.path.join(dest_dir, 'dir', 'a.py'))
+        b = os.stat(os.path.join(dest_dir, 'dir', 'b.py'))
+        self.assertTrue(os.path.samestat(a, b))
+        self.assertEqual(a.st_nlink, 2)
+        with open(os.path.join(dest_dir, 'dir', 'a.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'shared\n')
+
+    def test_hard_links_excluded_data(self):
+        # The data is stored with the last link, that is excluded
+        dest_dir = self.path('venv')
+        os.mkdir(dest_dir)
+        with open(self.path('exclude-path'), 'w') as f:
+            f.write('b\\.py$\n')
+        path_filter = venvjail.PathFilter(self.path('exclude-path'))
+        extracted = venvjail._cpio_extract(_cpio([
+            ('./a.py', F, 2, 2, b''),
+            ('./b.py', F, 2, 2, b'shared\n'),
+        ]), dest_dir, path_filter=path_filter)
+        self.assertEqual(extracted, {'a.py'})
+        self.assertFalse(os.path.lexists(os.path.join(dest_dir, 'b.py')))
+        with open(os.path.join(dest_dir, 'a.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'shared\n')
+        self.assertEqual(path_filter.skipped, {'b\\.py$': (1, 7)})
+
+
+class TestReadOnlyDirectories(TempDirTestCase):
+    # Without root, a directory is only filled if it is writable, so
+    # the modes of the directories are applied at the end
+    def test_extract(self):
+        packages = []
+        for n in range(2):
+            package = self.path('python-r%d-1.0-1.1.noarch.rpm' % n)
+            benchmark.write_rpm(package, 'python-r%d' % n, [
+                ('usr/share/ro', 0o40555, b''),
+                ('usr/share/ro/f%d' % n, F, b'%d\n' % n),
+                ('usr/share/ro/sub', 0o40500, b''),
+                ('usr/share/ro/sub/g%d' % n, F, b'%d\n' % n),
+            ])
+            packages.append(package)
+        rpm_cache = venvjail.RPMCache(self.path('cache'), 0)
+        for name, jobs, cache in (('serial', 1, None), ('parallel', 4, None),
+                                  ('cached', 4, rpm_cache)):
+            dest_dir = self.path(name)
+            os.mkdir(dest_dir)
+            venvjail._extract_packages(packages, dest_dir, jobs, cache)
+            tree = _tree(dest_dir)
+            self.assertEqual(tree['usr/share/ro'], ('dir', 0o555), name)
+            self.assertEqual(tree['usr/share/ro/sub'], ('dir', 0o500), name)
+            self.assertEqual(tree['usr/share/ro/f0'], ('file', 0o644, b'0\n'))
+            self.assertEqual(tree['usr/share/ro/sub/g1'],
+                             ('file', 0o644, b'1\n'))
+            self.assertEqual(os.listdir(dest_dir), ['usr'])
+            venvjail._rmtree(dest_dir)
+            self.assertFalse(os.path.exists(dest_dir))
+        # The entries of the cache can be evicted
+        self.assertEqual(os.listdir(self.path('cache', 'rpms')), [])
+
+
+class TestExtractPackages(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        # RPMs that overwrite the files and links of the previous ones
+        self.repo = self.path('repo')
+        os.mkdir(self.repo)
+        self.packages = []
+        for n in range(6):
+            files = [
+                (MODULE, D, b''),
+                (MODULE + '/shared.py', F, b'from %d\n' % n),
+                (MODULE + '/own%d.py' % n, F, b'%d\n' % n * n),
+                (MODULE + '/link.py', L, b'own%d.py' % n),
+            ]
+            if n % 2:
+                files.append(('usr/bin/tool', X, b'#!/usr/bin/python2\n'))
+            else:
+                files.append(('usr/bin/tool', L, b'tool-%d' % n))
+            package = self.path('repo', 'python-p%d-1.0-1.1.noarch.rpm' % n)
+            benchmark.write_rpm(package, 'python-p%d' % n, files)
+            self.packages.append(package)
+
+    def _extract(self, name, jobs, cache=None):
+        dest_dir = self.path(name)
+        os.mkdir(dest_dir)
+        venvjail._extract_packages(self.packages, dest_dir, jobs, cache)
+        return _tree(dest_dir)
+
+    def test_overlay_order(self):
+        serial = self._extract('serial', 1)
+        self.assertEqual(serial[MODULE + '/shared.py'],
+                         ('file', 0o644, b'from 5\n'))
+        self.assertEqual(serial[MODULE + '/link.py'], ('link', 'own5.py'))
+        self.assertEqual(serial['usr/bin/tool'],
+                         ('file', 0o755, b'#!/usr/bin/python2\n'))
+        self.assertEqual(self._extract('parallel', 4), serial)
+
+    def test_cache(self):
+        serial = self._extract('serial', 1)
+        cache = venvjail.RPMCache(self.path('cache'), 1 << 30)
+        self.assertEqual(self._extract('cold', 4, cache), serial)
+        self.assertEqual(self._extract('warm', 4, cache), serial)
+        self.assertFalse(cache.used)
+
+
+class TestUpdatePackages(TempDirTestCase):
+    def _write_rpm(self, repo, name, files):
+        os.makedirs(self.path(repo), exist_ok=True)
+        package = self.path(repo, '%s-1.0-1.1.noarch.rpm' % name)
+        benchmark.write_rpm(package, name, files)
+        return package
+
+    def _create(self, name, packages):
+        dest_dir = self.path(name)
+        os.makedirs(os.path.join(dest_dir, 'META-INF'))
+        extracted = venvjail._extract_packages(packages, dest_dir)
+        venvjail._write_manifest(dest_dir, [
+            venvjail._manifest_record(package, *extracted[package])
+            for package in packages])
+        return dest_dir
+
+    def test_update(self):
+        kept = [(MODULE, D, b''), (MODULE + '/a.py', F, b'a\n')]
+        old = [
+            self._write_rpm('repo0', 'python-a', kept),
+            self._write_rpm('repo0', 'python-b', [
+                (MODULE + '/b.py', F, b'b0\n'),
+                (MODULE + '/a.py', F, b'overwritten\n')]),
+            self._write_rpm('repo0', 'python-c', [
+                (MODULE + '/c', D, b''),
+                (MODULE + '/c/__init__.py', F, b'c\n')]),
+        ]
+        new = [
+            self._write_rpm('repo1', 'python-a', kept),
+            self._write_rpm('repo1', 'python-b', [
+                (MODULE + '/b.py', F, b'b1\n')]),
+            self._write_rpm('repo1', 'python-d', [
+                (MODULE + '/d.py', F, b'd\n')]),
+        ]
+        dest_dir = self._create('venv', old)
+        # Byte-compiled files of a module that will be removed
+        compiled = [MODULE + '/c/__init__.pyc',
+                    MODULE + '/c/__pycache__/__init__.cpython-36.pyc']
+        for path in compiled:
+            os.makedirs(os.path.dirname(os.path.join(dest_dir, path)),
+                        exist_ok=True)
+            open(os.path.join(dest_dir, path), 'wb').close()
+
+        _, records, paths = venvjail._update_packages(new, dest_dir)
+        self.assertEqual([record['rpm'] for record in records],
+                         [os.path.basename(package) for package in new])
+        self.assertNotIn(MODULE + '/c', paths)
+        venvjail._write_manifest(dest_dir, records)
+
+        full = self._create('full', new)
+        self.assertEqual(_tree(dest_dir), _tree(full))
+        self.assertEqual(_tree(dest_dir)[MODULE + '/a.py'],
+                         ('file', 0o644, b'a\n'))
+
+
+class TestFileList(TempDirTestCase):
+    RULES = [
+        '# comment',
+        'python-six',
+        'python-oslo.*',
+        'python-nova$',
+        'python-.*-doc',
+        'python-(foo|bar)',
+        '(?i)PYTHON-UPPER',
+        'usr/share/man',
+        r'.*\.la$',
+        '',
+        'python-z[0-9]+$',
+    ]
+    NAMES = [
+        'python-six', 'python-sixer', 'python-oslo.config', 'python-oslo',
+        'python-nova', 'python-novaclient', 'python-nova-doc',
+        'python-keystone-doc', 'python-foo', 'python-barbican',
+        'python-upper', 'usr/share/man/man1/x.1', 'usr/lib/libx.la',
+        'usr/lib/libx.lab', 'python-z12', 'python-z12a', 'python-',
+        'other', '',
+    ]
+
+    def test_match(self):
+        filename = self.path('rules')
+        with open(filename, 'w') as f:
+            f.write('\n'.join(self.RULES) + '\n')
+        file_list = venvjail.FileList(filename)
+        rules = [rule for rule in self.RULES
+                 if rule and not rule.startswith('#')]
+        self.assertEqual(file_list.rules, rules)
+        for name in self.NAMES:
+            # The first rule that match with `re.match`
+            expected = next((rule for rule in rules
+                             if re.match(rule, name)), None)
+            self.assertEqual(file_list.match(name), expected, name)
+            self.assertEqual(name in file_list, expected is not None, name)
+
+    def test_missing_file(self):
+        file_list = venvjail.FileList(self.path('missing'))
+        self.assertFalse(file_list.is_populated())
+        self.assertIsNone(file_list.match('python-six'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Tests for the fixups applied to the extracted venv: the relocation of
+# the shebangs, the activators and the systemd services.
+
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import venvjail  # noqa: E402
+
+SHEBANG = b'#!/opt/stack/venv/tool-1/bin/python2'
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def path(self, *names):
+        return os.path.join(self.tmp, *names)
+
+    def write(self, name, data, mode=0o755):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        os.chmod(self.path(name), mode)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+
+class TestRelocateShebang(TempDirTestCase):
+    def test_sizes(self):
+        body = b'\nimport tool\n' + b'x' * (1 << 17)
+        for line in (b'#!/usr/bin/python2', b'#!/usr/bin/env python',
+                     b'#!' + b'/' * (len(SHEBANG) - 2) + b'python',
+                     b'#!/' + b'x' * 300 + b'/python'):
+            name = self.write('tool', line + body)
+            self.assertTrue(venvjail._relocate_shebang(name, SHEBANG))
+            self.assertEqual(self.read('tool'), SHEBANG + body)
+            self.assertEqual(stat.S_IMODE(os.stat(name).st_mode), 0o755)
+            # Already relocated
+            self.assertFalse(venvjail._relocate_shebang(name, SHEBANG))
+
+    def test_not_python(self):
+        for data in (b'#!/bin/sh\nexit 0\n', b'\x7fELF\x02\x01\x01',
+                     b'import python\n', b''):
+            name = self.write('tool', data)
+            self.assertFalse(venvjail._relocate_shebang(name, SHEBANG))
+            self.assertEqual(self.read('tool'), data)
+
+    def test_hard_links(self):
+        name = self.write('tool', b'#!/usr/bin/python2\nimport tool\n')
+        os.link(name, self.path('tool-2'))
+        self.assertTrue(venvjail._relocate_shebang(name, SHEBANG))
+        self.assertTrue(os.path.samefile(name, self.path('tool-2')))
+        self.assertEqual(self.read('tool-2'), SHEBANG + b'\nimport tool\n')
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['tool', 'tool-2'])
+
+
+class TestFixVirtualenv(TempDirTestCase):
+    def test_activators(self):
+        os.mkdir(self.path('bin'))
+        self.write('bin/activate', b'VIRTUAL_ENV="/build/tool-1"\n'
+                   b'deactivate nondestructive\n', 0o644)
+        self.write('bin/activate.csh', b'setenv VIRTUAL_ENV "/build"\n'
+                   b'deactivate nondestructive\n', 0o644)
+        self.write('bin/activate.fish', b'set -gx VIRTUAL_ENV "/build"\n'
+                   b'deactivate nondestructive\n', 0o644)
+        venv = '/opt/stack/venv/tool-1'
+        self.assertEqual(venvjail._fix_activators(self.tmp, venv), 3)
+        self.assertEqual(self.read('bin/activate'), (
+            'VIRTUAL_ENV="%s"\ndeactivate nondestructive\n'
+            'export LD_LIBRARY_PATH="%s/lib"\n' % (venv, venv)).encode())
+        self.assertEqual(self.read('bin/activate.fish'), (
+            'set -gx VIRTUAL_ENV "%s"\ndeactivate nondestructive\n'
+            'set -gx LD_LIBRARY_PATH "%s/lib"\n' % (venv, venv)).encode())
+
+    def test_systemd_services(self):
+        os.makedirs(self.path('usr/lib/systemd/system'))
+        self.write('usr/lib/systemd/system/tool.service',
+                   b'[Service]\nExecStartPre=-/usr/bin/tool-init\n'
+                   b'ExecStart=/usr/bin/tool\n', 0o444)
+        venv = '/opt/stack/venv/tool-1'
+        self.assertEqual(venvjail._fix_systemd_services(self.tmp, venv), 1)
+        self.assertEqual(os.listdir(self.path('usr/lib/systemd/system')),
+                         ['venv-tool.service'])
+        name = 'usr/lib/systemd/system/venv-tool.service'
+        self.assertEqual(self.read(name), (
+            '[Service]\nExecStartPre=-%s/usr/bin/tool-init\n'
+            'ExecStart=%s/usr/bin/tool\n' % (venv, venv)).encode())
+        self.assertEqual(stat.S_IMODE(os.stat(self.path(name)).st_mode),
+                         0o444)
+
+
+if __name__ == '__main__':
+    unittest.main()
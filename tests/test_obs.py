@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Tests for the access to the OBS API: the native client and the
+# on-disk response cache, against a local stand-in HTTP server.
+
+import http.server
+import io
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import venvjail  # noqa: E402
+
+REPOSITORY = b'''<binarylist>
+  <binary filename="python-six.rpm"/>
+  <binary filename="_buildenv"/>
+  <binary filename="python-six.src.rpm"/>
+  <binary filename="rpmlint.log"/>
+  <binary filename="python-nova.rpm"/>
+</binarylist>
+'''
+
+
+class OBSHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the responses of `server.responses`, with an ETag."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers),
+                                self.client_address))
+        if self.headers.get('Authorization') != server.auth:
+            self._send(401, b'')
+            return
+        if self.path not in server.responses:
+            self._send(404, b'not found')
+            return
+        body = server.responses[self.path]
+        etag = '"%d"' % hash(body)
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, None, etag)
+        else:
+            self._send(200, body, etag)
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified',
+                             'Mon, 01 Jan 2018 00:00:00 GMT')
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OBSTestCase(unittest.TestCase):
+    API = '/build/Cloud/SLE_12_SP3/x86_64/_repository'
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      OBSHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.responses = {self.API: REPOSITORY}
+        self.server.auth = venvjail.OBSClient('http://x', 'user',
+                                              'secret').auth
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.apiurl = 'http://127.0.0.1:%d' % self.server.server_port
+        self.client = venvjail.OBSClient(self.apiurl, 'user', 'secret')
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def get(self, cache):
+        with cache.get(self.apiurl, self.API, self.client) as response:
+            return response.read()
+
+
+class TestOBSClient(OBSTestCase):
+    def test_keep_alive(self):
+        for _ in range(3):
+            status, response, _ = self.client(self.apiurl, self.API)
+            self.assertEqual(status, 200)
+            self.assertEqual(response.read(), REPOSITORY)
+        self.assertEqual(len(set(address for _, _, address
+                                 in self.server.requests)), 1)
+
+    def test_error(self):
+        with self.assertRaises(IOError):
+            self.client(self.apiurl, '/missing')
+
+    def test_filter(self):
+        _, response, _ = self.client(self.apiurl, self.API)
+        self.assertEqual(venvjail._filter_binary_xml(response),
+                         ['python-six.rpm', 'python-nova.rpm'])
+
+
+class TestAPICache(OBSTestCase):
+    def test_ttl(self):
+        cache = venvjail.APICache(self.tmp, ttl=3600)
+        self.assertEqual(self.get(cache), REPOSITORY)
+        self.assertEqual(self.get(cache), REPOSITORY)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_revalidate(self):
+        cache = venvjail.APICache(self.tmp, ttl=0)
+        self.assertEqual(self.get(cache), REPOSITORY)
+        self.assertEqual(self.get(cache), REPOSITORY)
+        self.assertEqual(len(self.server.requests), 2)
+        _, headers, _ = self.server.requests[1]
+        self.assertIn('If-None-Match', headers)
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Mon, 01 Jan 2018 00:00:00 GMT')
+
+        # A changed response is stored again
+        self.server.responses[self.API] = b'<binarylist/>\n'
+        self.assertEqual(self.get(cache), b'<binarylist/>\n')
+        self.assertEqual(self.get(venvjail.APICache(self.tmp, ttl=3600)),
+                         b'<binarylist/>\n')
+
+    def test_offline(self):
+        cache = venvjail.APICache(self.tmp, ttl=0, offline=True)
+        with self.assertRaises(LookupError):
+            self.get(cache)
+        self.get(venvjail.APICache(self.tmp))
+        self.server.responses.clear()
+        self.assertEqual(self.get(cache), REPOSITORY)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_interrupted(self):
+        class Response(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell():
+                    raise IOError('connection reset')
+                return super().read(4)
+
+        def fetch(apiurl, api, headers):
+            return 200, Response(REPOSITORY), {}
+
+        cache = venvjail.APICache(self.tmp, ttl=0)
+        with self.assertRaises(IOError):
+            cache.get(self.apiurl, self.API, fetch)
+        # Nothing is stored, not even the temporary file
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Tests for `plan`, computed from the RPM headers alone.
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import benchmark  # noqa: E402
+import venvjail  # noqa: E402
+
+D, F, X, L = 0o40755, 0o100644, 0o100755, 0o120777
+MODULE = 'usr/lib/python2.7/site-packages'
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.repo = os.path.join(self.tmp, 'repo')
+        os.mkdir(self.repo)
+        self._write_rpm('python-a', [
+            (MODULE + '/a.py', F, b'a\n'),
+            (MODULE + '/doc/a.txt', F, b'a\n'),
+            ('usr/bin/a', X, b'#!/usr/bin/python2\nimport a\n'),
+            ('usr/bin/a-sh', X, b'#!/bin/sh\nexit 0\n'),
+            ('usr/bin/keep', X, b'#!/usr/bin/python2\nimport a\n'),
+        ], ['python-b'])
+        self._write_rpm('python-b', [
+            (MODULE + '/b.py', F, b'b\n'),
+            (MODULE + '/doc/a.txt', F, b'b\n'),
+        ], ['/usr/bin/c'])
+        self._write_rpm('python-c', [
+            ('usr/bin/c', X, b'#!/usr/bin/env python\n'),
+        ])
+        self._write_rpm('python-d', [
+            (MODULE + '/d.py', F, b'd\n'),
+        ])
+
+    def _write_rpm(self, name, files, requires=()):
+        benchmark.write_rpm(
+            os.path.join(self.repo, '%s-1.0-1.1.noarch.rpm' % name),
+            name, files, requires)
+
+    def _plan(self, exclude_path='', root=None, no_relocate=()):
+        filename = os.path.join(self.tmp, 'exclude-path')
+        with open(filename, 'w') as f:
+            f.write(exclude_path)
+        args = argparse.Namespace(
+            repo=self.repo, include=os.path.join(self.tmp, 'include-rpm'),
+            exclude=os.path.join(self.tmp, 'exclude-rpm'),
+            exclude_path=filename, jobs=2, index=None, match_name=False,
+            root=root, dest_dir='a-1',
+            no_relocate_shebang_list=list(no_relocate))
+        return venvjail._plan(args)
+
+    def test_scripts(self):
+        plan = self._plan(no_relocate=['a-1/bin/keep'])
+        self.assertEqual(plan['scripts'], ['usr/bin/a', 'usr/bin/c'])
+        self.assertEqual(plan['files'], 8)
+
+    def test_conflicts(self):
+        plan = self._plan()
+        self.assertEqual(plan['conflicts'], [{
+            'path': MODULE + '/doc/a.txt',
+            'rpms': ['python-a-1.0-1.1.noarch.rpm',
+                     'python-b-1.0-1.1.noarch.rpm'],
+        }])
+        plan = self._plan(exclude_path='%s/doc/\n' % MODULE)
+        self.assertEqual(plan['conflicts'], [])
+        self.assertEqual(plan['skipped'], {
+            '%s/doc/' % MODULE: {'files': 2, 'size': 4}})
+
+    def test_root(self):
+        plan = self._plan(root=['python-a'])
+        self.assertEqual(plan['included'], {
+            'python-a-1.0-1.1.noarch.rpm': 'include list is empty, root',
+            'python-b-1.0-1.1.noarch.rpm': 'include list is empty, '
+                'requires python-b from python-a-1.0-1.1.noarch.rpm',
+            'python-c-1.0-1.1.noarch.rpm': 'include list is empty, '
+                'requires /usr/bin/c from python-b-1.0-1.1.noarch.rpm',
+        })
+        self.assertEqual(plan['unresolved'], {})
+
+    def test_python_script_class(self):
+        self.assertTrue(venvjail._is_python_script(
+            'a /usr/bin/python2 script, ASCII text executable'))
+        self.assertTrue(venvjail._is_python_script(
+            'a /usr/bin/env python3 script, ASCII text executable'))
+        self.assertFalse(venvjail._is_python_script(
+            'Python script, ASCII text executable'))
+        self.assertFalse(venvjail._is_python_script(
+            'a /bin/sh script, ASCII text executable'))
+
+
+if __name__ == '__main__':
+    unittest.main()
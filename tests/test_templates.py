@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Tests for the virtualenv templates, with stand-in `virtualenv` and
+# `python2.7` commands that count the calls.
+
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import venvjail  # noqa: E402
+
+VIRTUALENV = r'''#!/bin/sh
+[ "$1" = "--version" ] && { echo 15.1.0; exit 0; }
+echo "$@" >> "$(dirname "$0")/calls"
+for last; do true; done
+mkdir -p "$last/bin" "$last/lib/python2.7/site-packages"
+venv=$(cd "$last" && pwd)
+printf 'VIRTUAL_ENV="%s"\n' "$venv" > "$venv/bin/activate"
+printf '#!%s/bin/python\nimport pip\n' "$venv" > "$venv/bin/pip"
+chmod 755 "$venv/bin/pip"
+printf 'import os\n' > "$venv/lib/python2.7/site-packages/site.py"
+ln -s "$venv/lib/python2.7/site-packages/site.py" "$venv/lib/site.py"
+ln -s /usr/bin/python2.7 "$venv/bin/python"
+'''
+
+PYTHON = '''#!/bin/sh
+echo Python 2.7.18
+'''
+
+
+class TestVirtualenvTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.bin = os.path.join(self.tmp, 'bin')
+        os.mkdir(self.bin)
+        for name, data in (('virtualenv', VIRTUALENV), ('python2.7', PYTHON)):
+            with open(os.path.join(self.bin, name), 'w') as f:
+                f.write(data)
+            os.chmod(os.path.join(self.bin, name), 0o755)
+        environ = {'PATH': '%s:%s' % (self.bin, os.environ['PATH'])}
+        patcher = unittest.mock.patch.dict(os.environ, environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _calls(self):
+        try:
+            with open(os.path.join(self.bin, 'calls')) as f:
+                return f.read().splitlines()
+        except IOError:
+            return []
+
+    def _tree(self, dest_dir):
+        """Return the tree, with `dest_dir` replaced by VENV."""
+        tree = {}
+        venv = dest_dir.encode('utf-8')
+        for root, dirs, files in os.walk(dest_dir):
+            for name in dirs + files:
+                full = os.path.join(root, name)
+                path = os.path.relpath(full, dest_dir)
+                st = os.lstat(full)
+                if stat.S_ISLNK(st.st_mode):
+                    tree[path] = os.readlink(full).replace(dest_dir, 'VENV')
+                elif stat.S_ISDIR(st.st_mode):
+                    tree[path] = stat.S_IMODE(st.st_mode)
+                else:
+                    with open(full, 'rb') as f:
+                        tree[path] = (stat.S_IMODE(st.st_mode),
+                                      f.read().replace(venv, b'VENV'))
+        return tree
+
+    def test_clone(self):
+        options = ['--python=python2.7']
+        direct = os.path.join(self.tmp, 'direct-1')
+        venvjail._run_virtualenv(options, direct)
+        venvjail._add_usr_links(direct)
+
+        templates = venvjail.VirtualenvTemplates(os.path.join(self.tmp,
+                                                              'cache'))
+        for name in ('a-1', 'b-1'):
+            dest_dir = os.path.join(self.tmp, name)
+            self.assertTrue(templates.clone(options, dest_dir))
+            self.assertEqual(self._tree(dest_dir), self._tree(direct))
+        # The template is created once, for the first clone
+        self.assertEqual(len(self._calls()), 2)
+
+        # The files modified by the fixups are copies
+        a, b = (os.path.join(self.tmp, name) for name in ('a-1', 'b-1'))
+        for path, shared in (('lib/python2.7/site-packages/site.py', True),
+                             ('bin/pip', False), ('bin/activate', False)):
+            self.assertEqual(os.path.samefile(os.path.join(a, path),
+                                              os.path.join(b, path)),
+                             shared, path)
+
+        # Other options are other template
+        self.assertTrue(templates.clone(options + ['--system-site-packages'],
+                                        os.path.join(self.tmp, 'c-1')))
+        self.assertEqual(len(self._calls()), 3)
+
+    def test_without_python(self):
+        os.unlink(os.path.join(self.bin, 'python2.7'))
+        with unittest.mock.patch.dict(os.environ, {'PATH': self.bin}):
+            templates = venvjail.VirtualenvTemplates(self.tmp)
+            self.assertFalse(templates.clone([], os.path.join(self.tmp,
+                                                              'a-1')))
+        self.assertEqual(self._calls(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
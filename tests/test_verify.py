@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Tests for `verify`, on a venv extracted and fixed like `create` does.
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import benchmark  # noqa: E402
+import venvjail  # noqa: E402
+
+D, F, X, L = 0o40755, 0o100644, 0o100755, 0o120777
+MODULE = 'usr/lib/python2.7/site-packages'
+SCRIPT = 'usr/bin/tool'
+SERVICE = 'usr/lib/systemd/system/tool.service'
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='venvjail-test-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp)
+        os.mkdir('repo')
+        package = os.path.join('repo', 'python-tool-1.0-1.1.noarch.rpm')
+        benchmark.write_rpm(package, 'python-tool', [
+            (MODULE + '/tool.py', F, b'print(1)\n'),
+            (MODULE + '/tool.pyc', F, b'\x03\xf3\r\n'),
+            (SCRIPT, X, b'#!/usr/bin/python2\nimport tool\n'),
+            (SERVICE, F, b'[Service]\nExecStart=/usr/bin/tool\n'),
+        ])
+
+        # Extract and fix the venv like `create`
+        os.makedirs(os.path.join('tool-1', 'META-INF'))
+        extracted = venvjail._extract_packages([package], 'tool-1')
+        records = [venvjail._manifest_record(package, *extracted[package])]
+        virtual_env = os.path.join('/opt/stack/venv', 'tool-1')
+        venvjail._fix_relocation('tool-1', virtual_env, [])
+        venvjail._fix_systemd_services('tool-1', virtual_env)
+        venvjail._record_fixed('tool-1', records,
+                               {package: extracted[package][0]})
+        venvjail._write_manifest('tool-1', records)
+
+    def _verify(self, dest_dir='tool-1'):
+        args = argparse.Namespace(dest_dir=dest_dir,
+                                  relocate='/opt/stack/venv',
+                                  repo=os.path.join(self.tmp, 'repo'),
+                                  index=None, jobs=2)
+        return venvjail._verify(args)
+
+    def test_fixed(self):
+        with open(os.path.join('tool-1', SCRIPT), 'rb') as f:
+            self.assertEqual(f.readline(),
+                             b'#!/opt/stack/venv/tool-1/bin/python2\n')
+        self.assertEqual(self._verify(), (4, {}))
+        # From other directory, with other spelling of the venv
+        os.chdir('/')
+        self.assertEqual(self._verify(os.path.join(self.tmp, 'tool-1')),
+                         (4, {}))
+
+    def _drift(self):
+        _, drift = self._verify()
+        return drift.get('python-tool-1.0-1.1.noarch.rpm')
+
+    def test_script_body(self):
+        with open(os.path.join('tool-1', SCRIPT), 'ab') as f:
+            f.write(b'import os\n')
+        self.assertEqual(self._drift(), [(SCRIPT, 'size changed')])
+
+    def test_script_same_size(self):
+        name = os.path.join('tool-1', SCRIPT)
+        with open(name, 'rb') as f:
+            data = f.read()
+        with open(name, 'wb') as f:
+            f.write(data.replace(b'import tool', b'import evil'))
+        self.assertEqual(self._drift(), [(SCRIPT, 'size changed')])
+
+    def test_renamed_service(self):
+        name = os.path.join('tool-1', 'usr/lib/systemd/system',
+                            'venv-tool.service')
+        os.chmod(name, 0o644)
+        with open(name, 'a') as f:
+            f.write('User=root\n')
+        os.chmod(name, 0o444)
+        self.assertEqual(self._drift(), [(SERVICE, 'renamed file changed')])
+
+    def test_pyc(self):
+        with open(os.path.join('tool-1', MODULE, 'tool.pyc'), 'wb') as f:
+            f.write(b'\x03\xf3\r\x0a')
+        self.assertEqual(self._verify(), (4, {}))
+        with open(os.path.join('tool-1', MODULE, 'tool.pyc'), 'wb') as f:
+            f.write(b'\x03\xf3\r\n\x00')
+        self.assertEqual(self._drift(),
+                         [(MODULE + '/tool.pyc', 'size changed')])
+
+    def test_missing(self):
+        os.unlink(os.path.join('tool-1', MODULE, 'tool.py'))
+        self.assertEqual(self._drift(), [(MODULE + '/tool.py', 'missing')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,15 +18,50 @@
 # and Python RPMs.  Used to jail OpenStack services.
 
 import argparse
+import base64
+import bz2
+import collections
+import contextlib
+import cProfile
+import concurrent.futures
+import configparser
+import ctypes
+import fcntl
 import fnmatch
 import glob
+import gzip
+import hashlib
+import http.client
+import io
 import itertools
+import json
+import lzma
 import os
 import os.path
 import re
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
 import xml.etree.ElementTree as ET
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # Sane default for exclude-rpm file
 EXCLUDE_RPM = r"""# List of packages to ignore (use Python regex)
@@ -70,26 +105,110 @@ LICENSE = """# Copyright (c) 2018 SUSE LINUX GmbH, Nuernberg, Germany.
 
 
 class FileList():
-    """File list with comments and regular expressions."""
+    """File list with comments and regular expressions.
+
+    The rules are indexed when the file is loaded.  Plain names (like
+    `name` or `name.*`, that match as a prefix) and exact names (like
+    `name$`) are found with a hash lookup, and the rest of the regular
+    expressions are combined into a single one.
+    """
+    # Characters that make a rule a real regular expression
+    SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
     def __init__(self, filename):
         try:
-            self.items = [
-                re.compile(line.strip()) for line in open(filename)
+            self.rules = [
+                line.strip() for line in open(filename)
                 if line.strip() and not line.strip().startswith('#')
             ]
         except IOError:
-            self.items = []
+            self.rules = []
+        self.items = [re.compile(rule) for rule in self.rules]
+        self._compile()
+
+    def _is_plain(self, rule):
+        return not self.SPECIAL.intersection(rule)
+
+    def _compile(self):
+        """Build the indexes used to match the rules."""
+        self._prefixes = {}
+        self._exact = {}
+        regexs = []
+        self._others = []
+        for index, (rule, item) in enumerate(zip(self.rules, self.items)):
+            if rule.endswith('.*') and self._is_plain(rule[:-2]):
+                self._prefixes.setdefault(rule[:-2], index)
+            elif self._is_plain(rule):
+                self._prefixes.setdefault(rule, index)
+            elif rule.endswith('$') and self._is_plain(rule[:-1]):
+                self._exact.setdefault(rule[:-1], index)
+            elif item.groups or rule.startswith('(?'):
+                # Groups and global flags cannot be safely combined
+                self._others.append((index, item))
+            else:
+                regexs.append('(?P<r%d>%s)' % (index, rule))
+        self._lengths = sorted(set(len(prefix) for prefix in self._prefixes))
+        # The alternation is tried in order, so the first rule that
+        # match is the one reported by `lastgroup`
+        self._regex = re.compile('|'.join(regexs)) if regexs else None
 
     def is_populated(self):
         return self.items
 
+    def match(self, item):
+        """Return the first rule that match the item, or None."""
+        found = []
+        if item in self._exact:
+            found.append(self._exact[item])
+        for length in self._lengths:
+            if length > len(item):
+                break
+            index = self._prefixes.get(item[:length])
+            if index is not None:
+                found.append(index)
+        if self._regex:
+            match = self._regex.match(item)
+            if match:
+                found.append(int(match.lastgroup[1:]))
+        for index, item_re in self._others:
+            if item_re.match(item):
+                found.append(index)
+                break
+        return self.rules[min(found)] if found else None
+
     def contains(self, item):
-        return any(i.match(item) for i in self.items)
+        return self.match(item) is not None
 
     def __contains__(self, item):
         return self.contains(item)
 
 
+class PathFilter():
+    """Paths of the RPMs that are not installed in the venv.
+
+    The rules are a FileList matched against the paths (relative to
+    the venv, like `usr/share/man`).  The files and bytes skipped by
+    every rule are counted, and can be shared by the extraction
+    threads.
+    """
+    def __init__(self, filename):
+        self.rules = _file_list(filename)
+        self.skipped = {}
+        self._lock = threading.Lock()
+
+    def excluded(self, path, size=0):
+        """Check if a path is excluded, and count it."""
+        if not self.rules.is_populated():
+            return False
+        rule = self.rules.match(path)
+        if rule is None:
+            return False
+        with self._lock:
+            files, total = self.skipped.get(rule, (0, 0))
+            self.skipped[rule] = (files + 1, total + size)
+        return True
+
+
 def _replace(filename, original, line):
     """Replace a line in a file using regular expressions."""
     lines = re.sub(original, line, open(filename).read())
@@ -108,17 +227,67 @@ def _insert(filename, after, line):
     open(filename, 'w').writelines(lines)
 
 
-def _fix_virtualenv(dest_dir, relocated, no_relocate_shebang):
-    """Fix virtualenv activators."""
+def _fix_virtualenv(dest_dir, relocated, no_relocate_shebang, paths=None,
+                    stats=None, byte_compile=False, archive=None):
+    """Fix virtualenv activators.
+
+    When updating a venv, `paths` are the paths (relative to
+    `dest_dir`) of the updated files.  Only those are fixed, and the
+    activators are left untouched.  Every fix is measured as a phase
+    in `stats`.  If `byte_compile` is True, the Python sources are
+    compiled after the relocation.  If the `archive` is provided, the
+    entries are written into it as soon as they are fixed.
+    """
+    stats = stats or BuildStats()
     # New path where the venv will live at the end
     virtual_env = os.path.join(relocated, dest_dir)
 
-    _fix_filesystem(dest_dir)
-    _fix_alternatives(dest_dir, relocated)
-    _fix_broken_links(dest_dir, directories=['srv'])
-    _fix_relocation(dest_dir, virtual_env, no_relocate_shebang)
-    _fix_activators(dest_dir, virtual_env)
-    _fix_systemd_services(dest_dir, virtual_env)
+    with stats.phase('fix_filesystem') as phase:
+        phase['files'] = _fix_filesystem(dest_dir)
+    # The alternatives, broken links and relocation fixes are done in
+    # a single traversal of the venv
+    with stats.phase('fix_tree') as phase:
+        fixups = [
+            AlternativesFixup(relocated),
+            BrokenLinksFixup(dest_dir, directories=['srv']),
+            RelocationFixup(virtual_env, no_relocate_shebang),
+        ]
+        if archive is not None:
+            fixups.append(ArchiveFixup(archive, byte_compile))
+        touched = _fix_tree(dest_dir, fixups, paths)
+        touched.pop('ArchiveFixup', None)
+        phase['files'] = sum(touched.values())
+        phase['fixups'] = touched
+    if paths is None:
+        with stats.phase('fix_activators') as phase:
+            phase['files'] = _fix_activators(dest_dir, virtual_env)
+        services = None
+    else:
+        services = [os.path.join(dest_dir, path) for path in paths
+                    if fnmatch.fnmatch(path, SERVICES)]
+    with stats.phase('fix_systemd_services') as phase:
+        phase['files'] = _fix_systemd_services(dest_dir, virtual_env,
+                                               services)
+    if byte_compile:
+        with stats.phase('byte_compile') as phase:
+            phase['files'] = _byte_compile(dest_dir, virtual_env,
+                                           no_relocate_shebang, paths,
+                                           archive=archive)
+
+
+def _fixed_files(stats):
+    """Return the name and files fixed of every fix recorded in `stats`.
+
+    The fixups of the single traversal are reported one by one.
+    """
+    fixed = []
+    for phase in stats.phases:
+        if phase['name'] == 'fix_tree':
+            fixed.extend(sorted(phase['fixups'].items()))
+        elif (phase['name'].startswith('fix_')
+              or phase['name'] == 'byte_compile'):
+            fixed.append((phase['name'], phase['files']))
+    return fixed
 
 
 def _fix_filesystem(dest_dir):
@@ -158,73 +327,286 @@ def _fix_filesystem(dest_dir):
         'usr/share/keystone': 0o755,
     })
 
+    fixed = 0
     for dir_, mod_ in dirs.items():
         dir_ = os.path.join(dest_dir, dir_)
         if os.path.isdir(dir_):
             os.chmod(dir_, mod_)
+            fixed += 1
+    return fixed
 
 
-def _fix_alternatives(dest_dir, relocated):
+class Entry():
+    """Entry of the venv tree, with the metadata cached."""
+    def __init__(self, path, dir_entry=None):
+        self.name = os.path.basename(path)
+        self.path = path
+        self.dirpath = os.path.dirname(path)
+        self._dir_entry = dir_entry
+        self._link = None
+
+    def refresh(self):
+        """Forget the cached metadata after a modification."""
+        self._dir_entry = None
+        self._link = None
+
+    def is_link(self):
+        if self._dir_entry:
+            return self._dir_entry.is_symlink()
+        return os.path.islink(self.path)
+
+    def is_dir(self):
+        """Return True for directories, or links to directories."""
+        if self._dir_entry:
+            return self._dir_entry.is_dir()
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        """Return True for regular files (not links)."""
+        if self._dir_entry:
+            return self._dir_entry.is_file(follow_symlinks=False)
+        return os.path.isfile(self.path) and not os.path.islink(self.path)
+
+    def stat(self):
+        if self._dir_entry:
+            return self._dir_entry.stat(follow_symlinks=False)
+        return os.lstat(self.path)
+
+    @property
+    def link(self):
+        """Target of the link (read only once)."""
+        if self._link is None:
+            self._link = os.readlink(self.path)
+        return self._link
+
+
+def _scan(path):
+    """Walk a directory tree in order, yielding an Entry for each path.
+
+    Links to directories are not followed, like in `os.walk()`.
+    """
+    try:
+        dir_entries = sorted(os.scandir(path), key=lambda e: e.name)
+    except OSError:
+        return
+    for dir_entry in dir_entries:
+        yield Entry(dir_entry.path, dir_entry)
+        if dir_entry.is_dir(follow_symlinks=False):
+            yield from _scan(dir_entry.path)
+
+
+class Fixup():
+    """Fix applied to the entries of the venv during a traversal."""
+    def __init__(self):
+        self.touched = 0
+
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    def visit(self, entry):
+        """Fix the entry, and return True if it was modified."""
+        raise NotImplementedError()
+
+
+class AlternativesFixup(Fixup):
     """Fix alternative links."""
-    # os.scandir() was implemented in 3.5, but for now we are in 3.4
-    for dirpath, dirnames, filenames in os.walk(dest_dir):
-        for name in filenames:
-            rel_name = os.path.join(dirpath, name)
-            if (os.path.islink(rel_name)
-               and 'alternatives' in os.readlink(rel_name)):
-                # We assume that the Python 2.7 alternative is living
-                # in the same directory, but we create the link the
-                # the place were it will live at the end
-                alt_name = os.path.join(relocated, dirpath, name + '-2.7')
-                alt_rel_name = rel_name + '-2.7'
-                if os.path.exists(alt_rel_name):
-                    os.unlink(rel_name)
-                    os.symlink(alt_name, rel_name)
-                else:
-                    print('ERROR: alternative link for %s not found' % name)
+    def __init__(self, relocated):
+        super().__init__()
+        self.relocated = relocated
 
+    def visit(self, entry):
+        if (not entry.is_link() or entry.is_dir()
+           or 'alternatives' not in entry.link):
+            return False
+        # We assume that the Python 2.7 alternative is living in the
+        # same directory, but we create the link the the place were
+        # it will live at the end
+        alt_name = os.path.join(self.relocated, entry.dirpath,
+                                entry.name + '-2.7')
+        alt_rel_name = entry.path + '-2.7'
+        if not os.path.exists(alt_rel_name):
+            print('ERROR: alternative link for %s not found' % entry.name)
+            return False
+        os.unlink(entry.path)
+        os.symlink(alt_name, entry.path)
+        return True
 
-def _fix_broken_links(dest_dir, directories=None):
+
+class BrokenLinksFixup(Fixup):
     """Fix broken links."""
     # Some packages create absolute soft-links.  We can use some
     # heuristics to detect them, and if is possible, fix them.
-    for fix_dir in directories:
-        fix_dir = os.path.join(dest_dir, fix_dir)
-        for dirpath, dirnames, filenames in os.walk(fix_dir):
-            for name in itertools.chain(dirnames, filenames):
-                rel_name = os.path.join(dirpath, name)
-                if (os.path.islink(rel_name)
-                    and os.readlink(rel_name).startswith('/')):
-                    link_to = os.path.join(dest_dir,
-                                           os.readlink(rel_name)[1:])
-                    if os.path.exists(link_to):
-                        # Convert the absolute link into a relative
-                        # link, also takes care of removing the
-                        # initial '/' from the path
-                        rel_link = os.path.relpath(
-                            link_to, os.path.dirname(rel_name))
-                        os.unlink(rel_name)
-                        os.symlink(rel_link, rel_name)
-                    else:
-                        print('ERROR: alternative link for %s not found' % name)
+    def __init__(self, dest_dir, directories):
+        super().__init__()
+        self.dest_dir = dest_dir
+        self.prefixes = tuple(os.path.join(dest_dir, fix_dir, '')
+                              for fix_dir in directories)
+
+    def visit(self, entry):
+        if (not entry.path.startswith(self.prefixes)
+           or not entry.is_link() or not entry.link.startswith('/')):
+            return False
+        link_to = os.path.join(self.dest_dir, entry.link[1:])
+        if not os.path.exists(link_to):
+            print('ERROR: alternative link for %s not found' % entry.name)
+            return False
+        # Convert the absolute link into a relative link, also takes
+        # care of removing the initial '/' from the path
+        rel_link = os.path.relpath(link_to, entry.dirpath)
+        os.unlink(entry.path)
+        os.symlink(rel_link, entry.path)
+        return True
+
+
+class RelocationFixup(Fixup):
+    """Fix relocation shebang from python scripts."""
+    def __init__(self, virtual_env, no_relocate_shebang):
+        super().__init__()
+        self.shebang = os.fsencode(
+            '#!' + os.path.join(virtual_env, 'bin', 'python2'))
+        self.no_relocate_shebang = no_relocate_shebang
+
+    def visit(self, entry):
+        if not entry.is_file():
+            return False
+        if any(fnmatch.fnmatch(entry.path, path)
+               for path in self.no_relocate_shebang):
+            return False
+        try:
+            return _relocate_shebang(entry.path, self.shebang)
+        except OSError:
+            return False
+
+
+class ArchiveFixup(Fixup):
+    """Write the entries of the venv into the archive, once fixed.
+
+    The entries that the build changes after the traversal are left
+    pending, and are written when the archive is closed.
+    """
+    def __init__(self, archive, byte_compile=False):
+        super().__init__()
+        self.archive = archive
+        self.late = _late_paths(archive.dest_dir, byte_compile)
+
+    def visit(self, entry):
+        if any(fnmatch.fnmatch(entry.path, path) for path in self.late):
+            self.archive.pending.add(entry.path)
+        else:
+            self.archive.add(entry.path)
+        return False
+
+
+# Bytes read from a file to decide if it is a script
+SHEBANG_PREFIX_SIZE = 256
+
+
+def _relocate_shebang(filename, shebang):
+    """Replace the python shebang of a script.
+
+    Only a small prefix of the file is read, so binary files (ELF,
+    .pyc, archives, ...) are discarded as soon as we see that they do
+    not start with '#!'.  Only the first line is rewritten: in place
+    if the new shebang has the same size, or streaming the rest of the
+    file into a new copy if not.
+
+    A file with hard links is always rewritten in place, so all its
+    names keep the same (relocated) content.  The scripts are never
+    linked to the RPM cache (see `RPMCache._is_rewritten()`), so only
+    the links inside the venv are shared.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(SHEBANG_PREFIX_SIZE)
+        if not head.startswith(b'#!'):
+            return False
+        if b'\n' not in head and len(head) == SHEBANG_PREFIX_SIZE:
+            # Very long shebang, read the rest of the line
+            head += f.readline()
+        line = head.split(b'\n', 1)[0].rstrip()
+        if b'python' not in line or line == shebang:
+            return False
+
+        if len(line) == len(shebang):
+            f.close()
+            with open(filename, 'r+b') as script:
+                script.write(shebang)
+            return True
+
+        if os.fstat(f.fileno()).st_nlink > 1:
+            f.seek(len(line))
+            rest = f.read()
+            f.close()
+            with open(filename, 'r+b') as script:
+                script.write(shebang)
+                script.write(rest)
+                script.truncate()
+            return True
+
+        fd, tmp_name = tempfile.mkstemp(
+            dir=os.path.dirname(filename),
+            prefix='.%s.' % os.path.basename(filename))
+        try:
+            with open(fd, 'wb') as script:
+                script.write(shebang)
+                f.seek(len(line))
+                shutil.copyfileobj(f, script)
+            shutil.copymode(filename, tmp_name)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    return True
+
+
+def _entries(dest_dir, paths):
+    """Return an Entry for each path (relative to `dest_dir`).
+
+    The links in the parent directories are resolved, so the entries
+    are the same that `_scan()` would return for those paths.
+    """
+    real_dest_dir = os.path.realpath(dest_dir)
+    entries = set()
+    for path in paths:
+        dirname, name = os.path.split(path)
+        dirname = os.path.relpath(
+            os.path.realpath(os.path.join(dest_dir, dirname)), real_dest_dir)
+        name = os.path.normpath(os.path.join(dest_dir, dirname, name))
+        if not dirname.startswith('..') and os.path.lexists(name):
+            entries.add(name)
+    return [Entry(name) for name in sorted(entries)]
+
+
+def _fix_tree(dest_dir, fixups, paths=None):
+    """Apply a list of fixups in a single traversal of `dest_dir`.
+
+    If `paths` is provided, only those paths (relative to `dest_dir`)
+    are visited.  Return a dictionary with the number of entries
+    touched by each fixup.
+    """
+    entries = _scan(dest_dir) if paths is None else _entries(dest_dir, paths)
+    for entry in entries:
+        for fixup in fixups:
+            if fixup.visit(entry):
+                fixup.touched += 1
+                entry.refresh()
+    return {fixup.name: fixup.touched for fixup in fixups}
+
+
+def _fix_alternatives(dest_dir, relocated):
+    """Fix alternative links."""
+    return _fix_tree(dest_dir, [AlternativesFixup(relocated)])
+
+
+def _fix_broken_links(dest_dir, directories=None):
+    """Fix broken links."""
+    return _fix_tree(dest_dir, [BrokenLinksFixup(dest_dir, directories)])
 
 
 def _fix_relocation(dest_dir, virtual_env, no_relocate_shebang):
     """Fix relocation shebang from python scripts"""
-    shebang = '#!' + os.path.join(virtual_env, 'bin', 'python2')
-    for dirpath, dirnames, filenames in os.walk(dest_dir):
-        for name in filenames:
-            rel_name = os.path.join(dirpath, name)
-            if any(fnmatch.fnmatch(rel_name, path)
-                    for path in no_relocate_shebang):
-                continue
-            if os.path.isfile(rel_name):
-                try:
-                    line = open(rel_name).readline().strip()
-                    if line.startswith('#!') and 'python' in line:
-                        _replace(rel_name, line, shebang)
-                except Exception:
-                    pass
+    return _fix_tree(dest_dir, [RelocationFixup(virtual_env,
+                                                no_relocate_shebang)])
 
 
 def _fix_activators(dest_dir, virtual_env):
@@ -274,12 +656,23 @@ def _fix_activators(dest_dir, virtual_env):
         # for different architectures
         after, line = action['insert']
         _insert(filename, after, line)
+    return len(activators)
+
 
+# Systemd services fixed (and renamed) by `_fix_systemd_services`
+SERVICES = 'usr/lib/systemd/system/*.service'
 
-def _fix_systemd_services(dest_dir, virtual_env):
+
+def _fix_systemd_services(dest_dir, virtual_env, service_list=None):
     """Fix OpenStack systemd services."""
     services = os.path.join(dest_dir, 'usr/lib/systemd/system')
-    for service in glob.glob(os.path.join(services, '*.service')):
+    if service_list is None:
+        service_list = glob.glob(os.path.join(dest_dir, SERVICES))
+    fixed = 0
+    for service in service_list:
+        if not os.path.isfile(service):
+            continue
+        fixed += 1
         # Service files are read only
         os.chmod(service, 0o644)
         _replace(service, r'ExecStart=(.*)',
@@ -290,43 +683,222 @@ def _fix_systemd_services(dest_dir, virtual_env):
         # For convenience, rename the service
         os.rename(service, os.path.join(services, 'venv-' +
                   os.path.basename(service)))
+    return fixed
+
+
+# Script run by the Python of the venv to byte-compile a list of
+# sources.  It reads a JSON list of [source, dfile] pairs from stdin,
+# and writes the .pyc files atomically, as they can be hard links to
+# the cache.  Every .pyc is printed, prefixed by 'C' if it was
+# compiled or by 'U' if it was up to date.
+BYTE_COMPILE = r'''
+import json, marshal, os, py_compile, struct, sys
+try:
+    from importlib.util import MAGIC_NUMBER as MAGIC, cache_from_source
+except ImportError:
+    import imp
+    MAGIC = imp.get_magic()
+    cache_from_source = lambda source: source + 'c'
+
+def header(st):
+    mtime = int(st.st_mtime) & 0xFFFFFFFF
+    size = st.st_size & 0xFFFFFFFF
+    if sys.version_info[0] == 2:
+        return MAGIC + struct.pack('<I', mtime)
+    if sys.version_info < (3, 7):
+        return MAGIC + struct.pack('<II', mtime, size)
+    return MAGIC + struct.pack('<III', 0, mtime, size)
+
+def up_to_date(source, cfile, dfile):
+    expected = header(os.stat(source))
+    try:
+        with open(cfile, 'rb') as f:
+            data = f.read()
+        if not data.startswith(expected):
+            return False
+        return marshal.loads(data[len(expected):]).co_filename == dfile
+    except Exception:
+        return False
+
+for source, dfile in json.load(sys.stdin):
+    cfile = cache_from_source(source)
+    if up_to_date(source, cfile, dfile):
+        print('U %s' % cfile)
+        continue
+    tmp = '%s.%d.tmp' % (cfile, os.getpid())
+    try:
+        py_compile.compile(source, cfile=tmp, dfile=dfile, doraise=True)
+        os.rename(tmp, cfile)
+        print('C %s' % cfile)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        print('ERROR: %s: %s' % (source, str(e).strip().splitlines()[-1]))
+'''
+
+
+def _byte_compile(dest_dir, virtual_env, no_byte_compile, paths=None,
+                  jobs=None, archive=None):
+    """Byte-compile the Python sources of the venv.
+
+    The relocated path of each source is embedded in the .pyc, and
+    the sources with an up to date .pyc are skipped.  The files are
+    compiled in parallel, in chunks, by the Python of the venv.  If
+    `paths` is provided, only those paths (relative to `dest_dir`)
+    are compiled.  The .pyc files are left pending in the `archive`,
+    if provided.  Return the number of compiled files.
+    """
+    python = os.path.join(dest_dir, 'bin', 'python')
+    if not os.path.exists(python):
+        print('ERROR: %s not found, cannot byte-compile' % python)
+        return 0
+    entries = _scan(dest_dir) if paths is None else _entries(dest_dir, paths)
+    sources = []
+    for entry in entries:
+        if not entry.name.endswith('.py') or not entry.is_file():
+            continue
+        if any(fnmatch.fnmatch(entry.path, path)
+               for path in no_byte_compile):
+            continue
+        dfile = os.path.join(virtual_env, os.path.relpath(entry.path,
+                                                          dest_dir))
+        sources.append([os.path.abspath(entry.path), dfile])
+    if not sources:
+        return 0
+
+    def _compile(chunk):
+        process = subprocess.Popen([python, '-c', BYTE_COMPILE],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        output, _ = process.communicate(json.dumps(chunk).encode('utf-8'))
+        if process.returncode:
+            print('ERROR: byte-compilation failed')
+        return output.decode('utf-8', 'surrogateescape').splitlines()
+
+    jobs = min(jobs or os.cpu_count() or 1, len(sources))
+    abs_dest_dir = os.path.abspath(dest_dir)
+    compiled = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for lines in pool.map(
+                _compile, [sources[i::jobs] for i in range(jobs)]):
+            for line in lines:
+                if line[:2] not in ('C ', 'U '):
+                    print(line)
+                    continue
+                if line[0] == 'C':
+                    compiled += 1
+                if archive is not None:
+                    archive.pending.add(os.path.join(
+                        dest_dir, os.path.relpath(line[2:], abs_dest_dir)))
+    return compiled
+
+
+# Release files read instead of running `lsb_release -a`
+LSB_RELEASE = '/etc/lsb-release'
+OS_RELEASE = '/etc/os-release'
+
+# `lsb_release` reports SUSE as the distributor of the SLE products
+LSB_DISTRIBUTORS = {
+    'sles': 'SUSE',
+    'sled': 'SUSE',
+    'sles_sap': 'SUSE',
+}
+
+# Distributions hidden by `pip freeze`
+PIP_FREEZE_SKIP = ('pip', 'setuptools', 'wheel', 'distribute')
+
+
+def _read_release(filename):
+    """Parse a shell-like KEY=value release file."""
+    release = {}
+    try:
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                value = shlex.split(value)
+                release[key.strip()] = ' '.join(value)
+    except IOError:
+        pass
+    return release
 
 
 def _os_release(ardana_version):
     """Recover release information."""
-    output = subprocess.check_output('lsb_release -a', shell=True)
-    output = output.decode('utf-8')
+    lsb = _read_release(LSB_RELEASE)
+    os_release = _read_release(OS_RELEASE)
+    name = os_release.get('NAME', 'n/a')
+    distributor_id = LSB_DISTRIBUTORS.get(os_release.get('ID'),
+                                          name.split()[0])
     return {
         'distributor_id':
-        re.findall(r'Distributor ID:\s+(.*)$',
-                   output, re.MULTILINE)[0],
+        lsb.get('DISTRIB_ID', distributor_id),
         'description':
-        re.findall(r'Description:\s+(.*)$',
-                   output, re.MULTILINE)[0],
+        lsb.get('DISTRIB_DESCRIPTION', os_release.get('PRETTY_NAME', name)),
         'release':
-        re.findall(r'Release:\s+(.*)$',
-                   output, re.MULTILINE)[0],
+        lsb.get('DISTRIB_RELEASE', os_release.get('VERSION_ID', 'n/a')),
         'codename':
-        re.findall(r'Codename:\s+(.*)$',
-                   output, re.MULTILINE)[0],
+        lsb.get('DISTRIB_CODENAME',
+                os_release.get('VERSION_CODENAME', 'n/a')),
         'deployer_version': 'ardana-%s' % ardana_version,
         'pip_mirror': 'OBS',
     }
 
 
-def _pip_freeze(dest_dir):
-    """Return the output from `pip freeze`."""
-    output = subprocess.check_output(
-        'cd %s; source bin/activate; pip freeze' % dest_dir,
-        shell=True)
-    output = output.decode('utf-8')
-    return output.split('\n')
+def _distribution(metadata):
+    """Return (name, version) from a dist-info or egg-info entry."""
+    if os.path.isdir(metadata):
+        name = 'METADATA' if metadata.endswith('.dist-info') else 'PKG-INFO'
+        metadata = os.path.join(metadata, name)
+    name = version = None
+    try:
+        with open(metadata, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    break
+                if line.startswith('Name:'):
+                    name = line[5:].strip()
+                elif line.startswith('Version:'):
+                    version = line[8:].strip()
+    except IOError:
+        return None
+    if not name or not version:
+        return None
+    # Same normalization than `safe_name` from pkg_resources
+    return re.sub(r'[^A-Za-z0-9.]+', '-', name), version
+
+
+def _pip_freeze(dest_dir, jobs=8):
+    """Return the output equivalent to `pip freeze`."""
+    metadata = []
+    seen = set()
+    for site_packages in sorted(glob.glob(
+            os.path.join(dest_dir, 'lib*', 'python*', 'site-packages'))):
+        # lib64 is usually a link to lib
+        real = os.path.realpath(site_packages)
+        if real in seen:
+            continue
+        seen.add(real)
+        for pattern in ('*.dist-info', '*.egg-info'):
+            metadata.extend(glob.glob(os.path.join(site_packages, pattern)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        distributions = set(d for d in pool.map(_distribution, metadata) if d)
+
+    distributions = sorted(distributions, key=lambda d: d[0].lower())
+    lines = ['%s==%s' % (name, version) for name, version in distributions
+             if name.lower() not in PIP_FREEZE_SKIP]
+    # `pip freeze` output ends with a new line
+    lines.append('')
+    return lines
 
 
 def add_meta_inf(dest_dir, version, ardana_version):
     """Add META-INF directory content."""
     meta_inf = os.path.join(dest_dir, 'META-INF')
-    os.mkdir(meta_inf)
+    os.makedirs(meta_inf, exist_ok=True)
 
     service, timestamp = os.path.basename(dest_dir).rsplit('-', 1)
 
@@ -364,256 +936,3318 @@ def add_meta_inf(dest_dir, version, ardana_version):
             print('  %s' % line, file=f)
 
 
-def create(args):
-    """Function called for the `create` command."""
-    # Create the virtual environment
-    options = []
-    if args.system_site_packages:
-        options.append('--system-site-packages')
-    # Make sure that we generate a Python 2.7 environment
-    options.append('--python=python2.7')
-    options = ' '.join(options)
-    subprocess.call('virtualenv %s %s' % (options, args.dest_dir),
-                    shell=True)
+# RPM header tags used by venvjail
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_OLDFILENAMES = 1027
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILEMTIMES = 1034
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_FILEFLAGS = 1037
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_DISTURL = 1123
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_FILECLASS = 1141
+RPMTAG_CLASSDICT = 1142
+RPMTAG_FILEDIGESTALGO = 5011
+RPMTAG_LONGFILESIZES = 5008
 
-    # Prepare the links for /usr/bin and /usr/lib[64]
-    usr = os.path.join(args.dest_dir, 'usr')
-    os.mkdir(usr)
-    os.symlink('../bin', os.path.join(usr, 'bin'))
-    os.symlink('../lib', os.path.join(usr, 'lib'))
-    os.symlink('../lib', os.path.join(usr, 'lib64'))
+# Types of the values stored in a RPM header
+RPM_INT_TYPES = {2: 'B', 3: 'H', 4: 'I', 5: 'Q'}
+RPM_CHAR_TYPE = 1
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPES = (8, 9)
 
-    # If both are populated, the algorithm will take precedence over
-    # the `exclude` list
-    include = FileList(args.include)
-    exclude = FileList(args.exclude)
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
 
-    # Install the packages and maintain a log
-    included = []
-    excluded = []
-    for package in glob.glob(os.path.join(args.repo, '*.rpm')):
-        rpm = os.path.basename(package)
-        if rpm in exclude:
-            excluded.append(rpm)
-            continue
-        if include.is_populated() and rpm not in include:
-            excluded.append(rpm)
-            continue
-        included.append(rpm)
 
-        package = os.path.abspath(package)
-        subprocess.call(
-            'cd %s; rpm2cpio %s | cpio --extract --unconditional '
-            '--preserve-modification-time --make-directories '
-            '--extract-over-symlinks' % (args.dest_dir, package),
-            stdout=subprocess.DEVNULL,
-            shell=True)
+# File information stored in a RPM header
+RPMFile = collections.namedtuple(
+    'RPMFile', 'path size mode mtime digest linkto flags')
 
-    add_meta_inf(args.dest_dir, args.version, args.ardana_version)
+# Capability provided or required by a RPM
+RPMDependency = collections.namedtuple('RPMDependency', 'name flags version')
 
-    _fix_virtualenv(args.dest_dir, args.relocate, args.no_relocate_shebang_list)
 
-    # Write the log file, useful to better taylor the inclusion /
-    # exclusion of packages.
-    with open(os.path.join(args.dest_dir, 'packages.log'), 'w') as f:
-        print('# Included packages', file=f)
-        for rpm in sorted(included):
-            print(rpm, file=f)
-        print('\n\n# Excluded packages', file=f)
-        for rpm in sorted(excluded):
-            print(rpm, file=f)
+class RPMHeader():
+    """Tags from a RPM header, decoded on demand."""
+    def __init__(self, data):
+        self.data = data
+        nindex, self._store_size = struct.unpack('>II', data[8:16])
+        self._store = 16 + nindex * 16
+        self._index = {}
+        for i in range(nindex):
+            tag, type_, offset, count = struct.unpack_from(
+                '>IIII', data, 16 + i * 16)
+            self._index[tag] = (type_, self._store + offset, count)
 
-    # Write the L3/Maintenance track file, required to track the
-    # content of the venv inside OBS.
-    query = '|'.join(('%{NAME}', '%{EPOCH}', '%{VERSION}',
-                      '%{RELEASE}', '%{ARCH}', '%{DISTURL}'))
-    with open(args.track, 'w') as f:
-        for rpm in sorted(included):
-            rpm = os.path.join(args.repo, rpm)
-            output = subprocess.check_output(
-                "rpm -qp --queryformat='%s' %s" % (query, rpm),
-                stderr=subprocess.DEVNULL,
-                shell=True)
-            print(output.decode('utf-8'), file=f)
+    @classmethod
+    def read(cls, f, pad=False):
+        """Read a header from a file object."""
+        intro = _read_exact(f, 16)
+        if intro[:4] != RPM_HEADER_MAGIC:
+            raise ValueError('Bad RPM header magic')
+        nindex, store_size = struct.unpack('>II', intro[8:])
+        size = nindex * 16 + store_size
+        data = intro + _read_exact(f, size)
+        if pad and size % 8:
+            _read_exact(f, 8 - size % 8)
+        return cls(data)
 
+    def __contains__(self, tag):
+        return tag in self._index
 
-def _filter_binary_xml(root):
-    """Filter a XML tree of binary elements"""
-    elements = []
-    for binary in root.findall('binary'):
-        rpm = binary.get('filename')
-        if rpm.startswith('_'):
-            continue
-        if rpm.endswith('.log'):
-            continue
-        if rpm.endswith('src.rpm'):
-            continue
-        elements.append(rpm)
-    return elements
+    def paths(self):
+        """Return the paths of the files, relative to `/`."""
+        if RPMTAG_BASENAMES not in self:
+            return [path.lstrip('/')
+                    for path in self.get(RPMTAG_OLDFILENAMES, [])]
+        dirnames = self.get(RPMTAG_DIRNAMES)
+        return [os.path.join(dirnames[index], basename).lstrip('/')
+                for index, basename in zip(self.get(RPMTAG_DIRINDEXES),
+                                           self.get(RPMTAG_BASENAMES))]
 
+    def files(self):
+        """Return a RPMFile for every file in the RPM."""
+        paths = self.paths()
+        empty = [None] * len(paths)
+        return [RPMFile(*values) for values in zip(
+            paths,
+            self.get(RPMTAG_LONGFILESIZES) or self.get(RPMTAG_FILESIZES,
+                                                       empty),
+            self.get(RPMTAG_FILEMODES, empty),
+            self.get(RPMTAG_FILEMTIMES, empty),
+            self.get(RPMTAG_FILEDIGESTS, empty),
+            self.get(RPMTAG_FILELINKTOS, empty),
+            self.get(RPMTAG_FILEFLAGS, empty))]
 
-def _filter_binary_name(names, args):
-    """Filter a list of RPM names"""
-    exclude = FileList(args.exclude)
-    if args.all:
-        return names
-    else:
-        return [rpm for rpm in names if rpm not in exclude]
+    def classes(self):
+        """Return the file(1) class of every file, if recorded."""
+        dictionary = self.get(RPMTAG_CLASSDICT, [])
+        return [dictionary[index] if index < len(dictionary) else ''
+                for index in self.get(RPMTAG_FILECLASS, [])]
 
+    def _dependencies(self, name_tag, flags_tag, version_tag):
+        names = self.get(name_tag, [])
+        empty = [None] * len(names)
+        return [RPMDependency(*values) for values in zip(
+            names, self.get(flags_tag, empty), self.get(version_tag, empty))]
 
-def _repository(args):
-    """List binary packages from a repository"""
-    api = '/build/%s/%s/%s/_repository' % (args.project, args.repo,
-                                           args.arch)
-    output = subprocess.check_output(
-        'osc --apiurl %s api %s' % (args.apiurl, api), shell=True)
-    elements = _filter_binary_xml(ET.fromstring(output))
-    # Unversioned name, so we remove the file extension
-    elements = [rpm.replace('.rpm', '') for rpm in elements]
-    return _filter_binary_name(elements, args)
+    def provides(self):
+        """Return a RPMDependency for every capability provided."""
+        return self._dependencies(RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS,
+                                  RPMTAG_PROVIDEVERSION)
 
+    def requires(self):
+        """Return a RPMDependency for every capability required."""
+        return self._dependencies(RPMTAG_REQUIRENAME, RPMTAG_REQUIREFLAGS,
+                                  RPMTAG_REQUIREVERSION)
 
-def include(args):
-    """Generate initial include-rpm file"""
-    print('# List of packages to include (use Python regex)')
-    print()
-    print('# Packages from the repository')
-    for name in _repository(args):
-        print('%s.*' % name)
+    @property
+    def digest(self):
+        """SHA256 of the header, that identifies the RPM."""
+        return hashlib.sha256(self.data).hexdigest()
 
+    def get(self, tag, default=None):
+        """Return the value of a tag."""
+        if tag not in self._index:
+            return default
+        type_, offset, count = self._index[tag]
+        data = self.data
+        if type_ in RPM_INT_TYPES:
+            fmt = '>%d%s' % (count, RPM_INT_TYPES[type_])
+            return list(struct.unpack_from(fmt, data, offset))
+        if type_ == RPM_BIN_TYPE:
+            return data[offset:offset + count]
+        if type_ == RPM_CHAR_TYPE:
+            return data[offset:offset + count].decode('utf-8')
+        values = []
+        for _ in range(count):
+            end = data.index(b'\0', offset)
+            values.append(data[offset:end].decode('utf-8', 'surrogateescape'))
+            offset = end + 1
+        if type_ == RPM_STRING_TYPE:
+            return values[0]
+        if type_ == RPM_STRING_ARRAY_TYPES[1]:
+            # For I18N strings we only care about the default locale
+            return values[0]
+        return values
 
-def exclude(args):
-    """Generate initial exclude-rpm file"""
-    print(EXCLUDE_RPM)
 
+def _read_exact(f, size):
+    """Read exactly `size` bytes from a file object."""
+    data = f.read(size)
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            raise EOFError('Unexpected end of file')
+        data += chunk
+    return data
 
-def binary(args):
-    """List binary packages from a source package"""
 
-    # OBS generate a full RPM package name, including the version and
-    # architecture.  To generate include-rpm and exclude-rpm, we will
-    # need only the name of the package
-    rpm_re = re.compile(r'(.*)-([^-]+)-([^-]+)\.([^-\.]+)\.rpm')
+def _rpm_headers(f):
+    """Read the lead and the signature, and return the main header."""
+    lead = _read_exact(f, 96)
+    if lead[:4] != RPM_LEAD_MAGIC:
+        raise ValueError('Bad RPM lead magic')
+    # The signature header is padded to a multiple of 8 bytes
+    RPMHeader.read(f, pad=True)
+    return RPMHeader.read(f)
 
-    api = '/build/%s/%s/%s/%s' % (args.project, args.repo,
-                                  args.arch, args.package)
-    output = subprocess.check_output(
-        'osc --apiurl %s api %s' % (args.apiurl, api), shell=True)
-    elements = _filter_binary_xml(ET.fromstring(output))
-    # Take only the name of the package
-    elements = [rpm_re.match(rpm).groups()[0] for rpm in elements]
-    elements = _filter_binary_name(elements, args)
-    for rpm in elements:
-        print(rpm)
 
+def _payload(f, header):
+    """Return a file object with the uncompressed payload.
 
-def _filter_requires_spec(spec):
-    """Recover the Requires elements from a spec file"""
-    requires = re.findall(r'^Requires:\s*([-\.\w]+)(.*)?$', spec,
-                          re.MULTILINE)
-    return dict(requires)
+    Return None if the compressor is not supported."""
+    if header.get(RPMTAG_PAYLOADFORMAT, 'cpio') != 'cpio':
+        return None
+    compressor = header.get(RPMTAG_PAYLOADCOMPRESSOR, 'gzip')
+    if compressor == 'gzip':
+        return gzip.GzipFile(fileobj=f)
+    elif compressor == 'bzip2':
+        return bz2.BZ2File(f)
+    elif compressor in ('xz', 'lzma'):
+        return lzma.LZMAFile(f)
+    elif compressor == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return None
 
 
-def requires(args):
-    """List requirements for a source package"""
+def _make_writable(directory):
+    """Give the owner full access to a directory, to fill it.
 
-    api = '/source/%s/%s/%s.spec' % (args.project, args.package,
-                                     args.package)
-    output = subprocess.check_output(
-        'osc --apiurl %s api %s' % (args.apiurl, api), shell=True)
-    requires_and_version = _filter_requires_spec(output.decode('utf-8'))
-    requires = requires_and_version.keys()
+    Return the previous mode, or None if it was not changed.
+    """
+    mode = stat.S_IMODE(os.stat(directory).st_mode)
+    if mode & stat.S_IRWXU == stat.S_IRWXU:
+        return None
+    os.chmod(directory, mode | stat.S_IRWXU)
+    return mode
 
-    # Remove the packages included in the venv
-    include = FileList(args.include)
-    exclude = FileList(args.exclude)
-    in_venv = []
-    for rpm in requires:
-        if rpm in exclude:
-            continue
-        if include.is_populated() and rpm not in include:
-            continue
-        in_venv.append(rpm)
-    requires = set(requires) - set(in_venv)
 
-    for rpm in sorted(requires):
-        requires = '%s %s' % (rpm, requires_and_version[rpm].strip())
-        print(requires.strip())
+def _rmtree(path, ignore_errors=False):
+    """Remove a directory tree, also with read-only directories."""
+    def _onerror(function, name, exc_info):
+        try:
+            if (function not in (os.unlink, os.rmdir)
+               or not issubclass(exc_info[0], PermissionError)):
+                raise exc_info[1]
+            _make_writable(os.path.dirname(name))
+            function(name)
+        except OSError:
+            if not ignore_errors:
+                raise
+    shutil.rmtree(path, onerror=_onerror)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Utility to help venvs creation for OpenStack services')
-    subparsers = parser.add_subparsers(help='Sub-commands for venvjail')
+def _cpio_target(dest_dir, name, make_directories, extract_over_symlinks):
+    """Return the full path for a cpio entry, or None if is not valid."""
+    path = os.path.normpath(name.lstrip('/'))
+    if path == '.':
+        return path, None
+    if path == '..' or path.startswith('..' + os.sep):
+        print('ERROR: removing leading ".." from %s' % name)
+        return path, None
+    parent = os.path.dirname(path)
+    if parent and not extract_over_symlinks:
+        partial = dest_dir
+        for component in parent.split(os.sep):
+            partial = os.path.join(partial, component)
+            if os.path.islink(partial):
+                print('ERROR: %s: cannot extract through symlink' % path)
+                return path, None
+    if parent and not os.path.isdir(os.path.join(dest_dir, parent)):
+        if not make_directories:
+            print('ERROR: %s: cannot create, missing directory' % path)
+            return path, None
+        os.makedirs(os.path.join(dest_dir, parent), exist_ok=True)
+    return path, os.path.join(dest_dir, path)
 
-    # Parser for `create` command
-    subparser = subparsers.add_parser('create', help='Create a virtualenv')
-    subparser.add_argument('dest_dir', metavar='DEST_DIR',
-                           help='Virtual environment directory')
-    subparser.add_argument('-s', '--system-site-packages',
-                           action='store_false',
-                           help='Allows access to the global site-packages')
-    subparser.add_argument('-l', '--relocate',
-                           default='/opt/stack/venv',
-                           help='Relocated virtual environment directory')
-    subparser.add_argument('--no-relocate-shebang-list', metavar='PATH',
-                           default=[],
-                           nargs='+',
-                           help='Do not change the shebang in these files. '
-                               'Wildcards supported (fnmatch/bash style). '
-                               'Specify with DEST_DIR.')
-    subparser.add_argument('-r', '--repo',
-                           default='/.build.binaries',
-                           help='Repository directory')
-    subparser.add_argument('-i', '--include',
-                           default='include-rpm',
-                           help='File with the list of packages to install')
-    subparser.add_argument('-x', '--exclude',
-                           default='exclude-rpm',
-                           help='File with packages to exclude')
-    subparser.add_argument('-t', '--track',
-                           help='Filename for the L3/Maintenance track file')
-    subparser.add_argument('-v', '--version',
-                           default='0.1.0',
-                           help='Package version')
-    subparser.add_argument('-a', '--ardana-version',
-                           default='0.9.0',
-                           help='Ardana version')
-    subparser.set_defaults(func=create)
 
-    # Parser for `include` command
-    subparser = subparsers.add_parser(
-        'include', help='Generate initial include-rpm file')
-    subparser.add_argument('-A', '--apiurl',
-                           default='https://api.opensuse.org',
-                           help='API address')
-    subparser.add_argument('-p', '--project',
-                           default='Cloud:OpenStack:Master',
-                           help='Project name')
-    subparser.add_argument('-r', '--repo', default='SLE_12_SP3',
-                           help='Repository name')
-    subparser.add_argument('-a', '--arch', default='x86_64',
-                           help='Architecture')
-    subparser.add_argument('--all', action='store_true',
-                           help='Include all packages')
-    subparser.add_argument('-x', '--exclude',
-                           default='exclude-rpm',
-                           help='File with packages to exclude')
-    subparser.set_defaults(func=include)
+def _cpio_extract(stream, dest_dir, unconditional=True,
+                  preserve_mtime=True, make_directories=True,
+                  extract_over_symlinks=True, path_filter=None):
+    """Extract a newc cpio archive and return the extracted paths.
 
-    # Parser for `exclude` command
-    subparser = subparsers.add_parser(
-        'exclude', help='Generate initial exclude-rpm file')
-    subparser.set_defaults(func=exclude)
+    The keyword parameters mimic the cpio options used historically
+    to extract the RPM payload.  The paths excluded by `path_filter`
+    are skipped.
+    """
+    extracted = set()
+    # Hard links are stored without data, except for the last one
+    links = {}
+    # Like cpio, the mode and time of the directories are set at the
+    # end, so read-only directories can be filled
+    directories = []
+    as_root = os.geteuid() == 0
+    while True:
+        header = _read_exact(stream, 110)
+        if header[:6] not in (b'070701', b'070702'):
+            raise ValueError('Unsupported cpio format')
+        (ino, mode, uid, gid, nlink, mtime, size, devmajor,
+         devminor, _, _, namesize, _) = (
+             int(header[i:i + 8], 16) for i in range(6, 110, 8))
+        name = _read_exact(stream, namesize)[:-1]
+        _read_exact(stream, -(110 + namesize) % 4)
+        name = name.decode('utf-8', 'surrogateescape')
+        if name == 'TRAILER!!!':
+            break
 
-    # Parser for `binary` command
-    subparser = subparsers.add_parser(
-        'binary', help='List the binary packages')
-    subparser.add_argument('package', metavar='PACKAGE',
-                           help='Source package name')
+        if path_filter and path_filter.excluded(
+                os.path.normpath(name.lstrip('/')),
+                size if stat.S_ISREG(mode) else 0):
+            path, target = None, None
+        else:
+            path, target = _cpio_target(dest_dir, name, make_directories,
+                                        extract_over_symlinks)
+        if (target and not unconditional and os.path.lexists(target)
+           and not stat.S_ISDIR(mode)
+           and os.lstat(target).st_mtime >= mtime):
+            print('ERROR: %s not created: newer or same age version '
+                  'exists' % path)
+            target = None
+        if target and not stat.S_ISDIR(mode) and os.path.lexists(target):
+            if os.path.isdir(target) and not os.path.islink(target):
+                print('ERROR: cannot remove current %s' % path)
+                target = None
+            else:
+                os.unlink(target)
+
+        if stat.S_ISREG(mode):
+            key = (devmajor, devminor, ino)
+            if nlink > 1 and not size:
+                # Postpone it until the data is found
+                if target:
+                    links.setdefault(key, []).append(target)
+                    extracted.add(path)
+                continue
+            if not target and links.get(key):
+                # The data is shared with links that were extracted
+                target = links[key].pop(0)
+                path = os.path.relpath(target, dest_dir)
+            out = None
+            if target:
+                out = open(target, 'wb')
+            remaining = size
+            while remaining:
+                chunk = stream.read(min(remaining, 1 << 16))
+                if not chunk:
+                    raise EOFError('Unexpected end of file')
+                if out:
+                    out.write(chunk)
+                remaining -= len(chunk)
+            if out:
+                out.close()
+            _read_exact(stream, -size % 4)
+            if not target:
+                continue
+            for link in links.pop(key, []) if nlink > 1 else []:
+                os.link(target, link)
+            targets = [target]
+        else:
+            data = _read_exact(stream, size)
+            _read_exact(stream, -size % 4)
+            if not target:
+                continue
+            if stat.S_ISDIR(mode):
+                if not os.path.isdir(target):
+                    os.mkdir(target)
+                else:
+                    _make_writable(target)
+                directories.append((target, mode, mtime))
+            elif stat.S_ISLNK(mode):
+                os.symlink(data.decode('utf-8', 'surrogateescape'),
+                           target)
+            else:
+                try:
+                    os.mknod(target, mode, os.makedev(devmajor, devminor))
+                except OSError as e:
+                    print('ERROR: %s: %s' % (path, e))
+                    continue
+            targets = [target]
+
+        extracted.add(path)
+        for target in targets:
+            if as_root:
+                os.lchown(target, uid, gid)
+            if not stat.S_ISLNK(mode) and not stat.S_ISDIR(mode):
+                os.chmod(target, stat.S_IMODE(mode))
+            if preserve_mtime and not stat.S_ISDIR(mode):
+                os.utime(target, (mtime, mtime), follow_symlinks=False)
+
+    # Hard links without data are created empty
+    for targets in links.values():
+        for target in targets:
+            open(target, 'wb').close()
+
+    for target, mode, mtime in reversed(directories):
+        os.chmod(target, stat.S_IMODE(mode))
+        if preserve_mtime:
+            os.utime(target, (mtime, mtime))
+    return extracted
+
+
+def _extract_rpm(package, dest_dir, path_filter=None):
+    """Extract a RPM inside a directory.
+
+    Return the RPM header and the extracted paths."""
+    with open(package, 'rb') as f:
+        header = _rpm_headers(f)
+        payload = _payload(f, header)
+        if payload:
+            with payload:
+                return header, _cpio_extract(payload, dest_dir,
+                                             path_filter=path_filter)
+
+    # Use rpm2cpio to decompress payloads that we cannot read
+    process = subprocess.Popen(['rpm2cpio', package],
+                               stdout=subprocess.PIPE)
+    with process.stdout:
+        extracted = _cpio_extract(process.stdout, dest_dir,
+                                  path_filter=path_filter)
+    if process.wait():
+        print('ERROR: rpm2cpio failed for %s' % package)
+    return header, extracted
+
+
+def _track_record(header):
+    """Return the NAME|EPOCH|VERSION|RELEASE|ARCH|DISTURL of a RPM.
+
+    The format is the same that `rpm -qp --queryformat` generates.
+    """
+    fields = []
+    for tag in (RPMTAG_NAME, RPMTAG_EPOCH, RPMTAG_VERSION,
+                RPMTAG_RELEASE, RPMTAG_ARCH, RPMTAG_DISTURL):
+        value = header.get(tag)
+        if value is None:
+            value = '(none)'
+        elif isinstance(value, list):
+            value = value[0]
+        fields.append(str(value))
+    return '|'.join(fields)
+
+
+def _overlay(src_dir, dest_dir, extracted, place=None, prefix='',
+             excluded=()):
+    """Place a extracted tree over `dest_dir`, like cpio would do.
+
+    Files and links replace the ones already present, and directories
+    are merged.  The paths are resolved following the links already
+    present in `dest_dir`, so for example `usr/bin` will end in `bin`.
+    Only the directories listed in `extracted` (and not the ones
+    created implicitly by --make-directories) will update the
+    permissions of an existing directory.
+
+    By default the content of `src_dir` is moved.  If `place` is
+    provided, it is called as `place(src, dest, path)` for every file
+    and link, and `src_dir` is left untouched.  The paths in
+    `excluded` are not placed, and the excluded (or implicit)
+    directories are only created if some of their content is placed.
+
+    The read-only directories are made writable while they are
+    filled, and get their mode back at the end.
+    """
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        dest = os.path.join(dest_dir, name)
+        path = os.path.join(prefix, name)
+        if os.path.isdir(src) and not os.path.islink(src):
+            src_mode = stat.S_IMODE(os.stat(src).st_mode)
+            if not place:
+                # The content (or the directory itself) is moved
+                _make_writable(src)
+            if os.path.isdir(dest):
+                dest_mode = _make_writable(dest)
+                _overlay(src, dest, extracted, place, path, excluded)
+                if path in extracted and path not in excluded:
+                    shutil.copystat(src, dest)
+                    os.chmod(dest, src_mode)
+                elif dest_mode is not None:
+                    os.chmod(dest, dest_mode)
+                continue
+            elif os.path.lexists(dest):
+                print('ERROR: cannot create directory %s' % path)
+                continue
+            elif place:
+                os.mkdir(dest)
+                _overlay(src, dest, extracted, place, path, excluded)
+                if path in extracted and path not in excluded:
+                    shutil.copystat(src, dest)
+                elif excluded and not os.listdir(dest):
+                    os.rmdir(dest)
+                else:
+                    shutil.copystat(src, dest)
+                continue
+        elif path in excluded:
+            continue
+        elif os.path.isdir(dest) and not os.path.islink(dest):
+            print('ERROR: cannot replace directory %s' % path)
+            continue
+        if place:
+            if os.path.lexists(dest):
+                os.unlink(dest)
+            place(src, dest, path)
+        else:
+            os.replace(src, dest)
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                os.chmod(dest, src_mode)
+
+
+# ioctl to share the extents of a file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """Create `dest` as a copy-on-write clone of `src`."""
+    with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+        try:
+            fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+        except OSError:
+            dest_f.close()
+            os.unlink(dest)
+            raise
+    shutil.copystat(src, dest)
+
+
+def _read_header(package):
+    """Read the main header of a RPM file."""
+    if _warm:
+        return _warm.header(package)
+    return _read_rpm_header(package)
+
+
+def _read_rpm_header(package):
+    """Read the main header of a RPM file, without the warm state."""
+    with open(package, 'rb') as f:
+        return _rpm_headers(f)
+
+
+class RPMIndex():
+    """Persistent index of the headers of the RPMs in a repository.
+
+    The index is a SQLite database, that store the main fields, the
+    provides and requires, the file list and the full header of every
+    RPM.  Only the RPMs that changed (size or modification time) since
+    the last refresh are read again.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS packages (
+        rpm TEXT PRIMARY KEY, mtime REAL, size INTEGER, digest TEXT,
+        name TEXT, epoch INTEGER, version TEXT, release TEXT,
+        arch TEXT, disturl TEXT, header BLOB);
+    CREATE TABLE IF NOT EXISTS provides (
+        rpm TEXT, name TEXT, flags INTEGER, version TEXT);
+    CREATE TABLE IF NOT EXISTS requires (
+        rpm TEXT, name TEXT, flags INTEGER, version TEXT);
+    CREATE TABLE IF NOT EXISTS files (
+        rpm TEXT, path TEXT, size INTEGER, mode INTEGER, mtime INTEGER,
+        digest TEXT, linkto TEXT, flags INTEGER);
+    CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+    CREATE INDEX IF NOT EXISTS provides_name ON provides (name);
+    CREATE INDEX IF NOT EXISTS requires_rpm ON requires (rpm);
+    CREATE INDEX IF NOT EXISTS files_rpm ON files (rpm);
+    CREATE INDEX IF NOT EXISTS files_path ON files (path);
+    """
+
+    def __init__(self, filename):
+        # The index can be used from the extraction threads
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self._headers = {}
+
+    def refresh(self, repo):
+        """Synchronize the index with the RPMs from a repository."""
+        indexed = {rpm: (mtime, size) for rpm, mtime, size in self.db.execute(
+            'SELECT rpm, mtime, size FROM packages')}
+        found = set()
+        with self.db:
+            for package in glob.glob(os.path.join(repo, '*.rpm')):
+                rpm = os.path.basename(package)
+                found.add(rpm)
+                stat_ = os.stat(package)
+                if indexed.get(rpm) == (stat_.st_mtime, stat_.st_size):
+                    continue
+                self._delete(rpm)
+                self._add(rpm, stat_, _read_header(package))
+            for rpm in set(indexed) - found:
+                self._delete(rpm)
+        self._headers = {}
+
+    def _delete(self, rpm):
+        for table in ('packages', 'provides', 'requires', 'files'):
+            self.db.execute('DELETE FROM %s WHERE rpm = ?' % table, (rpm,))
+
+    def _add(self, rpm, stat_, header):
+        epoch = header.get(RPMTAG_EPOCH)
+        self.db.execute(
+            'INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (rpm, stat_.st_mtime, stat_.st_size, header.digest,
+             header.get(RPMTAG_NAME), epoch[0] if epoch else None,
+             header.get(RPMTAG_VERSION), header.get(RPMTAG_RELEASE),
+             header.get(RPMTAG_ARCH), header.get(RPMTAG_DISTURL),
+             header.data))
+        self.db.executemany(
+            'INSERT INTO provides VALUES (?, ?, ?, ?)',
+            ((rpm,) + dependency for dependency in header.provides()))
+        self.db.executemany(
+            'INSERT INTO requires VALUES (?, ?, ?, ?)',
+            ((rpm,) + dependency for dependency in header.requires()))
+        self.db.executemany(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((rpm,) + file_ for file_ in header.files()))
+
+    def header(self, rpm):
+        """Return the header of a RPM, from the stored data."""
+        if rpm not in self._headers:
+            row = self.db.execute('SELECT header FROM packages WHERE rpm = ?',
+                                  (rpm,)).fetchone()
+            self._headers[rpm] = RPMHeader(row[0]) if row else None
+        return self._headers[rpm]
+
+    def names(self):
+        """Return a dictionary with the package name of every RPM."""
+        return dict(self.db.execute('SELECT rpm, name FROM packages'))
+
+    def conflicts(self, rpms):
+        """Return the files that are different in several RPMs.
+
+        Return a list of (path, [rpm, ...]) for the files (directories
+        are not considered) that are in more than one RPM from `rpms`,
+        with a different mode, digest or link.
+        """
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS selected '
+                            '(rpm TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM selected')
+            self.db.executemany('INSERT INTO selected VALUES (?)',
+                                ((rpm,) for rpm in rpms))
+        rows = self.db.execute(
+            """SELECT path, group_concat(rpm, ' ') FROM files
+            WHERE rpm IN (SELECT rpm FROM selected)
+            AND (mode & ?) != ?
+            GROUP BY path
+            HAVING count(DISTINCT mode || ':' || digest || ':' || linkto) > 1
+            ORDER BY path""", (stat.S_IFMT(0o177777), stat.S_IFDIR))
+        return [(path, sorted(rpms.split())) for path, rpms in rows]
+
+
+def _closure(headers, roots):
+    """Compute the dependency closure of some root packages.
+
+    `headers` is a dictionary with the header of every candidate RPM,
+    and `roots` the names of the root packages.  The requirements are
+    resolved by name (versions are not compared) against the provides
+    and files of the candidates.  Return an ordered dictionary with
+    the reason why every RPM was selected, and a dictionary with the
+    requirements not provided by any candidate, and the RPMs that
+    require them.
+    """
+    providers = collections.defaultdict(list)
+    by_name = collections.defaultdict(list)
+    for rpm in sorted(headers):
+        header = headers[rpm]
+        name = header.get(RPMTAG_NAME)
+        by_name[name].append(rpm)
+        # RPM always provides the name of the package
+        providers[name].append(rpm)
+        for provide in header.provides():
+            providers[provide.name].append(rpm)
+        for path in header.paths():
+            providers['/' + path].append(rpm)
+    providers = {name: sorted(set(rpms)) for name, rpms in providers.items()}
+
+    selected = collections.OrderedDict()
+    unresolved = collections.defaultdict(list)
+    queue = collections.deque()
+    for root in roots:
+        if not by_name.get(root):
+            print('ERROR: root package %s not found' % root)
+        for rpm in by_name.get(root, []):
+            if rpm not in selected:
+                selected[rpm] = 'root'
+                queue.append(rpm)
+
+    while queue:
+        rpm = queue.popleft()
+        for require in headers[rpm].requires():
+            name = require.name
+            if name.startswith('rpmlib('):
+                continue
+            candidates = providers.get(name)
+            if not candidates:
+                unresolved[name].append(rpm)
+                continue
+            if any(candidate in selected for candidate in candidates):
+                continue
+            # Prefer the package with the same name than the capability
+            same_name = [candidate for candidate in candidates
+                         if headers[candidate].get(RPMTAG_NAME) == name]
+            candidate = (same_name or candidates)[0]
+            selected[candidate] = 'requires %s from %s' % (name, rpm)
+            queue.append(candidate)
+    return selected, unresolved
+
+
+class RPMCache():
+    """Cache of extracted RPMs, indexed by the digest of the header.
+
+    Every entry contains the extracted tree of a RPM, and a manifest
+    with the extracted paths, the size of the tree and the files that
+    the fixups will rewrite later, that needs to be copied instead of
+    linked.  The least recently used entries are removed when the
+    cache is bigger than `size` bytes, except the ones in use by a
+    running build (from `entry()` until `release()`).
+    """
+    def __init__(self, path, size):
+        self.path = os.path.join(path, 'rpms')
+        self.size = size
+        self.used = collections.Counter()
+        # The cache can be shared by several builds, so every RPM is
+        # extracted only once
+        self._lock = threading.Lock()
+        self._locks = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry(self, package):
+        """Return the header, the tree and the manifest of a RPM.
+
+        If the RPM is not in the cache, it is extracted first.
+        """
+        header = _read_header(package)
+        digest = header.digest
+        entry = os.path.join(self.path, digest)
+        with self._lock:
+            self.used[digest] += 1
+            lock = self._locks.setdefault(digest, threading.Lock())
+        try:
+            with lock:
+                if not os.path.isdir(entry):
+                    self._add(package, entry)
+            manifest_name = os.path.join(entry, 'manifest.json')
+            with open(manifest_name) as f:
+                manifest = json.load(f)
+        except Exception:
+            self.release([digest])
+            raise
+        # Mark the entry as recently used
+        os.utime(manifest_name)
+        return header, os.path.join(entry, 'tree'), manifest
+
+    def _add(self, package, entry):
+        """Extract a RPM into a new cache entry."""
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        tree = os.path.join(tmp_entry, 'tree')
+        os.mkdir(tree)
+        try:
+            _, extracted = _extract_rpm(package, tree)
+            size = 0
+            copy = []
+            for path in extracted:
+                name = os.path.join(tree, path)
+                if os.path.islink(name) or not os.path.isfile(name):
+                    continue
+                size += os.path.getsize(name)
+                if self._is_rewritten(path, name):
+                    copy.append(path)
+            manifest = {
+                'package': os.path.basename(package),
+                'extracted': sorted(extracted),
+                'copy': sorted(copy),
+                'size': size,
+            }
+            with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # Other process added the same entry meanwhile
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            _rmtree(tmp_entry, ignore_errors=True)
+
+    @staticmethod
+    def _is_rewritten(path, name):
+        """Check if a file will be modified by the fixups."""
+        if path.startswith('usr/lib/systemd/system/'):
+            return True
+        if os.path.basename(path).startswith('activate'):
+            return True
+        with open(name, 'rb') as f:
+            return f.read(2) == b'#!'
+
+    @staticmethod
+    def _place(src, dest, path, copy):
+        """Hard link, reflink or copy a file from the cache."""
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dest)
+            mtime = os.lstat(src).st_mtime
+            os.utime(dest, (mtime, mtime), follow_symlinks=False)
+            return
+        if path not in copy:
+            try:
+                os.link(src, dest)
+                return
+            except OSError:
+                pass
+        try:
+            _reflink(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+    def materialize(self, tree, manifest, dest_dir, path_filter=None):
+        """Place the content of a cache entry over `dest_dir`.
+
+        Return the paths placed, without the ones excluded by
+        `path_filter`.
+        """
+        copy = set(manifest['copy'])
+        extracted = set(manifest['extracted'])
+        excluded = set()
+        if path_filter:
+            for path in extracted:
+                st = os.lstat(os.path.join(tree, path))
+                size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+                if path_filter.excluded(path, size):
+                    excluded.add(path)
+        _overlay(tree, dest_dir, extracted,
+                 lambda src, dest, path: self._place(src, dest, path, copy),
+                 excluded=excluded)
+        return extracted - excluded
+
+    def release(self, digests):
+        """Mark the entries returned by `entry()` as not in use."""
+        with self._lock:
+            self.used.subtract(digests)
+            self.used += collections.Counter()
+
+    def evict(self):
+        """Remove the least recently used entries over the size limit."""
+        entries = []
+        for digest in os.listdir(self.path):
+            manifest_name = os.path.join(self.path, digest, 'manifest.json')
+            try:
+                with open(manifest_name) as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(manifest_name),
+                                size, digest))
+            except (OSError, ValueError):
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, digest in sorted(entries):
+            if total <= self.size:
+                break
+            if digest in self.used:
+                continue
+            _rmtree(os.path.join(self.path, digest))
+            total -= size
+
+
+def _extract_packages(packages, dest_dir, jobs=1, cache=None, stats=None,
+                      path_filter=None):
+    """Extract a list of RPMs inside `dest_dir`.
+
+    With more than one job, every RPM is extracted in parallel in its
+    own staging directory (or in the cache entry), and later placed
+    over `dest_dir` in the same order as in `packages`.  This way the
+    files shared between different RPMs are the same as in a
+    sequential extraction.
+
+    Return a dictionary with the header and the extracted paths of
+    every RPM.  The time used by each RPM is recorded in `stats`.  The
+    paths excluded by `path_filter` are not extracted.
+    """
+    stats = stats or BuildStats()
+    extracted = {}
+    if jobs <= 1 and not cache:
+        for package in packages:
+            extracted[package], wall, cpu = _timed(_extract_rpm, package,
+                                                   dest_dir, path_filter)
+            stats.add_package(package, wall, cpu, *extracted[package])
+        return extracted
+
+    if cache:
+        # Digests of the cache entries used by this build
+        used = []
+
+        def _extract(index_and_package):
+            _, package = index_and_package
+            header, tree, manifest = cache.entry(package)
+            used.append(header.digest)
+            return package, header, tree, manifest
+
+        def _place(tree, manifest):
+            return cache.materialize(tree, manifest, dest_dir, path_filter)
+    else:
+        staging = tempfile.mkdtemp(prefix='.venvjail-', dir=dest_dir)
+
+        def _extract(index_and_package):
+            index, package = index_and_package
+            stage_dir = os.path.join(staging, str(index))
+            os.mkdir(stage_dir)
+            return (package,) + _extract_rpm(package, stage_dir,
+                                             path_filter) + (stage_dir,)
+
+        def _place(paths, stage_dir):
+            _overlay(stage_dir, dest_dir, paths)
+            _rmtree(stage_dir)
+            return paths
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            # `map` return the results in order, so we can place each
+            # RPM as soon as all the previous ones are in place
+            for (package, header, *result), wall, cpu in executor.map(
+                    lambda item: _timed(_extract, item),
+                    enumerate(packages)):
+                paths, place_wall, place_cpu = _timed(_place, *result)
+                extracted[package] = header, paths
+                stats.add_package(package, wall + place_wall,
+                                  cpu + place_cpu, header, paths)
+    finally:
+        if cache:
+            cache.release(used)
+            cache.evict()
+        else:
+            _rmtree(staging, ignore_errors=True)
+    return extracted
+
+
+def _manifest_record(package, header, extracted):
+    """Return the manifest record of an extracted RPM.
+
+    The record contains the digest of the header and the extracted
+    paths, with the directories apart.
+    """
+    dirs = set(file_.path for file_ in header.files()
+               if stat.S_ISDIR(file_.mode or 0))
+    return {
+        'rpm': os.path.basename(package),
+        'digest': header.digest,
+        'files': sorted(extracted - dirs),
+        'dirs': sorted(extracted & dirs),
+    }
+
+
+def _record_fixed(dest_dir, records, headers):
+    """Record the digest and mode of the files changed by the fixups.
+
+    The extraction keeps the times and modes of the RPM files, so the
+    files with a different time or mode, or renamed, were rewritten by
+    the fixups.  Their digest and mode are added to the manifest
+    records (in `fixed`), so `verify` can check that they are still as
+    the build left them.  Return the number of files recorded.
+    """
+    headers = {os.path.basename(package): header
+               for package, header in headers.items()}
+    recorded = 0
+    for record in records:
+        files = {file_.path: file_
+                 for file_ in headers[record['rpm']].files()}
+        fixed = {}
+        for path in record['files']:
+            file_ = files.get(path)
+            if not file_ or not stat.S_ISREG(file_.mode or 0):
+                continue
+            for installed in _installed_paths(path):
+                name = os.path.join(dest_dir, installed)
+                try:
+                    st = os.lstat(name)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode) and (
+                        installed != path
+                        or int(st.st_mtime) != file_.mtime
+                        or stat.S_IMODE(st.st_mode)
+                        != stat.S_IMODE(file_.mode)):
+                    fixed[installed] = [_hash_file(name, 'sha256'),
+                                        stat.S_IMODE(st.st_mode)]
+                break
+        record['fixed'] = fixed
+        recorded += len(fixed)
+    return recorded
+
+
+def _read_manifest(dest_dir):
+    """Read the list of RPMs installed in a venv, and its files."""
+    with open(os.path.join(dest_dir, 'META-INF', 'packages.json')) as f:
+        return json.load(f)
+
+
+def _write_manifest(dest_dir, records):
+    """Write the list of RPMs installed in a venv, and its files."""
+    with open(os.path.join(dest_dir, 'META-INF', 'packages.json'),
+              'w') as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+
+
+def _installed_paths(path):
+    """Return the paths where a file from a RPM can be in the venv."""
+    yield path
+    # The services are renamed by `_fix_systemd_services`
+    if fnmatch.fnmatch(path, SERVICES):
+        dirname, name = os.path.split(path)
+        yield os.path.join(dirname, 'venv-' + name)
+
+
+def _update_packages(packages, dest_dir, jobs=1, cache=None, headers=None,
+                     stats=None, path_filter=None):
+    """Update the RPMs of a venv created before.
+
+    Compare the RPMs with the manifest recorded in the venv, extract
+    only the new or changed ones, and remove the files that were
+    owned only by the RPMs that are not in the venv anymore.  An
+    unchanged RPM is also extracted again if one of its files was
+    overwritten by a removed or changed RPM, so the result is the same
+    as with a full extraction.
+
+    If the `headers` of the RPMs are not provided, are read from the
+    RPM files.  Return the header of every RPM, the new manifest
+    records and the list of paths that were extracted.
+    """
+    old_records = {record['rpm']: record
+                   for record in _read_manifest(dest_dir)}
+    if headers is None:
+        headers = {package: _read_header(package) for package in packages}
+
+    kept = {}
+    for package in packages:
+        record = old_records.get(os.path.basename(package))
+        if record and record['digest'] == headers[package].digest:
+            kept[package] = record
+    kept_rpms = set(record['rpm'] for record in kept.values())
+    stale = [record for rpm, record in old_records.items()
+             if rpm not in kept_rpms]
+
+    # Files that are not as a full extraction would leave them
+    written = set(itertools.chain.from_iterable(
+        record['files'] for record in stale))
+    to_extract = []
+    for package in packages:
+        if package not in kept:
+            to_extract.append(package)
+            written.update(file_.path for file_ in headers[package].files()
+                           if not stat.S_ISDIR(file_.mode or 0))
+        elif written.intersection(kept[package]['files']):
+            to_extract.append(package)
+            written.update(kept[package]['files'])
+
+    print('Updating %d of %d packages' % (len(to_extract), len(packages)))
+    extracted = _extract_packages(to_extract, dest_dir, jobs, cache, stats,
+                                  path_filter)
+
+    records = []
+    for package in packages:
+        if package in extracted:
+            header, paths = extracted[package]
+            records.append(_manifest_record(package, header, paths))
+        else:
+            records.append(kept[package])
+
+    # Remove the files and directories that no RPM own anymore
+    files = set(itertools.chain.from_iterable(
+        record['files'] for record in records))
+    dirs = set(itertools.chain.from_iterable(
+        record['dirs'] for record in records))
+    for record in stale:
+        for path in set(record['files']) - files:
+            for name in _installed_paths(path):
+                name = os.path.join(dest_dir, name)
+                if os.path.lexists(name) and not os.path.isdir(name):
+                    os.unlink(name)
+                    if name.endswith('.py'):
+                        _remove_compiled(name)
+    orphan_dirs = set(itertools.chain.from_iterable(
+        record['dirs'] for record in stale)) - dirs
+    for path in sorted(orphan_dirs, key=len, reverse=True):
+        try:
+            os.rmdir(os.path.join(dest_dir, path))
+        except OSError:
+            # Not empty, or not a directory
+            pass
+
+    paths = sorted(set(itertools.chain.from_iterable(
+        paths for _, paths in extracted.values())))
+    return headers, records, paths
+
+
+def _remove_compiled(name):
+    """Remove the byte-compiled files of a removed Python module.
+
+    Python 2 can import a `.pyc` next to the source even without it,
+    and the `__pycache__` entries (for any interpreter) are useless.
+    """
+    root, module = os.path.split(name[:-len('.py')])
+    cache_dir = os.path.join(root, '__pycache__')
+    compiled = [name + 'c', name + 'o']
+    compiled.extend(glob.glob(os.path.join(glob.escape(cache_dir),
+                                           glob.escape(module) + '.*.py[co]')))
+    for filename in compiled:
+        if os.path.lexists(filename):
+            os.unlink(filename)
+    try:
+        os.rmdir(cache_dir)
+    except OSError:
+        # Not empty, or not present
+        pass
+
+
+class BuildStats():
+    """Time and resources used by each phase of a build, and by each RPM.
+
+    For every phase it records the wall and CPU time (of the process
+    and of the finished children), the bytes written by the process,
+    the files touched, the peak RSS (in KiB) during the phase, and the
+    maximum RSS of the process and of its children so far.  The peak
+    RSS of the phase is None when the kernel cannot reset it, or when
+    `peak_rss` is False because other builds share the process.
+    """
+    def __init__(self, peak_rss=True):
+        self.phases = []
+        self.packages = {}
+        self.peak_rss = peak_rss
+        self._start = self._sample()
+
+    @staticmethod
+    def _sample():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        written = None
+        try:
+            with open('/proc/self/io') as f:
+                for line in f:
+                    if line.startswith('wchar:'):
+                        written = int(line.split()[1])
+        except IOError:
+            pass
+        return {
+            'wall': time.monotonic(),
+            'cpu': time.process_time(),
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'bytes_written': written,
+        }
+
+    @staticmethod
+    def _delta(start, end):
+        delta = {}
+        for key, value in end.items():
+            if value is None or start[key] is None:
+                delta[key] = None
+            else:
+                delta[key] = value - start[key]
+        delta['max_rss'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        delta['children_max_rss'] = resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss
+        return delta
+
+    @staticmethod
+    def _reset_peak_rss():
+        """Reset the peak RSS of the process (VmHWM), if possible."""
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except IOError:
+            return False
+        return True
+
+    @staticmethod
+    def _peak_rss():
+        """Return the peak RSS of the process since the last reset."""
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except IOError:
+            pass
+        return None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager to measure a phase.
+
+        The yielded dictionary can be used to store the number of
+        files touched (`files`) or any other detail of the phase.
+        """
+        record = {'name': name, 'files': None}
+        # The reset is for the whole process
+        reset = self.peak_rss and self._reset_peak_rss()
+        start = self._sample()
+        try:
+            yield record
+        finally:
+            record.update(self._delta(start, self._sample()))
+            record['peak_rss'] = self._peak_rss() if reset else None
+            self.phases.append(record)
+
+    def add_package(self, package, wall, cpu, header, paths):
+        """Record the extraction of a RPM."""
+        sizes = {file_.path: file_.size for file_ in header.files()
+                 if stat.S_ISREG(file_.mode or 0)}
+        self.packages[os.path.basename(package)] = {
+            'wall': wall,
+            'cpu': cpu,
+            'files': len(paths),
+            'bytes': sum(sizes.get(path) or 0 for path in paths),
+        }
+
+    def as_dict(self):
+        return {
+            'phases': self.phases,
+            'packages': self.packages,
+            'total': self._delta(self._start, self._sample()),
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+def _timed(func, *args):
+    """Call a function, and return the result, the wall and CPU time.
+
+    The CPU time is the one used by the current thread.
+    """
+    wall, cpu = time.monotonic(), time.thread_time()
+    result = func(*args)
+    return result, time.monotonic() - wall, time.thread_time() - cpu
+
+
+class VirtualenvTemplates():
+    """Cache of virtualenv skeletons, ready to be cloned.
+
+    A skeleton only depends on the Python interpreter, the version of
+    virtualenv and the options used, that together form the key of
+    the template.  Every template stores the path where it was
+    created, that is re-pointed to the new location when cloned.
+    """
+    def __init__(self, path):
+        self.path = os.path.join(path, 'templates')
+        self._keys = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def _fingerprint(command, version):
+        """Identify an executable by its path, stat and version."""
+        path = shutil.which(command)
+        if not path:
+            return None
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        try:
+            output = subprocess.check_output(
+                [path] + version, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return [path, st.st_size, st.st_mtime,
+                output.decode('utf-8').strip()]
+
+    def key(self, options):
+        """Return the key for a template, or None if it cannot be used."""
+        # Versions are only asked once per process
+        if None not in self._keys:
+            self._keys[None] = [
+                self._fingerprint('python2.7', ['--version']),
+                self._fingerprint('virtualenv', ['--version']),
+            ]
+        interpreter, virtualenv = self._keys[None]
+        if not interpreter or not virtualenv:
+            return None
+        key = json.dumps([interpreter, virtualenv, options])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def template(self, options):
+        """Return the directory and path of a template, creating it."""
+        with self._lock:
+            key = self.key(options)
+            if not key:
+                return None, None
+            entry = os.path.join(self.path, key)
+            if not os.path.isdir(entry) and not self._add(options, entry):
+                return None, None
+        with open(os.path.join(entry, 'template.json')) as f:
+            template = json.load(f)
+        return os.path.join(entry, 'venv'), template['path']
+
+    def _add(self, options, entry):
+        """Create a new template."""
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        venv = os.path.join(tmp_entry, 'venv')
+        try:
+            if _run_virtualenv(options, venv):
+                print('ERROR: cannot create the virtualenv template')
+                return False
+            _add_usr_links(venv)
+            with open(os.path.join(tmp_entry, 'template.json'), 'w') as f:
+                json.dump({'path': venv, 'options': options}, f)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # Other process added the same template meanwhile
+                if not os.path.isdir(entry):
+                    raise
+            return True
+        finally:
+            _rmtree(tmp_entry, ignore_errors=True)
+
+    def clone(self, options, dest_dir):
+        """Clone a template into `dest_dir`, or return False."""
+        venv, origin = self.template(options)
+        if not venv:
+            return False
+        dest_dir = os.path.abspath(dest_dir)
+        repoint = (origin.encode('utf-8'), dest_dir.encode('utf-8'))
+        directories = []
+        for root, dirs, files in os.walk(venv):
+            relative = os.path.relpath(root, venv)
+            dest_root = os.path.normpath(os.path.join(dest_dir, relative))
+            os.makedirs(dest_root, exist_ok=True)
+            directories.append((root, dest_root))
+            for name in list(dirs) + files:
+                src = os.path.join(root, name)
+                dest = os.path.join(dest_root, name)
+                if os.path.islink(src):
+                    link = os.readlink(src)
+                    if link.startswith(origin):
+                        link = dest_dir + link[len(origin):]
+                    os.symlink(link, dest)
+                elif name in files:
+                    path = os.path.normpath(os.path.join(relative, name))
+                    self._place(src, dest, path, repoint)
+        for root, dest_root in reversed(directories):
+            shutil.copystat(root, dest_root)
+        return True
+
+    @staticmethod
+    def _place(src, dest, path, repoint):
+        """Copy the files that can be modified, link the rest."""
+        if (path.startswith('bin' + os.sep)
+           or RPMCache._is_rewritten(path, src)):
+            with open(src, 'rb') as f:
+                data = f.read()
+            # Only the text files are re-pointed
+            if b'\0' not in data:
+                data = data.replace(*repoint)
+            with open(dest, 'wb') as f:
+                f.write(data)
+            shutil.copystat(src, dest)
+            return
+        try:
+            os.link(src, dest)
+        except OSError:
+            try:
+                _reflink(src, dest)
+            except OSError:
+                shutil.copy2(src, dest)
+
+
+def _virtualenv_options(args):
+    """Return the options used to call virtualenv."""
+    options = []
+    if args.system_site_packages:
+        options.append('--system-site-packages')
+    # Make sure that we generate a Python 2.7 environment
+    options.append('--python=python2.7')
+    return options
+
+
+def _run_virtualenv(options, dest_dir):
+    """Call virtualenv and return the exit code."""
+    return subprocess.call('virtualenv %s %s' % (' '.join(options),
+                                                  dest_dir),
+                           shell=True)
+
+
+def _add_usr_links(dest_dir):
+    """Prepare the links for /usr/bin and /usr/lib[64]."""
+    usr = os.path.join(dest_dir, 'usr')
+    os.mkdir(usr)
+    os.symlink('../bin', os.path.join(usr, 'bin'))
+    os.symlink('../lib', os.path.join(usr, 'lib'))
+    os.symlink('../lib', os.path.join(usr, 'lib64'))
+
+
+def _venv_path(path):
+    """Return where a path of a RPM is in the venv, after the /usr links."""
+    for prefix, target in (('usr/bin/', 'bin/'), ('usr/lib/', 'lib/'),
+                           ('usr/lib64/', 'lib/')):
+        if path.startswith(prefix):
+            return target + path[len(prefix):]
+    return path
+
+
+def _create_virtualenv(args, templates=None):
+    """Create the virtual environment, with the links for /usr."""
+    options = _virtualenv_options(args)
+    if templates and templates.clone(options, args.dest_dir):
+        return
+    _run_virtualenv(options, args.dest_dir)
+    _add_usr_links(args.dest_dir)
+
+
+# External compressors used for the archives, that can use all the
+# cores.  If not found, the standard library is used instead.
+ARCHIVE_COMPRESSORS = (
+    (('.tar.zst', '.tzst'), ['zstd', '-T0', '-q', '-c']),
+    (('.tar.xz', '.txz'), ['xz', '-T0', '-c']),
+    (('.tar.gz', '.tgz'), None),
+    (('.tar',), None),
+)
+
+
+@contextlib.contextmanager
+def _compressed(filename):
+    """Open `filename` for writing, compressed by its extension."""
+    for extensions, command in ARCHIVE_COMPRESSORS:
+        if filename.endswith(extensions):
+            break
+    else:
+        raise ValueError('Unknown archive format for %s' % filename)
+    extension = extensions[0]
+
+    with open(filename, 'wb') as f:
+        if command and shutil.which(command[0]):
+            process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=f)
+            try:
+                yield process.stdin
+            finally:
+                process.stdin.close()
+                if process.wait():
+                    raise IOError('%s failed' % command[0])
+        elif extension == '.tar.zst':
+            if not zstandard:
+                raise ImportError('zstd or zstandard are required for %s'
+                                  % filename)
+            compressor = zstandard.ZstdCompressor(threads=-1)
+            with compressor.stream_writer(f) as stream:
+                yield stream
+        elif extension == '.tar.xz':
+            with lzma.LZMAFile(f, 'wb') as stream:
+                yield stream
+        elif extension == '.tar.gz':
+            # Without the name and mtime of the archive, to be
+            # reproducible
+            with gzip.GzipFile(filename='', fileobj=f, mode='wb',
+                               mtime=0) as stream:
+                yield stream
+        else:
+            yield f
+
+
+def _late_paths(dest_dir, byte_compile=False):
+    """Return the patterns of the paths changed after the fixups.
+
+    The patterns are prefixed by `dest_dir`, like the paths visited
+    by the fixups.
+    """
+    paths = [os.path.join(dest_dir, 'packages.log')]
+    if byte_compile:
+        paths.append(os.path.join(dest_dir, '*.pyc'))
+    # META-INF is completed at the end, the activators are rewritten
+    # and the services renamed
+    real_dest_dir = os.path.realpath(dest_dir)
+    for directory, name in (('META-INF', '*'), ('bin', 'activate*'),
+                            ('usr/lib/systemd/system', '*')):
+        directory = os.path.relpath(
+            os.path.realpath(os.path.join(dest_dir, directory)),
+            real_dest_dir)
+        if directory.startswith('..'):
+            continue
+        paths.append(os.path.join(dest_dir, directory, name))
+    return paths
+
+
+def _payload_mtime(dest_dir, repo):
+    """Return the newest modification time of the files of the RPMs.
+
+    It is the same for every build of the same RPMs, and is used to
+    clamp the times of the files created or fixed by the build.
+    """
+    mtime = None
+    for record in _read_manifest(dest_dir):
+        package = os.path.join(repo, record['rpm'])
+        if not os.path.exists(package):
+            continue
+        mtimes = _read_header(package).get(RPMTAG_FILEMTIMES) or []
+        if mtimes:
+            mtime = max(mtime or 0, max(mtimes))
+    return mtime
+
+
+class ArchiveWriter():
+    """Reproducible tar archive of a venv, written during the build.
+
+    The paths (prefixed by `dest_dir`) are written by `add()` as soon
+    as they are final, so the venv is not read again after the build.
+    The paths still changed by the build are left in `pending`, and
+    are written sorted by `close()`.  The entries are owned by root,
+    and the modification times newer than `mtime` are clamped.
+    """
+    def __init__(self, dest_dir, filename, mtime=None):
+        self.dest_dir = os.path.normpath(dest_dir)
+        self.filename = filename
+        self.mtime = mtime
+        self.pending = set()
+        self.written = set()
+        self.top = os.path.basename(self.dest_dir)
+        self._stack = contextlib.ExitStack()
+        stream = self._stack.enter_context(_compressed(filename))
+        self.tar = self._stack.enter_context(tarfile.open(
+            fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stack.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None and os.path.exists(self.filename):
+            # Do not leave an incomplete archive behind
+            os.unlink(self.filename)
+
+    def add(self, path):
+        """Write `path`, after its parent directories."""
+        path = os.path.normpath(path)
+        if path in self.written or not os.path.lexists(path):
+            return
+        if path != self.dest_dir:
+            self.add(os.path.dirname(path) or os.curdir)
+        self.written.add(path)
+        arcname = os.path.normpath(
+            os.path.join(self.top, os.path.relpath(path, self.dest_dir)))
+        info = self.tar.gettarinfo(path, arcname=arcname)
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        info.mtime = int(info.mtime)
+        if self.mtime is not None:
+            info.mtime = min(info.mtime, self.mtime)
+        if info.isreg():
+            with open(path, 'rb') as f:
+                self.tar.addfile(info, f)
+        else:
+            self.tar.addfile(info)
+
+    def close(self):
+        """Write the pending paths, and return the number of entries."""
+        self.add(self.dest_dir)
+        for path in sorted(self.pending):
+            self.add(path)
+        self.pending.clear()
+        self._stack.close()
+        return len(self.written)
+
+
+def _select_packages(args, index=None, stats=None):
+    """Select the RPMs from the repository, like `create` does.
+
+    Return the included and excluded RPMs, the full path of the
+    included ones, the reason of every decision and the requirements
+    not resolved by the closure of the root packages.
+    """
+    stats = stats or BuildStats()
+    # If both are populated, the algorithm will take precedence over
+    # the `exclude` list
+    include = _file_list(args.include)
+    exclude = _file_list(args.exclude)
+
+    names = index.names() if index else {}
+
+    # Select the packages, and record the reasons for the log
+    included = []
+    excluded = []
+    packages = []
+    # Rule that decided the inclusion or exclusion of every package
+    reasons = {}
+    for package in glob.glob(os.path.join(args.repo, '*.rpm')):
+        rpm = os.path.basename(package)
+        # The rules can be matched against the real name of the
+        # package instead of the file name
+        name = rpm
+        if args.match_name:
+            name = names.get(rpm) or _read_header(package).get(RPMTAG_NAME)
+        rule = exclude.match(name)
+        if rule is not None:
+            excluded.append(rpm)
+            reasons[rpm] = 'exclude: %s' % rule
+            continue
+        if include.is_populated():
+            rule = include.match(name)
+            if rule is None:
+                excluded.append(rpm)
+                reasons[rpm] = 'not included'
+                continue
+            reasons[rpm] = 'include: %s' % rule
+        else:
+            reasons[rpm] = 'include list is empty'
+        included.append(rpm)
+        packages.append(os.path.abspath(package))
+
+    # Reduce the selection to the closure of the root packages
+    unresolved = {}
+    if args.root:
+        with stats.phase('closure') as phase:
+            if index:
+                candidates = {rpm: index.header(rpm) for rpm in included}
+            else:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max(args.jobs, 1)) as pool:
+                    candidates = dict(zip(included, pool.map(
+                        _read_header, packages)))
+            closure, unresolved = _closure(candidates, args.root)
+            phase['files'] = len(closure)
+        for rpm, package in list(zip(included, packages)):
+            if rpm in closure:
+                reasons[rpm] = '%s, %s' % (reasons[rpm], closure[rpm])
+            else:
+                included.remove(rpm)
+                packages.remove(package)
+                excluded.append(rpm)
+                reasons[rpm] = '%s, not required' % reasons[rpm]
+
+    return included, excluded, packages, reasons, unresolved
+
+
+def create(args, cache=None, templates=None, shared=False):
+    """Function called for the `create` command.
+
+    The RPM `cache` and the virtualenv `templates` can be shared with
+    other builds.  If `shared` is True the build runs together with
+    others in the process, that already refreshed the index, and the
+    peak RSS of the phases is not measured.
+    """
+    if _warm and args.cache_dir:
+        cache = cache or _warm.cache(args.cache_dir,
+                                     args.cache_size * 1024 * 1024)
+        templates = templates or _warm.template(args.cache_dir)
+    stats = BuildStats(peak_rss=not shared)
+    build_stats = os.path.join(args.dest_dir, 'META-INF', 'build-stats.json')
+    with contextlib.ExitStack() as stack:
+        archive = None
+        if args.archive:
+            mtime = args.archive_mtime
+            if mtime is None and 'SOURCE_DATE_EPOCH' in os.environ:
+                mtime = int(os.environ['SOURCE_DATE_EPOCH'])
+            archive = stack.enter_context(ArchiveWriter(
+                args.dest_dir, args.archive, mtime))
+        if args.profile:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(_create, args, stats, cache, templates,
+                                archive, not shared)
+            finally:
+                profile.dump_stats(args.profile)
+        else:
+            _create(args, stats, cache, templates, archive, not shared)
+
+        if archive:
+            with stats.phase('archive') as phase:
+                if args.update:
+                    # Only the updated paths were visited by the fixups
+                    if archive.mtime is None:
+                        archive.mtime = _payload_mtime(args.dest_dir,
+                                                       args.repo)
+                    archive.pending.update(
+                        entry.path for entry in _scan(args.dest_dir))
+                else:
+                    # The paths created after the traversal
+                    for path in _late_paths(args.dest_dir,
+                                            args.byte_compile):
+                        archive.pending.update(glob.glob(path))
+                # The statistics are different for every build, and
+                # are not part of the reproducible archive
+                archive.pending.discard(build_stats)
+                phase['files'] = archive.close()
+
+    stats.write(build_stats)
+
+
+def _create(args, stats, cache=None, templates=None, archive=None,
+            refresh_index=True):
+    """Create or update the venv, measuring each phase in `stats`.
+
+    When creating the venv, the entries are written into the
+    `archive`, if provided, during the traversal of the fixups.  The
+    index is refreshed before use if `refresh_index` is True.
+    """
+    # Create the virtual environment, if we are not updating an
+    # existing one
+    if templates is None and args.cache_dir:
+        templates = VirtualenvTemplates(args.cache_dir)
+    if not args.update:
+        with stats.phase('virtualenv'):
+            _create_virtualenv(args, templates)
+
+    index = None
+    if args.index:
+        index = RPMIndex(args.index)
+        if refresh_index:
+            index.refresh(args.repo)
+    included, excluded, packages, reasons, unresolved = _select_packages(
+        args, index, stats)
+
+    # With the index we can detect the conflicts before the extraction
+    if index:
+        for path, rpms in index.conflicts(included):
+            print('WARNING: %s is different in %s' % (path, ', '.join(rpms)))
+
+    if cache is None and args.cache_dir:
+        cache = RPMCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    path_filter = PathFilter(args.exclude_path)
+    with stats.phase('extract') as phase:
+        if args.update:
+            headers = None
+            if index:
+                headers = {package: index.header(os.path.basename(package))
+                           for package in packages}
+            headers, records, paths = _update_packages(
+                packages, args.dest_dir, args.jobs, cache, headers, stats,
+                path_filter)
+            phase['files'] = len(paths)
+        else:
+            extracted = _extract_packages(packages, args.dest_dir,
+                                          args.jobs, cache, stats,
+                                          path_filter)
+            headers = {package: header
+                       for package, (header, _) in extracted.items()}
+            records = [_manifest_record(package, *extracted[package])
+                       for package in packages]
+            paths = None
+            phase['files'] = sum(len(extracted_paths) for
+                                 _, extracted_paths in extracted.values())
+
+    with stats.phase('meta_inf') as phase:
+        add_meta_inf(args.dest_dir, args.version, args.ardana_version)
+        # Record the files installed by each package, used by
+        # `--update`
+        _write_manifest(args.dest_dir, records)
+        phase['files'] = 3
+
+    # The archive is only written by the fixups when the whole venv
+    # is visited, clamping the times to the ones of the payloads
+    if archive and paths is None:
+        if archive.mtime is None:
+            archive.mtime = _payload_mtime(args.dest_dir, args.repo)
+    else:
+        archive = None
+    _fix_virtualenv(args.dest_dir, args.relocate,
+                    args.no_relocate_shebang_list, paths, stats,
+                    args.byte_compile, archive)
+    with stats.phase('record_fixed') as phase:
+        phase['files'] = _record_fixed(args.dest_dir, records, headers)
+        _write_manifest(args.dest_dir, records)
+
+    # Write the log file, useful to better taylor the inclusion /
+    # exclusion of packages.
+    with stats.phase('packages_log') as phase, \
+            open(os.path.join(args.dest_dir, 'packages.log'), 'w') as f:
+        phase['files'] = 1
+        print('# Included packages', file=f)
+        for rpm in sorted(included):
+            print('%s  # %s' % (rpm, reasons[rpm]), file=f)
+        print('\n\n# Excluded packages', file=f)
+        for rpm in sorted(excluded):
+            print('%s  # %s' % (rpm, reasons[rpm]), file=f)
+        if path_filter.skipped:
+            print('\n\n# Paths excluded from the packages', file=f)
+            for rule, (files, size) in sorted(path_filter.skipped.items()):
+                print('%s  # %d files, %d bytes' % (rule, files, size),
+                      file=f)
+        if unresolved:
+            print('\n\n# Requirements not provided by the included '
+                  'packages', file=f)
+            for name in sorted(unresolved):
+                print('%s  # %s' % (name, ', '.join(unresolved[name])),
+                      file=f)
+        print('\n\n# Files fixed after the extraction', file=f)
+        for name, files in _fixed_files(stats):
+            print('%s  # %d files' % (name, files), file=f)
+
+    # Write the L3/Maintenance track file, required to track the
+    # content of the venv inside OBS.  The records are taken from the
+    # headers read during the extraction.
+    headers = {os.path.basename(package): header
+               for package, header in headers.items()}
+    with stats.phase('track') as phase, open(args.track, 'w') as f:
+        phase['files'] = 1
+        for rpm in sorted(included):
+            print(_track_record(headers[rpm]), file=f)
+
+
+def index(args):
+    """Function called for the `index` command."""
+    rpm_index = RPMIndex(args.index)
+    rpm_index.refresh(args.repo)
+    print('%d packages indexed' % len(rpm_index.names()))
+
+
+# Options of `create` that `create-many` sets for all the builds
+CREATE_MANY_SHARED = ('repo', 'index', 'jobs', 'cache_dir', 'cache_size')
+
+
+def create_many(args):
+    """Function called for the `create-many` command.
+
+    The venvs from the manifest are built together, sharing the RPM
+    cache (so every payload is extracted only once), the virtualenv
+    templates and the index.  The jobs are divided between the builds
+    that run at the same time.
+
+    The builds run in the same process, so the CPU time, the bytes
+    written and the maximum RSS in the `build-stats.json` of every
+    venv include the ones of the other builds running at the same
+    time.  The peak RSS is only reported for the whole run.
+    """
+    with open(args.manifest) as f:
+        entries = json.load(f)
+
+    builds = []
+    for entry in entries:
+        build = args.create_parser.parse_args([entry['dest_dir']])
+        for key, value in entry.items():
+            if not hasattr(build, key):
+                raise ValueError('Unknown option %s in %s' % (key,
+                                                            args.manifest))
+            if key in CREATE_MANY_SHARED:
+                raise ValueError('Option %s in %s is shared by all the '
+                                 'venvs, use the command line'
+                                 % (key, args.manifest))
+            setattr(build, key, value)
+        if not build.track:
+            build.track = '%s.track' % os.path.normpath(build.dest_dir)
+        build.repo = args.repo
+        build.index = args.index
+        builds.append(build)
+    if not builds:
+        return 0
+
+    # The index is refreshed only once, and later only read
+    if args.index:
+        RPMIndex(args.index).refresh(args.repo)
+    reset = BuildStats._reset_peak_rss()
+
+    cache_dir = args.cache_dir
+    if not cache_dir:
+        # Near the venvs, so the files can be hard linked
+        cache_dir = tempfile.mkdtemp(
+            prefix='.venvjail-cache-',
+            dir=os.path.dirname(os.path.abspath(builds[0].dest_dir)))
+    try:
+        cache = RPMCache(cache_dir, args.cache_size * 1024 * 1024)
+        templates = VirtualenvTemplates(cache_dir)
+        workers = min(len(builds), max(args.jobs, 1))
+        for build in builds:
+            build.cache_dir = cache_dir
+            build.jobs = max(args.jobs // workers, 1)
+
+        def _build(build):
+            create(build, cache, templates, shared=True)
+            return build.dest_dir
+
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(_build, build): build
+                       for build in builds}
+            for future in concurrent.futures.as_completed(futures):
+                dest_dir = futures[future].dest_dir
+                try:
+                    future.result()
+                    print('%s: created' % dest_dir)
+                except Exception as e:
+                    print('ERROR: %s: %s' % (dest_dir, e))
+                    failed += 1
+    finally:
+        if not args.cache_dir:
+            _rmtree(cache_dir, ignore_errors=True)
+    peak_rss = BuildStats._peak_rss() if reset else None
+    if peak_rss is None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%d venvs created, peak RSS %d KiB' % (len(builds) - failed,
+                                                 peak_rss))
+    return 1 if failed else 0
+
+
+def _conflicts(headers):
+    """Return the files that are different in several RPMs.
+
+    The same as `RPMIndex.conflicts()`, but from the `headers` of the
+    RPMs, a dictionary indexed by RPM name.
+    """
+    files = collections.defaultdict(list)
+    for rpm in sorted(headers):
+        for file_ in headers[rpm].files():
+            if stat.S_ISDIR(file_.mode or 0):
+                continue
+            files[file_.path].append(
+                (rpm, (file_.mode, file_.digest, file_.linkto)))
+    return [(path, sorted(rpm for rpm, _ in owners))
+            for path, owners in sorted(files.items())
+            if len(set(value for _, value in owners)) > 1]
+
+
+def _is_python_script(class_):
+    """Check if a file class is the one of a Python script.
+
+    file(1) describes a file that starts with `#!INTERPRETER` as "a
+    INTERPRETER script", so this is the check of `_relocate_shebang()`
+    (a `#!` line with `python`) without reading the payload.  Python
+    modules without shebang are "Python script" and are not matched.
+    """
+    match = re.match(r'a (\S+(?: \S+)?) script', class_)
+    return bool(match) and 'python' in match.group(1)
+
+
+def _plan(args):
+    """Compute the result of `create`, from the RPM headers alone."""
+    index = None
+    if args.index:
+        index = RPMIndex(args.index)
+        index.refresh(args.repo)
+    included, excluded, packages, reasons, unresolved = _select_packages(
+        args, index)
+    if index:
+        headers = {rpm: index.header(rpm) for rpm in included}
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(args.jobs, 1)) as pool:
+            headers = dict(zip(included, pool.map(_read_header, packages)))
+
+    path_filter = PathFilter(args.exclude_path)
+    # Last RPM wins, like in the extraction
+    installed = {}
+    for rpm in included:
+        header = headers[rpm]
+        classes = header.classes() or itertools.repeat('')
+        for file_, class_ in zip(header.files(), classes):
+            mode = file_.mode or 0
+            size = file_.size if stat.S_ISREG(mode) else 0
+            if path_filter.excluded(file_.path, size):
+                continue
+            installed[file_.path] = (mode, size, file_.linkto, class_)
+
+    files = size = 0
+    scripts = []
+    alternatives = []
+    for path, (mode, file_size, linkto, class_) in sorted(installed.items()):
+        if stat.S_ISREG(mode):
+            files += 1
+            size += file_size
+            name = os.path.join(args.dest_dir, _venv_path(path))
+            if (_is_python_script(class_)
+               and not any(fnmatch.fnmatch(name, pattern) for pattern
+                           in args.no_relocate_shebang_list)):
+                scripts.append(path)
+        elif stat.S_ISLNK(mode) and linkto and 'alternatives' in linkto:
+            alternatives.append(path)
+
+    conflicts = (index.conflicts(included) if index
+                 else _conflicts(headers))
+    # The excluded paths are never written
+    conflicts = [(path, rpms) for path, rpms in conflicts
+                 if path_filter.rules.match(path) is None]
+    return {
+        'included': {rpm: reasons[rpm] for rpm in included},
+        'excluded': {rpm: reasons[rpm] for rpm in excluded},
+        'files': files,
+        'size': size,
+        'skipped': {rule: {'files': skipped_files, 'size': skipped_size}
+                    for rule, (skipped_files, skipped_size)
+                    in path_filter.skipped.items()},
+        'scripts': scripts,
+        'alternatives': alternatives,
+        'conflicts': [{'path': path, 'rpms': rpms}
+                      for path, rpms in conflicts],
+        'unresolved': {name: rpms for name, rpms in unresolved.items()},
+    }
+
+
+def plan(args):
+    """Function called for the `plan` command."""
+    result = _plan(args)
+    if args.json:
+        json.dump(result, sys.stdout, indent=1, sort_keys=True)
+        print()
+        return
+
+    print('# Included packages (%d)' % len(result['included']))
+    for rpm, reason in sorted(result['included'].items()):
+        print('%s  # %s' % (rpm, reason))
+    print('\n# Excluded packages (%d)' % len(result['excluded']))
+    for rpm, reason in sorted(result['excluded'].items()):
+        print('%s  # %s' % (rpm, reason))
+    print('\n# Summary')
+    print('Files: %d' % result['files'])
+    print('Size: %d bytes' % result['size'])
+    for rule, skipped in sorted(result['skipped'].items()):
+        print('Excluded path %s: %d files, %d bytes' % (
+            rule, skipped['files'], skipped['size']))
+    print('Scripts to relocate: %d' % len(result['scripts']))
+    print('Alternatives links: %d' % len(result['alternatives']))
+    for path in result['alternatives']:
+        print('  %s' % path)
+    print('Conflicts: %d' % len(result['conflicts']))
+    for conflict in result['conflicts']:
+        print('  %s: %s' % (conflict['path'], ', '.join(conflict['rpms'])))
+    if result['unresolved']:
+        print('Unresolved requirements: %d' % len(result['unresolved']))
+        for name, rpms in sorted(result['unresolved'].items()):
+            print('  %s: %s' % (name, ', '.join(rpms)))
+
+
+# Hash algorithms used for the file digests (RPMTAG_FILEDIGESTALGO)
+RPM_DIGEST_ALGORITHMS = {
+    1: 'md5',
+    2: 'sha1',
+    8: 'sha256',
+    9: 'sha384',
+    10: 'sha512',
+    11: 'sha224',
+}
+
+# Buffer used to hash the files
+HASH_BUFFER_SIZE = 1 << 20
+
+
+def _hash_file(filename, algorithm):
+    """Return the hex digest of a file."""
+    digest = hashlib.new(algorithm)
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            # hashlib releases the GIL for big buffers
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def _expected_change(path, name, file_, st, fixed, relocated):
+    """Check if a difference is produced by the fixups of `create`.
+
+    The links are checked against the change made by the fixup, and
+    the files against the digest and mode recorded by `create` after
+    the fixups (in `fixed`).  Return the name of the fixup, or None if
+    the change is not expected.
+    """
+    if stat.S_ISLNK(st.st_mode) and file_.linkto:
+        link = os.readlink(name)
+        if ('alternatives' in file_.linkto and link.startswith(relocated)
+           and link.endswith(os.path.basename(path) + '-2.7')):
+            return 'alternatives'
+        if path.startswith('srv/') and file_.linkto.startswith('/'):
+            # Absolute links converted into relative ones
+            dest_dir = name[:-len(path)]
+            target = os.path.join(dest_dir, file_.linkto[1:])
+            if os.path.normpath(os.path.join(os.path.dirname(name),
+                                             link)) == target:
+                return 'broken-links'
+        return None
+    if path in fixed and stat.S_ISREG(st.st_mode):
+        digest, mode = fixed[path]
+        if (stat.S_IMODE(st.st_mode) == mode
+           and _hash_file(name, 'sha256') == digest):
+            return 'fixups'
+    return None
+
+
+def _verify_file(dest_dir, path, file_, algorithm, fixed, relocated):
+    """Compare a file of the venv with the RPM header.
+
+    Return None if it is as expected, or a description of the drift.
+    """
+    for installed in _installed_paths(path):
+        name = os.path.join(dest_dir, installed)
+        if os.path.lexists(name):
+            break
+    else:
+        return 'missing'
+    if installed != path:
+        # Renamed (and rewritten) by `_fix_systemd_services`
+        st = os.lstat(name)
+        if _expected_change(installed, name, file_, st, fixed, relocated):
+            return None
+        return 'renamed file changed'
+    st = os.lstat(name)
+    mode = file_.mode or 0
+    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+        return 'type changed'
+    if stat.S_ISLNK(mode):
+        if os.readlink(name) == file_.linkto:
+            return None
+        problem = 'link changed'
+    elif stat.S_ISREG(mode):
+        if stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode):
+            problem = 'mode changed'
+        elif st.st_size != file_.size:
+            problem = 'size changed'
+        elif file_.digest and _hash_file(name, algorithm) != file_.digest:
+            problem = 'digest changed'
+        else:
+            return None
+    else:
+        return None
+    if _expected_change(path, name, file_, st, fixed, relocated):
+        return None
+    return problem
+
+
+def _verify(args):
+    """Verify the files of a venv against the headers of its RPMs.
+
+    Return a dictionary with the drift (a list of (path, problem)) of
+    every RPM.
+    """
+    index = RPMIndex(args.index) if args.index else None
+    if index:
+        index.refresh(args.repo)
+    drift = collections.OrderedDict()
+    # The last RPM that extracted a file is the one that set it
+    expected = {}
+    for record in _read_manifest(args.dest_dir):
+        rpm = record['rpm']
+        if index:
+            header = index.header(rpm)
+        else:
+            package = os.path.join(args.repo, rpm)
+            header = _read_header(package) if os.path.exists(package) else None
+        if not header:
+            drift[rpm] = [('', 'RPM not found')]
+            continue
+        if header.digest != record['digest']:
+            drift[rpm] = [('', 'RPM is not the one installed')]
+            continue
+        algorithm = RPM_DIGEST_ALGORITHMS.get(
+            (header.get(RPMTAG_FILEDIGESTALGO) or [1])[0], 'md5')
+        files = set(record['files'])
+        fixed = record.get('fixed', {})
+        for file_ in header.files():
+            if file_.path in files:
+                expected[file_.path] = (rpm, file_, algorithm, fixed)
+
+    def _check(item):
+        path, (rpm, file_, algorithm, fixed) = item
+        return rpm, path, _verify_file(args.dest_dir, path, file_, algorithm,
+                                       fixed, args.relocate)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(args.jobs, 1)) as pool:
+        for rpm, path, problem in pool.map(_check, sorted(expected.items())):
+            if problem:
+                drift.setdefault(rpm, []).append((path, problem))
+    return len(expected), drift
+
+
+def verify(args):
+    """Function called for the `verify` command."""
+    files, drift = _verify(args)
+    for rpm, problems in drift.items():
+        print('%s: %d files with drift' % (rpm, len(problems)))
+        for path, problem in problems:
+            print('  %s: %s' % (path, problem) if path else '  %s' % problem)
+    if drift:
+        print('ERROR: drift found in %d packages' % len(drift))
+        return 1
+    print('%d files verified' % files)
+    return 0
+
+
+# Commands that can be served by the daemon
+DAEMON_COMMANDS = ('create', 'include', 'binary', 'requires')
+
+# Version of the format of the delta artifacts
+DELTA_FORMAT = 1
+
+
+@contextlib.contextmanager
+def _decompressed(filename):
+    """Open a (compressed) tar archive for streamed reading."""
+    if not filename.endswith(('.tar.zst', '.tzst')):
+        with tarfile.open(filename, mode='r|*') as tar:
+            yield tar
+    elif shutil.which('zstd'):
+        process = subprocess.Popen(['zstd', '-q', '-dc', filename],
+                                   stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                yield tar
+        finally:
+            process.stdout.close()
+            process.wait()
+    elif zstandard:
+        with open(filename, 'rb') as f, \
+                zstandard.ZstdDecompressor().stream_reader(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|') as tar:
+            yield tar
+    else:
+        raise ImportError('zstd or zstandard are required for %s' % filename)
+
+
+def _tree_index(dest_dir):
+    """Return the stat of every path of a venv, relative to it."""
+    return {os.path.relpath(entry.path, dest_dir): entry.stat()
+            for entry in _scan(dest_dir)}
+
+
+def _file_value(dest_dir, path, st):
+    """Return what identifies the content of a path."""
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(os.path.join(dest_dir, path))
+    if stat.S_ISREG(st.st_mode):
+        return _hash_file(os.path.join(dest_dir, path), 'sha256')
+    return None
+
+
+def _delta(old_dir, new_dir, jobs=1):
+    """Compare two venvs.
+
+    The files are compared by type, mode and size, and only the
+    regular files with the same size (and that are not the same inode)
+    are hashed, in parallel.  Return the removed and the changed or
+    added paths, and the value (digest or link) in `old_dir` of the
+    removed and changed ones, used to check the base of the delta.
+    """
+    old = _tree_index(old_dir)
+    new = _tree_index(new_dir)
+    removed = sorted(set(old) - set(new))
+    added = set(new) - set(old)
+    changed = set()
+    candidates = []
+    for path in set(old) & set(new):
+        old_st, new_st = old[path], new[path]
+        if (stat.S_IFMT(old_st.st_mode) != stat.S_IFMT(new_st.st_mode)
+           or stat.S_IMODE(old_st.st_mode) != stat.S_IMODE(new_st.st_mode)):
+            changed.add(path)
+        elif stat.S_ISREG(old_st.st_mode):
+            if os.path.samestat(old_st, new_st):
+                continue
+            if old_st.st_size != new_st.st_size:
+                changed.add(path)
+            else:
+                candidates.append(path)
+        elif stat.S_ISLNK(old_st.st_mode):
+            candidates.append(path)
+
+    def _compare(path):
+        old_value = _file_value(old_dir, path, old[path])
+        return path, old_value, old_value != _file_value(new_dir, path,
+                                                         new[path])
+
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+        base = {}
+        for path, old_value, different in pool.map(_compare, candidates):
+            if different:
+                changed.add(path)
+                base[path] = old_value
+        todo = [path for path in sorted(changed) + removed
+                if path not in base]
+        base.update(zip(todo, pool.map(
+            lambda path: _file_value(old_dir, path, old[path]), todo)))
+    return removed, sorted(changed | added), base
+
+
+def delta(args):
+    """Function called for the `delta` command."""
+    removed, updated, base = _delta(args.old_dir, args.new_dir, args.jobs)
+
+    old_packages = set(record['rpm']
+                       for record in _read_manifest(args.old_dir))
+    new_packages = set(record['rpm']
+                       for record in _read_manifest(args.new_dir))
+    meta = {
+        'format': DELTA_FORMAT,
+        'old': os.path.basename(os.path.normpath(args.old_dir)),
+        'new': os.path.basename(os.path.normpath(args.new_dir)),
+        'packages': {
+            'removed': sorted(old_packages - new_packages),
+            'added': sorted(new_packages - old_packages),
+        },
+        'removed': removed,
+        'updated': updated,
+        'base': base,
+    }
+    data = json.dumps(meta, indent=1, sort_keys=True).encode('utf-8')
+
+    with _compressed(args.output) as stream, \
+            tarfile.open(fileobj=stream, mode='w|',
+                         format=tarfile.GNU_FORMAT) as tar:
+        info = tarfile.TarInfo('DELTA.json')
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+        for path in updated:
+            name = os.path.join(args.new_dir, path)
+            info = tar.gettarinfo(name, arcname=os.path.join('data', path))
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            if info.isreg():
+                with open(name, 'rb') as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+    print('%d packages added, %d removed' % (len(meta['packages']['added']),
+                                            len(meta['packages']['removed'])))
+    print('%d paths updated, %d removed' % (len(updated), len(removed)))
+
+
+def _clone_tree(src_dir, dest_dir):
+    """Copy a tree, hard linking the files."""
+    os.mkdir(dest_dir)
+    directories = [(src_dir, dest_dir)]
+    for root, dirs, files in os.walk(src_dir):
+        dest_root = os.path.join(dest_dir, os.path.relpath(root, src_dir))
+        for name in list(dirs) + files:
+            src = os.path.join(root, name)
+            dest = os.path.join(dest_root, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dest)
+            elif name in files:
+                try:
+                    os.link(src, dest)
+                except OSError:
+                    shutil.copy2(src, dest)
+            else:
+                os.mkdir(dest)
+                directories.append((src, dest))
+    for src, dest in directories:
+        shutil.copystat(src, dest)
+
+
+def _remove(name):
+    """Remove a file, link or directory tree."""
+    if os.path.isdir(name) and not os.path.islink(name):
+        _rmtree(name)
+    elif os.path.lexists(name):
+        os.unlink(name)
+
+
+def _apply_member(tar, member, dest_dir):
+    """Place a member of the delta in the new venv."""
+    path = os.path.normpath(member.name[len('data/'):])
+    if (not member.name.startswith('data/') or os.path.isabs(path)
+       or path.split(os.sep)[0] in ('.', '..')):
+        raise ValueError('Invalid path in the delta: %s' % member.name)
+    name = os.path.join(dest_dir, path)
+    if member.isdir():
+        if not os.path.isdir(name) or os.path.islink(name):
+            _remove(name)
+            os.makedirs(name)
+        os.chmod(name, member.mode)
+        return
+    # Never write over the old file, as it is hard linked with the
+    # installed venv
+    _remove(name)
+    os.makedirs(os.path.dirname(name), exist_ok=True)
+    if member.issym():
+        os.symlink(member.linkname, name)
+        return
+    if member.islnk():
+        # Hard link to a file placed before from the delta (like the
+        # ones created by %fdupes)
+        target = os.path.normpath(member.linkname[len('data/'):])
+        if (not member.linkname.startswith('data/')
+           or os.path.isabs(target)
+           or target.split(os.sep)[0] in ('.', '..')):
+            raise ValueError('Invalid link in the delta: %s'
+                             % member.linkname)
+        os.link(os.path.join(dest_dir, target), name)
+        return
+    if not member.isreg():
+        raise ValueError('Unsupported entry in the delta: %s' % member.name)
+    with tar.extractfile(member) as src, open(name, 'wb') as dest:
+        shutil.copyfileobj(src, dest, HASH_BUFFER_SIZE)
+    os.chmod(name, member.mode)
+    os.utime(name, (member.mtime, member.mtime))
+
+
+# Flags for renameat2(2), from linux/fs.h
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def _exchange(src, dest):
+    """Atomically swap two directories.
+
+    Use renameat2(2) with RENAME_EXCHANGE, and if it is not supported
+    (by the libc or the filesystem) rename `dest` out of the way
+    first, so there is a short window without `dest`.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 and renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD,
+                               os.fsencode(dest), RENAME_EXCHANGE) == 0:
+        return
+    backup = src + '.old'
+    os.rename(dest, backup)
+    try:
+        os.rename(src, dest)
+    except OSError:
+        os.rename(backup, dest)
+        raise
+    os.rename(backup, src)
+
+
+def apply(args):
+    """Function called for the `apply` command.
+
+    The delta is applied over a hard linked copy of the installed
+    venv, and the result is created with the name of the new venv
+    with a rename, or is exchanged with the installed venv (see
+    `_exchange()`), so the venv is never seen half updated.
+    """
+    venv = os.path.normpath(args.venv)
+    parent = os.path.dirname(os.path.abspath(venv))
+    with _decompressed(args.delta) as tar:
+        member = tar.next()
+        if not member or member.name != 'DELTA.json':
+            raise ValueError('%s is not a venvjail delta' % args.delta)
+        meta = json.loads(tar.extractfile(member).read().decode('utf-8'))
+        if meta['format'] != DELTA_FORMAT:
+            raise ValueError('Unsupported delta format %s' % meta['format'])
+
+        # Check that the venv is the base of the delta
+        old = _tree_index(venv)
+        mismatch = [path for path, value in sorted(meta['base'].items())
+                    if path not in old
+                    or _file_value(venv, path, old[path]) != value]
+        if mismatch:
+            for path in mismatch:
+                print('ERROR: %s is not as in %s' % (path, meta['old']))
+            return 1
+
+        output = args.output or os.path.join(parent, meta['new'])
+        staging = tempfile.mkdtemp(prefix='.venvjail-apply-', dir=parent)
+        new_dir = os.path.join(staging, 'venv')
+        try:
+            _clone_tree(venv, new_dir)
+            for path in sorted(meta['removed'], reverse=True):
+                _remove(os.path.join(new_dir, path))
+            # Iterating the tar would restart from DELTA.json, that
+            # cannot be read again from a stream
+            member = tar.next()
+            while member:
+                _apply_member(tar, member, new_dir)
+                member = tar.next()
+
+            if os.path.abspath(output) == os.path.abspath(venv):
+                # The old venv ends in the staging directory
+                _exchange(new_dir, venv)
+            else:
+                os.rename(new_dir, output)
+        finally:
+            _rmtree(staging, ignore_errors=True)
+    print('%s updated to %s' % (venv, meta['new']))
+    return 0
+
+
+# Default socket for the daemon, in a directory private to the user
+DAEMON_SOCKET = (
+    os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                 'venvjail-%d.sock' % os.getuid())
+    if os.environ.get('XDG_RUNTIME_DIR') else
+    os.path.join(os.path.expanduser('~'), '.cache', 'venvjail',
+                 'daemon.sock'))
+
+# Environment variables used by the commands, sent to the daemon
+DAEMON_ENVIRONMENT = ('PATH', 'HOME', 'TMPDIR', 'LANG', 'LC_ALL', 'LC_CTYPE',
+                      'SOURCE_DATE_EPOCH', 'OSC_CONFIG')
+
+
+class WarmState():
+    """Data kept in memory by the daemon between requests.
+
+    The FileLists and the RPM headers are indexed by the path and the
+    stat of the file, so a modified file is read again.  The OBS
+    responses are kept for the `--ttl` of the request.
+    """
+    def __init__(self):
+        self.file_lists = {}
+        self.headers = {}
+        self.api = {}
+        self.caches = {}
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(filename):
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return filename, None, None
+        return filename, st.st_mtime, st.st_size
+
+    def file_list(self, filename):
+        key = self._key(filename)
+        with self.lock:
+            if key not in self.file_lists:
+                self.file_lists[key] = FileList(filename)
+            return self.file_lists[key]
+
+    def header(self, package):
+        key = self._key(package)
+        with self.lock:
+            header = self.headers.get(key)
+        if not header:
+            header = _read_rpm_header(package)
+            with self.lock:
+                self.headers[key] = header
+        return header
+
+    def cache(self, cache_dir, size):
+        key = (os.path.abspath(cache_dir), size)
+        with self.lock:
+            if key not in self.caches:
+                self.caches[key] = RPMCache(cache_dir, size)
+            return self.caches[key]
+
+    def template(self, cache_dir):
+        key = os.path.abspath(cache_dir)
+        with self.lock:
+            if key not in self.templates:
+                self.templates[key] = VirtualenvTemplates(cache_dir)
+            return self.templates[key]
+
+
+# Warm state, only used inside the daemon
+_warm = None
+
+
+def _file_list(filename):
+    """Return the FileList of a file, warm if running as daemon."""
+    if _warm:
+        return _warm.file_list(filename)
+    return FileList(filename)
+
+
+class _SocketWriter(io.TextIOBase):
+    """Text stream that sends the output to a daemon client."""
+    def __init__(self, f, lock, name):
+        self.f = f
+        self.lock = lock
+        self.name = name
+
+    def write(self, text):
+        message = json.dumps({self.name: text}).encode('utf-8') + b'\n'
+        with self.lock:
+            self.f.write(message)
+            self.f.flush()
+        return len(text)
+
+
+def _serve(connection, parser):
+    """Run a command for a client, with its directory and environment."""
+    f = connection.makefile('rwb')
+    request = json.loads(f.readline().decode('utf-8'))
+    if (not isinstance(request, dict)
+       or not isinstance(request.get('cwd'), str)
+       or not isinstance(request.get('env'), dict)
+       or not isinstance(request.get('argv'), list)):
+        raise ValueError('Invalid request, expected cwd, env and argv')
+    lock = threading.Lock()
+    stdout = _SocketWriter(f, lock, 'out')
+    stderr = _SocketWriter(f, lock, 'err')
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        os.chdir(request['cwd'])
+        for name in DAEMON_ENVIRONMENT:
+            os.environ.pop(name, None)
+        os.environ.update((name, value)
+                          for name, value in request['env'].items()
+                          if name in DAEMON_ENVIRONMENT)
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            try:
+                args = parser.parse_args(request['argv'])
+                if getattr(args, 'func', None) not in [
+                        globals()[command] for command in DAEMON_COMMANDS]:
+                    raise ValueError('Command not served by the daemon')
+                code = args.func(args) or 0
+            except SystemExit as e:
+                code = e.code or 0
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+    with lock:
+        f.write(json.dumps({'exit': code}).encode('utf-8') + b'\n')
+        f.flush()
+
+
+def daemon(args):
+    """Function called for the `daemon` command.
+
+    The requests are served one by one, as every one changes the
+    working directory and the standard output.
+    """
+    global _warm
+    _warm = WarmState()
+    # Remove the socket also when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    os.makedirs(os.path.dirname(os.path.abspath(args.listen)), mode=0o700,
+                exist_ok=True)
+    if os.path.exists(args.listen):
+        os.unlink(args.listen)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(args.listen)
+        os.chmod(args.listen, 0o600)
+        server.listen()
+        print('Listening on %s' % args.listen)
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    if _peer_uid(connection) != os.getuid():
+                        raise ValueError('Client of other user refused')
+                    _serve(connection, args.parser)
+                except Exception as e:
+                    # A bad client must not stop the daemon
+                    print('ERROR: %s' % e)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(args.listen):
+            os.unlink(args.listen)
+
+
+def _peer_uid(connection):
+    """Return the user of the other end of a Unix socket."""
+    ucred = struct.Struct('3i')
+    _, uid, _ = ucred.unpack(connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, ucred.size))
+    return uid
+
+
+def _client(socket_path, argv):
+    """Run a command in the daemon.
+
+    Only a daemon of the same user is used, and it only gets the
+    environment variables used by the commands.  Return the exit code,
+    or None if the daemon is not running (or cannot be trusted).
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        owner = os.stat(socket_path).st_uid
+        peer = _peer_uid(connection)
+    except OSError:
+        connection.close()
+        return None
+    if owner != os.getuid() or peer != os.getuid():
+        connection.close()
+        print('ERROR: %s is not a daemon of this user, ignoring it'
+              % socket_path, file=sys.stderr)
+        return None
+    with connection:
+        f = connection.makefile('rwb')
+        request = {'argv': argv, 'cwd': os.getcwd(),
+                   'env': {name: os.environ[name]
+                           for name in DAEMON_ENVIRONMENT
+                           if name in os.environ}}
+        f.write(json.dumps(request).encode('utf-8') + b'\n')
+        f.flush()
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+            else:
+                return message['exit']
+    print('ERROR: the daemon closed the connection', file=sys.stderr)
+    return 1
+
+
+def _osc_fetch(apiurl, api, headers=None):
+    """Fetch an OBS API path using `osc api`.
+
+    `osc` do not expose the response headers, so the cache validators
+    in `headers` are ignored and a full response is always returned.
+    Return the HTTP status, a file object with the body and the
+    response headers.
+    """
+    output = subprocess.check_output(
+        'osc --apiurl %s api %s' % (apiurl, api), shell=True)
+    return 200, io.BytesIO(output), {}
+
+
+def _osc_credentials(apiurl):
+    """Read the user and password for `apiurl` from the osc config.
+
+    Return None if there are no credentials that we can use (for
+    example if osc is using a keyring).
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read([os.environ.get('OSC_CONFIG', ''),
+                 os.path.expanduser('~/.config/osc/oscrc'),
+                 os.path.expanduser('~/.oscrc')])
+    for section in config.sections():
+        if section.rstrip('/') != apiurl.rstrip('/'):
+            continue
+        options = config[section]
+        if 'user' not in options:
+            return None
+        if 'pass' in options:
+            password = options['pass']
+        elif 'passx' in options:
+            # Obfuscated password, compressed and base64 encoded
+            password = bz2.decompress(
+                base64.b64decode(options['passx'])).decode('utf-8')
+        else:
+            return None
+        return options['user'], password
+    return None
+
+
+class OBSClient():
+    """HTTP client for the OBS API, with persistent connections.
+
+    Every thread keeps its own keep-alive connection to the server.
+    The response is returned without reading it, so it can be parsed
+    incrementally.  Use it as a fetch function for `APICache`.
+    """
+    def __init__(self, apiurl, user, password):
+        url = urllib.parse.urlsplit(apiurl)
+        self.https = url.scheme == 'https'
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        token = base64.b64encode(
+            ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+        self.auth = 'Basic %s' % token
+        self._local = threading.local()
+
+    def _connection(self, new=False):
+        connection = getattr(self._local, 'connection', None)
+        if new or not connection:
+            if connection:
+                connection.close()
+            if self.https:
+                connection = http.client.HTTPSConnection(self.netloc)
+            else:
+                connection = http.client.HTTPConnection(self.netloc)
+            self._local.connection = connection
+        return connection
+
+    def __call__(self, apiurl, api, headers=None):
+        """Request an API path, return the status, response and headers."""
+        headers = dict(headers or {})
+        headers['Authorization'] = self.auth
+        for retry in (False, True):
+            connection = self._connection(new=retry)
+            try:
+                connection.request('GET', self.prefix + api,
+                                   headers=headers)
+                response = connection.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed the persistent connection
+                if retry:
+                    raise
+        if response.status == 401:
+            # Probably a server that require signature authentication
+            response.read()
+            return _osc_fetch(apiurl, api, headers)
+        if response.status not in (200, 304):
+            response.read()
+            raise IOError('HTTP %d %s for %s' % (response.status,
+                                                 response.reason, api))
+        return response.status, response, response.headers
+
+
+def _obs_fetch(apiurl):
+    """Return the fetch function for an API URL.
+
+    The native client is used when the osc configuration has the
+    credentials for `apiurl`, if not we fall back to `osc api`.
+    """
+    credentials = _osc_credentials(apiurl)
+    if credentials:
+        return OBSClient(apiurl, *credentials)
+    return _osc_fetch
+
+
+class APICache():
+    """On-disk cache of OBS API responses.
+
+    The responses are stored by API URL and API path.  A response
+    younger than `ttl` seconds is used directly.  An older one is
+    revalidated using the ETag and Last-Modified headers, if the
+    server provided them.  In `offline` mode only the stored responses
+    are used, regardless of the age.
+    """
+    def __init__(self, path, ttl=3600, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(path, exist_ok=True)
+
+    def _entry(self, apiurl, api):
+        key = hashlib.sha256(('%s %s' % (apiurl, api)).encode('utf-8'))
+        return os.path.join(self.path, key.hexdigest())
+
+    def get(self, apiurl, api, fetch=_osc_fetch):
+        """Return a file object with the body of a response.
+
+        The body is streamed into the cache, and read back from it.
+        """
+        entry = self._entry(apiurl, api)
+        try:
+            with open(entry + '.json') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = None
+
+        if self.offline:
+            if not meta:
+                raise LookupError('%s%s is not in the API cache' % (apiurl,
+                                                                    api))
+            return self._body(entry)
+        if meta and time.time() - meta['time'] < self.ttl:
+            return self._body(entry)
+
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        status, response, response_headers = fetch(apiurl, api, headers)
+        if status == 304 and meta:
+            response.read()
+            meta['time'] = time.time()
+            self._write(entry + '.json', json.dumps(meta).encode('utf-8'))
+            return self._body(entry)
+
+        self._write(entry + '.body', response)
+        meta = {
+            'apiurl': apiurl,
+            'api': api,
+            'time': time.time(),
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+        }
+        self._write(entry + '.json', json.dumps(meta).encode('utf-8'))
+        return self._body(entry)
+
+    @staticmethod
+    def _body(entry):
+        return open(entry + '.body', 'rb')
+
+    @staticmethod
+    def _write(filename, data):
+        """Write bytes or a file object into a file atomically."""
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with open(fd, 'wb') as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+
+# Fetch function for every API URL
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def _osc_api(args, api):
+    """Return a file object with the response of the OBS API.
+
+    The cache is used if enabled.
+    """
+    if args.offline and not args.api_cache:
+        raise LookupError('--offline requires --api-cache')
+    with _fetchers_lock:
+        if args.apiurl not in _fetchers:
+            _fetchers[args.apiurl] = (_osc_fetch if args.osc else
+                                      _obs_fetch(args.apiurl))
+        fetch = _fetchers[args.apiurl]
+    if _warm:
+        # The daemon keeps the responses in memory
+        key = (args.apiurl, api)
+        with _warm.lock:
+            created, data = _warm.api.get(key, (0, None))
+        if data is None or time.time() - created >= args.ttl:
+            with _osc_api_uncached(args, api, fetch) as response:
+                data = response.read()
+            with _warm.lock:
+                _warm.api[key] = (time.time(), data)
+        return io.BytesIO(data)
+    return _osc_api_uncached(args, api, fetch)
+
+
+def _osc_api_uncached(args, api, fetch):
+    """Return the response of the OBS API, from the disk cache."""
+    if args.api_cache:
+        cache = APICache(args.api_cache, args.ttl, args.offline)
+        return cache.get(args.apiurl, api, fetch)
+    _, response, _ = fetch(args.apiurl, api)
+    return response
+
+
+def _filter_binary_xml(source):
+    """Filter a XML stream of binary elements
+
+    The XML is parsed incrementally, and the elements are discarded
+    after reading them, so big listings are processed in constant
+    memory.
+    """
+    elements = []
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, binary in context:
+        if event != 'end' or binary.tag != 'binary':
+            continue
+        rpm = binary.get('filename')
+        root.clear()
+        if rpm.startswith('_'):
+            continue
+        if rpm.endswith('.log'):
+            continue
+        if rpm.endswith('src.rpm'):
+            continue
+        elements.append(rpm)
+    return elements
+
+
+def _filter_binary_name(names, args):
+    """Filter a list of RPM names"""
+    exclude = _file_list(args.exclude)
+    if args.all:
+        return names
+    else:
+        return [rpm for rpm in names if rpm not in exclude]
+
+
+def _repository(args):
+    """List binary packages from a repository"""
+    api = '/build/%s/%s/%s/_repository' % (args.project, args.repo,
+                                           args.arch)
+    with _osc_api(args, api) as response:
+        elements = _filter_binary_xml(response)
+    # Unversioned name, so we remove the file extension
+    elements = [rpm.replace('.rpm', '') for rpm in elements]
+    return _filter_binary_name(elements, args)
+
+
+def include(args):
+    """Generate initial include-rpm file"""
+    print('# List of packages to include (use Python regex)')
+    print()
+    print('# Packages from the repository')
+    for name in _repository(args):
+        print('%s.*' % name)
+
+
+def exclude(args):
+    """Generate initial exclude-rpm file"""
+    print(EXCLUDE_RPM)
+
+
+def _source_packages(args):
+    """Return the source packages from the command line and the file."""
+    packages = list(args.packages)
+    if args.from_file:
+        packages.extend(
+            line.strip() for line in open(args.from_file)
+            if line.strip() and not line.strip().startswith('#'))
+    # Remove duplicates, keeping the order
+    return list(collections.OrderedDict.fromkeys(packages))
+
+
+def _map_packages(func, args):
+    """Call `func(args, package)` concurrently for every source package.
+
+    Return a list of (package, result) in the same order as the
+    packages, and the number of failed calls.  The failures are
+    reported, but do not stop the rest of the calls.
+    """
+    packages = _source_packages(args)
+    if not packages:
+        args.command_parser.error('no source packages, use PACKAGE or '
+                                  '--from-file')
+    results = []
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        futures = [executor.submit(func, args, package)
+                   for package in packages]
+        for package, future in zip(packages, futures):
+            try:
+                results.append((package, future.result()))
+            except Exception as e:
+                print('ERROR: %s: %s' % (package, e), file=sys.stderr)
+                failed += 1
+    return results, failed
+
+
+def _binary(args, package):
+    """List the binary RPM files from a source package"""
+    api = '/build/%s/%s/%s/%s' % (args.project, args.repo,
+                                  args.arch, package)
+    with _osc_api(args, api) as response:
+        return _filter_binary_xml(response)
+
+
+def binary(args):
+    """List binary packages from source packages"""
+
+    # OBS generate a full RPM package name, including the version and
+    # architecture.  To generate include-rpm and exclude-rpm, we will
+    # need only the name of the package
+    rpm_re = re.compile(r'(.*)-([^-]+)-([^-]+)\.([^-\.]+)\.rpm')
+
+    results, failed = _map_packages(_binary, args)
+    # Take only the name of the package, without duplicates
+    elements = collections.OrderedDict()
+    for _, rpms in results:
+        for rpm in rpms:
+            elements[rpm_re.match(rpm).groups()[0]] = None
+    elements = _filter_binary_name(list(elements), args)
+    for rpm in elements:
+        print(rpm)
+    return 1 if failed else 0
+
+
+def _filter_requires_spec(spec):
+    """Recover the Requires elements from a spec file"""
+    requires = re.findall(r'^Requires:\s*([-\.\w]+)(.*)?$', spec,
+                          re.MULTILINE)
+    return dict(requires)
+
+
+def _requires(args, package):
+    """Return the Requires elements from the spec of a source package"""
+    api = '/source/%s/%s/%s.spec' % (args.project, package, package)
+    with _osc_api(args, api) as response:
+        return _filter_requires_spec(response.read().decode('utf-8'))
+
+
+def requires(args):
+    """List requirements for source packages"""
+
+    results, failed = _map_packages(_requires, args)
+    requires_and_version = collections.defaultdict(set)
+    for _, package_requires in results:
+        for rpm, version in package_requires.items():
+            requires_and_version[rpm].add(version.strip())
+    requires = requires_and_version.keys()
+
+    # Remove the packages included in the venv
+    include = _file_list(args.include)
+    exclude = _file_list(args.exclude)
+    in_venv = []
+    for rpm in requires:
+        if rpm in exclude:
+            continue
+        if include.is_populated() and rpm not in include:
+            continue
+        in_venv.append(rpm)
+    requires = set(requires) - set(in_venv)
+
+    for rpm in sorted(requires):
+        # The same requirement can come with different versions from
+        # different packages
+        for version in sorted(requires_and_version[rpm]):
+            requires = '%s %s' % (rpm, version)
+            print(requires.strip())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Utility to help venvs creation for OpenStack services')
+    parser.add_argument('-S', '--socket',
+                        default=os.environ.get('VENVJAIL_SOCKET',
+                                               DAEMON_SOCKET),
+                        help='Socket of the daemon used with --daemon '
+                        '(default: $VENVJAIL_SOCKET or %(default)s)')
+    parser.add_argument('-D', '--daemon', dest='use_daemon',
+                        action='store_true',
+                        default=bool(os.environ.get('VENVJAIL_DAEMON')),
+                        help='Run create, include, binary and requires in '
+                        'the daemon, if it is running (default: '
+                        '$VENVJAIL_DAEMON)')
+    subparsers = parser.add_subparsers(help='Sub-commands for venvjail')
+
+    # Parser for `create` command
+    subparser = subparsers.add_parser('create', help='Create a virtualenv')
+    subparser.add_argument('dest_dir', metavar='DEST_DIR',
+                           help='Virtual environment directory')
+    subparser.add_argument('-s', '--system-site-packages',
+                           action='store_false',
+                           help='Allows access to the global site-packages')
+    subparser.add_argument('-l', '--relocate',
+                           default='/opt/stack/venv',
+                           help='Relocated virtual environment directory')
+    subparser.add_argument('--no-relocate-shebang-list', metavar='PATH',
+                           default=[],
+                           nargs='+',
+                           help='Do not change the shebang in these files. '
+                               'Wildcards supported (fnmatch/bash style). '
+                               'Specify with DEST_DIR.')
+    subparser.add_argument('--byte-compile', action='store_true',
+                           help='Byte-compile the Python sources after '
+                           'the relocation, except the ones listed in '
+                           '--no-relocate-shebang-list')
+    subparser.add_argument('-r', '--repo',
+                           default='/.build.binaries',
+                           help='Repository directory')
+    subparser.add_argument('-i', '--include',
+                           default='include-rpm',
+                           help='File with the list of packages to install')
+    subparser.add_argument('-x', '--exclude',
+                           default='exclude-rpm',
+                           help='File with packages to exclude')
+    subparser.add_argument('--exclude-path',
+                           default='exclude-path',
+                           help='File with paths to exclude from the '
+                           'packages')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=1,
+                           help='Number of RPMs extracted in parallel')
+    subparser.add_argument('--cache-dir',
+                           help='Cache directory for the extracted RPMs '
+                           'and the virtualenv templates')
+    subparser.add_argument('--cache-size', type=int,
+                           default=10240,
+                           help='Maximum size of the cache (in MiB)')
+    subparser.add_argument('--index',
+                           help='Index of the RPM headers of the '
+                           'repository (created if missing)')
+    subparser.add_argument('--match-name', action='store_true',
+                           help='Match the include and exclude rules '
+                           'against the package name, not the file name')
+    subparser.add_argument('--root', metavar='PKG', action='append',
+                           help='Only install the dependency closure of '
+                           'this package, from the included ones (can be '
+                           'used several times)')
+    subparser.add_argument('-u', '--update', action='store_true',
+                           help='Update an existing venv, extracting only '
+                           'the new or changed packages')
+    subparser.add_argument('--profile', metavar='FILE',
+                           help='Dump a cProfile of the build to FILE')
+    subparser.add_argument('--archive', metavar='FILE',
+                           help='Write the venv as a reproducible archive '
+                           '(.tar.zst, .tar.xz, .tar.gz or .tar)')
+    subparser.add_argument('--archive-mtime', metavar='EPOCH', type=int,
+                           help='Clamp the modification times of the '
+                           'archive (default: SOURCE_DATE_EPOCH, or the '
+                           'newest time of the files in the RPMs)')
+    subparser.add_argument('-t', '--track',
+                           help='Filename for the L3/Maintenance track file')
+    subparser.add_argument('-v', '--version',
+                           default='0.1.0',
+                           help='Package version')
+    subparser.add_argument('-a', '--ardana-version',
+                           default='0.9.0',
+                           help='Ardana version')
+    subparser.set_defaults(func=create)
+    create_parser = subparser
+
+    # Parser for `create-many` command
+    subparser = subparsers.add_parser(
+        'create-many', help='Create several virtualenvs together')
+    subparser.add_argument('manifest', metavar='MANIFEST',
+                           help='JSON file with the list of venvs, every '
+                           'one with the `create` options (dest_dir, '
+                           'include, exclude, relocate, version, ...)')
+    subparser.add_argument('-r', '--repo',
+                           default='/.build.binaries',
+                           help='Repository directory')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=os.cpu_count() or 1,
+                           help='Number of jobs shared by all the builds')
+    subparser.add_argument('--cache-dir',
+                           help='Cache directory shared by the builds '
+                           '(by default a temporary one)')
+    subparser.add_argument('--cache-size', type=int,
+                           default=10240,
+                           help='Maximum size of the cache (in MiB)')
+    subparser.add_argument('--index',
+                           help='Index of the RPM headers of the '
+                           'repository')
+    subparser.set_defaults(func=create_many, create_parser=create_parser)
+
+    # Parser for `plan` command
+    subparser = subparsers.add_parser(
+        'plan', help='Show what `create` will install, without extracting')
+    subparser.add_argument('-r', '--repo',
+                           default='/.build.binaries',
+                           help='Repository directory')
+    subparser.add_argument('-i', '--include',
+                           default='include-rpm',
+                           help='File with the list of packages to install')
+    subparser.add_argument('-x', '--exclude',
+                           default='exclude-rpm',
+                           help='File with packages to exclude')
+    subparser.add_argument('--exclude-path',
+                           default='exclude-path',
+                           help='File with paths to exclude from the '
+                           'packages')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=8,
+                           help='Number of RPM headers read in parallel')
+    subparser.add_argument('--index',
+                           help='Index of the RPM headers of the '
+                           'repository (created if missing)')
+    subparser.add_argument('--match-name', action='store_true',
+                           help='Match the include and exclude rules '
+                           'against the package name, not the file name')
+    subparser.add_argument('--root', metavar='PKG', action='append',
+                           help='Only consider the dependency closure of '
+                           'this package (can be used several times)')
+    subparser.add_argument('--dest-dir', default='',
+                           help='Virtual environment directory, used to '
+                           'match --no-relocate-shebang-list like `create`')
+    subparser.add_argument('--no-relocate-shebang-list', metavar='PATH',
+                           default=[],
+                           nargs='+',
+                           help='Scripts that will keep their shebang. '
+                           'Wildcards supported (fnmatch/bash style)')
+    subparser.add_argument('--json', action='store_true',
+                           help='Output in JSON format')
+    subparser.set_defaults(func=plan)
+
+    # Parser for `verify` command
+    subparser = subparsers.add_parser(
+        'verify', help='Verify a venv against the RPM headers')
+    subparser.add_argument('dest_dir', metavar='DEST_DIR',
+                           help='Virtual environment directory')
+    subparser.add_argument('-l', '--relocate',
+                           default='/opt/stack/venv',
+                           help='Relocated virtual environment directory')
+    subparser.add_argument('-r', '--repo',
+                           default='/.build.binaries',
+                           help='Repository directory')
+    subparser.add_argument('--index',
+                           help='Index of the RPM headers of the '
+                           'repository (created if missing)')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=os.cpu_count() or 1,
+                           help='Number of files verified in parallel')
+    subparser.set_defaults(func=verify)
+
+    # Parser for `delta` command
+    subparser = subparsers.add_parser(
+        'delta', help='Create a delta artifact between two venvs')
+    subparser.add_argument('old_dir', metavar='OLD_DIR',
+                           help='Virtual environment of the previous build')
+    subparser.add_argument('new_dir', metavar='NEW_DIR',
+                           help='Virtual environment of the new build')
+    subparser.add_argument('-o', '--output', required=True,
+                           help='Delta file (.tar.zst, .tar.xz, .tar.gz '
+                           'or .tar)')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           default=os.cpu_count() or 1,
+                           help='Number of files hashed in parallel')
+    subparser.set_defaults(func=delta)
+
+    # Parser for `apply` command
+    subparser = subparsers.add_parser(
+        'apply', help='Update an installed venv with a delta artifact')
+    subparser.add_argument('delta', metavar='DELTA',
+                           help='Delta file created by `delta`')
+    subparser.add_argument('venv', metavar='VENV',
+                           help='Installed virtual environment, the base '
+                           'of the delta')
+    subparser.add_argument('-o', '--output',
+                           help='Directory for the new venv (default: the '
+                           'name of the new venv, next to VENV)')
+    subparser.set_defaults(func=apply)
+
+    # Parser for `index` command
+    subparser = subparsers.add_parser(
+        'index', help='Create or refresh the index of RPM headers')
+    subparser.add_argument('index', metavar='INDEX',
+                           help='SQLite file for the index')
+    subparser.add_argument('-r', '--repo',
+                           default='/.build.binaries',
+                           help='Repository directory')
+    subparser.set_defaults(func=index)
+
+    # Parser for `include` command
+    subparser = subparsers.add_parser(
+        'include', help='Generate initial include-rpm file')
+    subparser.add_argument('-A', '--apiurl',
+                           default='https://api.opensuse.org',
+                           help='API address')
+    subparser.add_argument('--api-cache', metavar='DIR',
+                           help='Cache directory for the API responses')
+    subparser.add_argument('--ttl', type=int, default=3600,
+                           help='Seconds before revalidating a cached '
+                           'response')
+    subparser.add_argument('--offline', action='store_true',
+                           help='Use only the cached API responses')
+    subparser.add_argument('--osc', action='store_true',
+                           help='Use `osc api` instead of the native '
+                           'HTTP client')
+    subparser.add_argument('-p', '--project',
+                           default='Cloud:OpenStack:Master',
+                           help='Project name')
+    subparser.add_argument('-r', '--repo', default='SLE_12_SP3',
+                           help='Repository name')
+    subparser.add_argument('-a', '--arch', default='x86_64',
+                           help='Architecture')
+    subparser.add_argument('--all', action='store_true',
+                           help='Include all packages')
+    subparser.add_argument('-x', '--exclude',
+                           default='exclude-rpm',
+                           help='File with packages to exclude')
+    subparser.set_defaults(func=include)
+
+    # Parser for `exclude` command
+    subparser = subparsers.add_parser(
+        'exclude', help='Generate initial exclude-rpm file')
+    subparser.set_defaults(func=exclude)
+
+    # Parser for `binary` command
+    subparser = subparsers.add_parser(
+        'binary', help='List the binary packages')
+    subparser.add_argument('packages', metavar='PACKAGE', nargs='*',
+                           help='Source package name')
+    subparser.add_argument('-F', '--from-file', metavar='FILE',
+                           help='File with a source package name per line')
+    subparser.add_argument('-j', '--jobs', type=int, default=8,
+                           help='Number of concurrent queries')
     subparser.add_argument('-A', '--apiurl',
                            default='https://api.opensuse.org',
                            help='API address')
+    subparser.add_argument('--api-cache', metavar='DIR',
+                           help='Cache directory for the API responses')
+    subparser.add_argument('--ttl', type=int, default=3600,
+                           help='Seconds before revalidating a cached '
+                           'response')
+    subparser.add_argument('--offline', action='store_true',
+                           help='Use only the cached API responses')
+    subparser.add_argument('--osc', action='store_true',
+                           help='Use `osc api` instead of the native '
+                           'HTTP client')
     subparser.add_argument('-p', '--project',
                            default='Cloud:OpenStack:Master',
                            help='Project name')
@@ -626,16 +4260,30 @@ if __name__ == '__main__':
     subparser.add_argument('-x', '--exclude',
                            default='exclude-rpm',
                            help='File with packages to exclude')
-    subparser.set_defaults(func=binary)
+    subparser.set_defaults(func=binary, command_parser=subparser)
 
     # Parser for `requires` command
     subparser = subparsers.add_parser(
         'requires', help='List requirements for a package')
-    subparser.add_argument('package', metavar='PACKAGE',
+    subparser.add_argument('packages', metavar='PACKAGE', nargs='*',
                            help='Source package name')
+    subparser.add_argument('-F', '--from-file', metavar='FILE',
+                           help='File with a source package name per line')
+    subparser.add_argument('-j', '--jobs', type=int, default=8,
+                           help='Number of concurrent queries')
     subparser.add_argument('-A', '--apiurl',
                            default='https://api.opensuse.org',
                            help='API address')
+    subparser.add_argument('--api-cache', metavar='DIR',
+                           help='Cache directory for the API responses')
+    subparser.add_argument('--ttl', type=int, default=3600,
+                           help='Seconds before revalidating a cached '
+                           'response')
+    subparser.add_argument('--offline', action='store_true',
+                           help='Use only the cached API responses')
+    subparser.add_argument('--osc', action='store_true',
+                           help='Use `osc api` instead of the native '
+                           'HTTP client')
     subparser.add_argument('-p', '--project',
                            default='Cloud:OpenStack:Master',
                            help='Project name')
@@ -645,7 +4293,22 @@ if __name__ == '__main__':
     subparser.add_argument('-x', '--exclude',
                            default='exclude-rpm',
                            help='File with packages to exclude')
-    subparser.set_defaults(func=requires)
+    subparser.set_defaults(func=requires, command_parser=subparser)
+
+    # Parser for `daemon` command
+    subparser = subparsers.add_parser(
+        'daemon', help='Serve the commands from a Unix socket, keeping '
+        'the caches in memory')
+    subparser.add_argument('listen', metavar='SOCKET', nargs='?',
+                           default=DAEMON_SOCKET,
+                           help='Path of the Unix socket')
+    subparser.set_defaults(func=daemon, parser=parser)
 
     args = parser.parse_args()
-    args.func(args)
+    if (args.func in (create, include, binary, requires)
+       and args.use_daemon):
+        # Use the daemon if it is running
+        code = _client(args.socket, sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    sys.exit(args.func(args))